@@ -13,9 +13,6 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 from pathlib import Path
 import os
 from dotenv import load_dotenv
-import redis 
-
-redis_client = redis.StrictRedis(host='localhost', port=6379, db=0)
 
 load_dotenv()
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework_simplejwt',
     'corsheaders',
@@ -50,6 +48,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -62,7 +61,7 @@ MIDDLEWARE = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'chat.authentication.JWTTokenUserAuthentication',
     ),
 }
 
@@ -148,4 +147,72 @@ CORS_ALLOWED_ORIGINS = [
 ]
 CORS_ALLOW_CREDENTIALS = True
 
+# Redis (see chat/redis_client.py)
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', '50'))
+REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', '5'))  # wait for a free pooled connection
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', '5'))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(os.getenv('REDIS_SOCKET_CONNECT_TIMEOUT', '2'))
+REDIS_RETRY_ATTEMPTS = int(os.getenv('REDIS_RETRY_ATTEMPTS', '3'))  # with exponential backoff
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', '30'))
+
+# Request metrics (chat/metrics.py, scraped at /metrics)
+# Share of requests whose SQL and Redis use is recorded (every request is timed)
+METRICS_SAMPLE_RATE = float(os.getenv('METRICS_SAMPLE_RATE', '0.1'))
+# Add a Server-Timing header with the breakdown to sampled responses
+METRICS_SERVER_TIMING = os.getenv('METRICS_SERVER_TIMING', 'False') == 'True'
+# Seconds between each worker adding its counters to the shared Redis hash
+METRICS_FLUSH_INTERVAL = 10
+# Socket timeout (seconds) of the flush, which is never retried
+METRICS_FLUSH_TIMEOUT = 0.5
+# /metrics is staff-only; when set, scrapers may send "Authorization: Bearer <token>" instead
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Chat
+# Page size for get-messages and list-vault when the client does not pass ?limit=, and the cap on ?limit=
+CHAT_MESSAGES_DEFAULT_LIMIT = 100
+CHAT_MESSAGES_MAX_LIMIT = 500
+# search-users page size when the client does not pass ?limit=, and the cap on ?limit=
+CHAT_SEARCH_DEFAULT_LIMIT = 20
+CHAT_SEARCH_MAX_LIMIT = 50
+# Most messages accepted by one send-messages batch
+CHAT_SEND_BATCH_MAX = 500
+# Rows export-vault fetches from its server-side cursor at a time
+CHAT_VAULT_EXPORT_CHUNK_SIZE = 2000
+# Most messages one bulk-save-to-vault or bulk-delete-from-vault request accepts
+CHAT_VAULT_BATCH_MAX = 500
+# Ephemeral message storage in Redis: "list" (RPUSH lists) or "stream" (Redis Streams,
+# O(1) removal by id). Existing conversations are not migrated when this changes.
+CHAT_EPHEMERAL_BACKEND = os.getenv('CHAT_EPHEMERAL_BACKEND', 'list')
+# Caps on each direction of a conversation in Redis; every send drops the oldest
+# messages past either cap (see chat/redis_scripts.py)
+CHAT_CONVERSATION_MAX_MESSAGES = 10000
+CHAT_CONVERSATION_MAX_BYTES = 10 * 1024 * 1024
+# Largest message content accepted by the send endpoints, in UTF-8 bytes
+CHAT_MESSAGE_MAX_BYTES = 64 * 1024
+
+# JWT authentication (chat/authentication.py): seconds each worker trusts a user's
+# is_active flag before checking it again (None: never check, trust the token until it
+# expires), and how many users it remembers
+AUTH_USER_ACTIVE_TTL = 60
+AUTH_USER_CACHE_SIZE = 10000
+
+# Friend graph cache (chat/cache.py): lifetime of each user's Redis friend set, and
+# the size and lifetime of the per-worker copy in front of it
+FRIEND_CACHE_TTL = 86400
+FRIEND_CACHE_LOCAL_SIZE = 10000
+FRIEND_CACHE_LOCAL_TTL = 60
+
+# Encryption keys
+# Clients are told to replenish one-time keys once fewer than the low watermark
+# remain, and to top the pool back up to the high watermark
+ONE_TIME_KEYS_LOW_WATERMARK = 20
+ONE_TIME_KEYS_HIGH_WATERMARK = 100
+# Most one-time keys accepted by one upload
+ONE_TIME_KEYS_MAX_UPLOAD = 1000
+# Most users whose keys one /api/keys/claim/ request can claim
+ONE_TIME_KEYS_CLAIM_BATCH_MAX = 500
+# Lifetime of each user's cached identity and signing keys (chat/cache.py)
+KEY_DIRECTORY_CACHE_TTL = 86400
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
@@ -4,7 +4,10 @@ URL configuration for backend project.
 from django.contrib import admin
 from django.urls import path, include
 
+from chat.metrics import metrics_view
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/", include("chat.urls")),
+    path("metrics", metrics_view),
 ]
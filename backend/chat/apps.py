@@ -1,6 +1,24 @@
+import logging
+
 from django.apps import AppConfig
 
+logger = logging.getLogger(__name__)
+
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        import redis
+        from . import cache, metrics
+        from .redis_util import load_scripts
+
+        metrics.install()
+        cache.install()
+
+        try:
+            load_scripts()
+        except redis.RedisError:
+            # Scripts are loaded lazily on first use (EVAL fallback) if Redis is not up yet
+            logger.warning('Could not preload Redis scripts; they will be loaded on first use')
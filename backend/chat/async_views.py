@@ -0,0 +1,235 @@
+"""
+Async (ASGI-native) versions of the messaging hot path, the key endpoints and
+the vault export.
+
+DRF views are synchronous, so under ASGI each request holds a thread while it
+waits on Redis and PostgreSQL. These are plain Django async views instead:
+Redis goes through the asyncio client and the database through the async ORM,
+so one worker can keep thousands of requests in flight. They are mounted under
+/api/async/ and take and return the same JSON as their DRF counterparts in
+views.py, whose response helpers they share. Under WSGI they still work, but
+Django runs each one in an event loop of its own, which gets its own Redis client
+and pool (see redis_client.PerLoopRedis), so the sync endpoints are cheaper there.
+"""
+import functools
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+
+from .authentication import JWTTokenUserAuthentication, aget_user
+from .cache import aget_identity_keys, ais_friend, store_identity_keys
+from .models import Message, OneTimeKeys, UserKeys
+from .redis_util import aget_conversation_messages, amark_read, apublish_event, asave_temp_message
+from .views import (
+    CONTENT_NOT_STRING, MESSAGE_TOO_LARGE, VAULT_EXPORT_LINES_PER_CHUNK, VAULT_FIELDS, conversation_page,
+    conversation_vault_rows, is_integer_id, message_too_large, one_time_key_pool, parse_key_upload,
+    parse_message_cursors, vault_entry, vault_export_chunks,
+)
+
+
+async def authenticate(request):
+    """
+    The user of the request's "Authorization: Bearer <access token>" header, or
+    None. Like the DRF views it is a TokenUser (see authentication.py); these
+    views only use its id and username, which never need a query.
+    """
+    auth = JWTTokenUserAuthentication()
+    header = auth.get_header(request)
+    raw_token = auth.get_raw_token(header) if header else None
+    if raw_token is None:
+        return None
+    try:
+        return await aget_user(auth.get_validated_token(raw_token))
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+
+def api_view(*methods):
+    """
+    Authenticate with the JWT access token, allow only `methods`, and parse a JSON
+    body into request.data, like the DRF views.
+    """
+    def decorator(view):
+        @csrf_exempt
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+            user = await authenticate(request)
+            if user is None:
+                return JsonResponse({'detail': 'Authentication credentials were not provided or are invalid.'}, status=401)
+            request.user = user
+            request.data = {}
+            if request.body:
+                try:
+                    request.data = json.loads(request.body)
+                except ValueError:
+                    return JsonResponse({'error': 'Request body must be JSON'}, status=400)
+                if not isinstance(request.data, dict):
+                    return JsonResponse({'error': 'Request body must be a JSON object'}, status=400)
+            return await view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ============ MESSAGING ============
+
+@api_view('POST')
+async def send_message(request):
+    """POST /api/async/send-message/ - see views.SendMessageView"""
+    receiver_id = request.data.get('receiver_id')
+    content = request.data.get('content')
+
+    if not receiver_id or not content:
+        return JsonResponse({'error': 'receiver_id and content are required'}, status=400)
+
+    if not is_integer_id(receiver_id):
+        return JsonResponse({'error': 'receiver_id must be an integer'}, status=400)
+
+    if not isinstance(content, str):
+        return JsonResponse({'error': CONTENT_NOT_STRING}, status=400)
+
+    if message_too_large(content):
+        return JsonResponse({'error': MESSAGE_TOO_LARGE}, status=413)
+
+    if not await ais_friend(request.user.id, receiver_id):
+        return JsonResponse({'error': 'You can only message friends'}, status=403)
+
+    saved = await asave_temp_message(request.user.id, receiver_id, content)
+
+    return JsonResponse({
+        'message': 'Message sent!',
+        'message_data': {
+            'id': saved['id'],
+            'sender_id': request.user.id,
+            'sender_username': request.user.username,
+            'receiver_id': receiver_id,
+            'content': content,
+            'timestamp': saved['timestamp'],
+        }
+    }, status=201)
+
+
+@api_view('GET')
+async def get_messages(request):
+    """GET /api/async/get-messages/?user_id=<id> - see views.GetMessagesView"""
+    other_user_id = request.GET.get('user_id')
+    if not other_user_id:
+        return JsonResponse({'error': 'user_id is required'}, status=400)
+
+    try:
+        cursors, limit = parse_message_cursors(request.GET)
+    except ValueError:
+        return JsonResponse({'error': 'Cursors and limit must be integers'}, status=400)
+
+    other_user = await User.objects.filter(id=other_user_id).afirst()
+    if other_user is None:
+        return JsonResponse({'error': 'User not found'}, status=404)
+
+    saved_messages = Message.objects.saved_in_conversation(request.user.id, other_user)
+    saved_messages = [msg async for msg in conversation_vault_rows(saved_messages, cursors, limit)]
+    received, sent = await aget_conversation_messages(
+        request.user.id, other_user.id, cursors.get('since'), cursors.get('before'), limit + 1
+    )
+    if 'before' not in cursors:
+        await amark_read(request.user.id, other_user.id)
+
+    usernames = {other_user.id: other_user.username, request.user.id: request.user.username}
+    return JsonResponse(conversation_page(cursors, limit, saved_messages, received + sent, usernames))
+
+
+@api_view('GET')
+async def export_vault(request):
+    """GET /api/async/export-vault/ - see views.ExportVaultView"""
+    messages = (
+        Message.objects.saved_by(request.user.id).order_by('timestamp', 'id').values(*VAULT_FIELDS)
+        .aiterator(chunk_size=settings.CHAT_VAULT_EXPORT_CHUNK_SIZE)
+    )
+
+    async def chunks():
+        entries = []
+        async for msg in messages:
+            entries.append(vault_entry(msg))
+            if len(entries) == VAULT_EXPORT_LINES_PER_CHUNK:
+                yield ''.join(vault_export_chunks(entries))
+                entries = []
+        if entries:
+            yield ''.join(vault_export_chunks(entries))
+
+    response = StreamingHttpResponse(chunks(), content_type='application/x-ndjson')
+    response['Content-Disposition'] = 'attachment; filename="vault.ndjson"'
+    return response
+
+
+# ============ ENCRYPTION KEYS ============
+
+@api_view('POST')
+async def upload_keys(request):
+    """POST /api/async/keys/upload/ - see views.UploadKeysView"""
+    try:
+        identity_key, signing_key, one_time_keys = parse_key_upload(request.data)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    user_keys, _ = await UserKeys.objects.aupdate_or_create(
+        user_id=request.user.id,
+        defaults={'identity_key': identity_key, 'signing_key': signing_key}
+    )
+    await sync_to_async(store_identity_keys)(request.user.username, user_keys)
+
+    added = await sync_to_async(OneTimeKeys.objects.add)(request.user.id, one_time_keys)
+    available = await OneTimeKeys.objects.filter(user_id=request.user.id, is_used=False).acount()
+
+    return JsonResponse({
+        'message': 'Keys registered successfully',
+        'oneTimeKeysAdded': added,
+        **one_time_key_pool(available),
+    }, status=201)
+
+
+@api_view('GET')
+async def query_keys(request, username):
+    """GET /api/async/keys/query/<username>/ - see views.QueryKeysView"""
+    keys = await aget_identity_keys(username)
+    if keys is None:
+        if not await User.objects.filter(username=username).aexists():
+            return JsonResponse({'error': 'User not found'}, status=404)
+        return JsonResponse({'error': 'User has not uploaded encryption keys'}, status=404)
+
+    # The claim is one raw statement (see OneTimeKeysQuerySet.claim), run in a thread
+    otk = await sync_to_async(OneTimeKeys.objects.claim)(keys['user_id'])
+
+    if not otk:
+        return JsonResponse({'error': 'No one-time keys available. User needs to replenish.'}, status=400)
+
+    pool = one_time_key_pool(await OneTimeKeys.objects.filter(user_id=keys['user_id'], is_used=False).acount())
+    if pool['replenish']:
+        await apublish_event(keys['user_id'], {'type': 'otk_low', **pool})
+
+    return JsonResponse({
+        'identityKey': keys['identity_key'],
+        'signingKey': keys['signing_key'],
+        'oneTimeKey': otk.key_value,
+        'oneTimeKeyId': otk.key_id,
+    })
+
+
+@api_view('GET')
+async def own_keys(request):
+    """GET /api/async/keys/me/ - see views.GetOwnKeysView"""
+    keys = await aget_identity_keys(request.user.username)
+    if keys is None:
+        return JsonResponse({'hasKeys': False, **one_time_key_pool(0)})
+
+    available_otks = await OneTimeKeys.objects.filter(user_id=request.user.id, is_used=False).acount()
+    return JsonResponse({
+        'hasKeys': True,
+        'identityKey': keys['identity_key'],
+        'signingKey': keys['signing_key'],
+        **one_time_key_pool(available_otks),
+    })
@@ -0,0 +1,132 @@
+"""
+JWT authentication without a database query per request.
+
+simplejwt's JWTAuthentication loads the User row on every request just to set
+request.user, although the send and polling views only need the id and the
+username. Here request.user is a TokenUser: a lazy User whose id and username
+come from the token claims (tokens carry a "username" claim, see RefreshToken)
+and whose row is only loaded if a view touches anything else or hands it to the
+ORM. Views on the hot path filter by request.user.id so they never load it.
+
+Deactivated users are still refused: each worker caches every user's is_active
+for AUTH_USER_ACTIVE_TTL seconds, so the check costs one query per user per
+worker per TTL (and that query also fills in the lazy User). A deactivation
+therefore takes up to AUTH_USER_ACTIVE_TTL seconds to apply; set it to None to
+skip the check and trust tokens until they expire.
+"""
+import functools
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils.functional import SimpleLazyObject
+from rest_framework_simplejwt import serializers, tokens
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from .cache import TTLCache
+
+USERNAME_CLAIM = 'username'
+
+# user id -> is_active
+user_active = TTLCache(settings.AUTH_USER_CACHE_SIZE, settings.AUTH_USER_ACTIVE_TTL or 0)
+
+
+class RefreshToken(tokens.RefreshToken):
+    """Refresh token that also carries the username, which its access tokens copy"""
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        token[USERNAME_CLAIM] = user.username
+        return token
+
+
+class TokenObtainPairSerializer(serializers.TokenObtainPairSerializer):
+    token_class = RefreshToken
+
+
+def load_user(user_id):
+    try:
+        return User.objects.get(pk=user_id)
+    except User.DoesNotExist:
+        raise AuthenticationFailed('User not found', code='user_not_found')
+
+
+class TokenUser(SimpleLazyObject):
+    """
+    request.user for a JWT request. id, pk and username are read from the token;
+    anything else (including comparisons, isinstance() and ORM use) loads the User.
+    """
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, user_id, username=None):
+        super().__init__(functools.partial(load_user, user_id))
+        self.__dict__['id'] = self.__dict__['pk'] = user_id
+        if username is not None:
+            self.__dict__['username'] = username
+
+    def __bool__(self):
+        # Permission checks test `request.user and ...`
+        return True
+
+    def set_user(self, user):
+        """Use an already loaded User, so it is not fetched again"""
+        self._wrapped = user
+
+
+def token_principal(validated_token):
+    """A TokenUser for the token, or InvalidToken if it names no user"""
+    try:
+        user_id = User._meta.pk.to_python(validated_token[api_settings.USER_ID_CLAIM])
+    except KeyError:
+        raise InvalidToken('Token contained no recognizable user identification')
+    return TokenUser(user_id, validated_token.get(USERNAME_CLAIM))
+
+
+def checks_active():
+    return api_settings.CHECK_USER_IS_ACTIVE and settings.AUTH_USER_ACTIVE_TTL is not None
+
+
+def loaded(user, row):
+    """Fill in `user` with its freshly loaded `row`; returns whether the user is active"""
+    user.set_user(row)
+    user_active.set(user.id, row.is_active)
+    return row.is_active
+
+
+def refuse_inactive(is_active):
+    if not is_active:
+        raise AuthenticationFailed('User is inactive', code='user_inactive')
+
+
+class JWTTokenUserAuthentication(JWTAuthentication):
+    """JWTAuthentication that sets request.user to a TokenUser instead of querying the User"""
+
+    def get_user(self, validated_token):
+        user = token_principal(validated_token)
+        if checks_active():
+            is_active = user_active.get(user.id)
+            if is_active is None:
+                is_active = loaded(user, load_user(user.id))
+            refuse_inactive(is_active)
+        return user
+
+
+async def aget_user(validated_token):
+    """
+    JWTTokenUserAuthentication.get_user for async views, where a lazy load would
+    be a synchronous query: the User is loaded up front whenever the token or the
+    cache cannot answer for it.
+    """
+    user = token_principal(validated_token)
+    is_active = user_active.get(user.id) if checks_active() else True
+    if is_active is None or 'username' not in user.__dict__:
+        row = await User.objects.filter(pk=user.id).afirst()
+        if row is None:
+            raise AuthenticationFailed('User not found', code='user_not_found')
+        is_active = loaded(user, row)
+    if checks_active():
+        refuse_inactive(is_active)
+    return user
@@ -0,0 +1,256 @@
+"""
+Read-through caches in front of PostgreSQL.
+
+Friend graph: each user's friend ids are kept in a Redis set, friends:{user_id},
+loaded from the Friend table on first use. On top of that every worker keeps the
+sets it has read in a small in-process LRU with a short TTL, so in steady state
+the "are these two friends?" check on the send path needs neither Postgres nor
+Redis.
+
+The API only ever creates friendships, so a cached "no" is the one that
+usually goes stale (the friendship may have just been made on another worker):
+a miss is always confirmed against Redis and then the database before the
+caller is refused. AddFriendView and AcceptFriendRequestView drop the cached
+sets of both users once the new rows are committed, and so does deleting a
+Friend row, directly or with either user (see install()). The LRUs of other
+workers keep theirs until the TTL, so friend counts are read from Redis instead.
+
+Key directory: each user's identity and signing keys are kept as JSON in
+userkeys:{username} (usernames never change). UploadKeysView writes the new
+keys through once committed; a reader filling the cache after a miss only sets
+the key if it is still absent, so it cannot overwrite a newer upload with the
+row it read before it. Deleting a user or their keys drops the entry (see
+install()). One-time keys are never cached: each is handed out once.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete
+
+from .models import Friend, UserKeys
+from .redis_client import async_redis_client, redis_client
+
+# Always stored in the Redis set: marks it as loaded even when the user has no
+# friends yet. 0 is never a user id.
+LOADED_MARKER = '0'
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire `ttl` seconds after being set"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_friends = TTLCache(settings.FRIEND_CACHE_LOCAL_SIZE, settings.FRIEND_CACHE_LOCAL_TTL)
+
+
+def friends_key(user_id):
+    return f"friends:{user_id}"
+
+
+def get_friend_ids(user_id):
+    """The set of ids `user_id` has added as friends"""
+    user_id = int(user_id)
+    friend_ids = local_friends.get(user_id)
+    if friend_ids is None:
+        friend_ids = _load_friend_ids(user_id)
+        local_friends.set(user_id, friend_ids)
+    return friend_ids
+
+
+def _load_friend_ids(user_id):
+    key = friends_key(user_id)
+    members = redis_client.smembers(key)
+    if members:
+        return frozenset(int(member) for member in members if member.decode() != LOADED_MARKER)
+
+    friend_ids = frozenset(Friend.objects.filter(user_id=user_id).values_list('friend_id', flat=True))
+    pipe = redis_client.pipeline()
+    pipe.sadd(key, LOADED_MARKER, *friend_ids)
+    pipe.expire(key, settings.FRIEND_CACHE_TTL)
+    pipe.execute()
+    return friend_ids
+
+
+def friends_among(user_id, other_user_ids):
+    """The subset of `other_user_ids` that `user_id` has added as friends"""
+    user_id = int(user_id)
+    wanted = {int(other_user_id) for other_user_id in other_user_ids}
+    found = wanted & get_friend_ids(user_id)
+    if found == wanted:
+        return found
+
+    # Possibly stale "no": re-read Redis, then fall back to one database query
+    local_friends.delete(user_id)
+    found = wanted & get_friend_ids(user_id)
+    missing = wanted - found
+    if missing:
+        confirmed = set(
+            Friend.objects.filter(user_id=user_id, friend_id__in=missing).values_list('friend_id', flat=True)
+        )
+        if confirmed:
+            invalidate_friends(user_id)
+            found |= confirmed
+    return found
+
+
+def is_friend(user_id, other_user_id):
+    """Whether `user_id` has added `other_user_id` as a friend"""
+    return bool(friends_among(user_id, [other_user_id]))
+
+
+async def ais_friend(user_id, other_user_id):
+    """is_friend for async views: no I/O on a local hit, otherwise run in a worker thread"""
+    friend_ids = local_friends.get(int(user_id))
+    if friend_ids is not None and int(other_user_id) in friend_ids:
+        return True
+    return await sync_to_async(is_friend)(user_id, other_user_id)
+
+
+def friend_count(user_id):
+    """
+    How many friends `user_id` has, from the Redis set rather than the local LRU:
+    invalidate_friends() only reaches the LRU of the worker that ran it, so
+    another worker's copy can lag a new friendship by up to FRIEND_CACHE_LOCAL_TTL.
+    """
+    user_id = int(user_id)
+    count = redis_client.scard(friends_key(user_id))
+    if count:
+        return count - 1  # LOADED_MARKER
+    friend_ids = _load_friend_ids(user_id)
+    local_friends.set(user_id, friend_ids)
+    return len(friend_ids)
+
+
+def invalidate_friends(*user_ids):
+    """
+    Drop the cached friend sets of `user_ids` once the current transaction
+    commits: in Redis, and in this worker's LRU (the others expire theirs)
+    """
+    def invalidate():
+        redis_client.delete(*(friends_key(user_id) for user_id in user_ids))
+        for user_id in user_ids:
+            local_friends.delete(int(user_id))
+
+    transaction.on_commit(invalidate)
+
+
+def identity_keys_key(username):
+    return f"userkeys:{username}"
+
+
+def identity_keys_entry(user_keys):
+    """The cached form of a UserKeys row; `version` changes with every upload"""
+    return {
+        'user_id': user_keys.user_id,
+        'identity_key': user_keys.identity_key,
+        'signing_key': user_keys.signing_key,
+        'version': f'{user_keys.user_id}-{int(user_keys.updated_at.timestamp() * 1_000_000)}',
+    }
+
+
+def get_identity_keys(username):
+    """The identity_keys_entry of `username`, or None if they do not exist or have not uploaded keys"""
+    key = identity_keys_key(username)
+    cached = redis_client.get(key)
+    if cached is not None:
+        return json.loads(cached)
+
+    user_keys = UserKeys.objects.filter(user__username=username).first()
+    if user_keys is None:
+        return None
+    entry = identity_keys_entry(user_keys)
+    redis_client.set(key, json.dumps(entry), ex=settings.KEY_DIRECTORY_CACHE_TTL, nx=True)
+    return entry
+
+
+async def aget_identity_keys(username):
+    """get_identity_keys for async views, through the asyncio client and the async ORM"""
+    key = identity_keys_key(username)
+    cached = await async_redis_client.get(key)
+    if cached is not None:
+        return json.loads(cached)
+
+    user_keys = await UserKeys.objects.filter(user__username=username).afirst()
+    if user_keys is None:
+        return None
+    entry = identity_keys_entry(user_keys)
+    await async_redis_client.set(key, json.dumps(entry), ex=settings.KEY_DIRECTORY_CACHE_TTL, nx=True)
+    return entry
+
+
+def invalidate_identity_keys(*usernames):
+    """Drop the cached keys of `usernames` once the current transaction commits"""
+    transaction.on_commit(lambda: redis_client.delete(*(identity_keys_key(username) for username in usernames)))
+
+
+def _user_deleted(sender, instance, **kwargs):
+    invalidate_identity_keys(instance.username)
+
+
+def _friend_deleted(sender, instance, **kwargs):
+    invalidate_friends(instance.user_id, instance.friend_id)
+
+
+def _user_keys_deleted(sender, instance, **kwargs):
+    # When the user itself is being deleted it may be gone already; _user_deleted covers that
+    username = User.objects.filter(pk=instance.user_id).values_list('username', flat=True).first()
+    if username is not None:
+        invalidate_identity_keys(username)
+
+
+def install():
+    """
+    Drop a user's cached keys when the user or their keys are deleted, so a
+    username that is deleted and signed up again never gets the old keys, and
+    both users' friend sets when a friendship goes (deleting a user cascades to
+    their Friend rows), so nobody can still send to a deleted friend.
+    """
+    post_delete.connect(_user_deleted, sender=User, dispatch_uid='chat.cache.user')
+    post_delete.connect(_friend_deleted, sender=Friend, dispatch_uid='chat.cache.friend')
+    post_delete.connect(_user_keys_deleted, sender=UserKeys, dispatch_uid='chat.cache.user_keys')
+
+
+def store_identity_keys(username, user_keys):
+    """Write `username`'s just-uploaded keys through to the cache once the current transaction commits"""
+    entry = json.dumps(identity_keys_entry(user_keys))
+    transaction.on_commit(
+        lambda: redis_client.set(identity_keys_key(username), entry, ex=settings.KEY_DIRECTORY_CACHE_TTL)
+    )
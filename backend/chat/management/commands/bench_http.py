@@ -0,0 +1,148 @@
+import asyncio
+import json
+import statistics
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from chat.authentication import RefreshToken
+from chat.models import Friend
+from chat.redis_util import cleanup_all_temp_messages
+
+USERNAME_PREFIX = 'bench-http-'
+
+
+class HTTPConnection:
+    """A minimal keep-alive HTTP/1.1 client, so the load generator is not the bottleneck"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, token, body=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        payload = json.dumps(body).encode() if body is not None else b''
+        head = (
+            f"{method} {path} HTTP/1.1\r\n"
+            f"Host: {self.host}\r\n"
+            f"Authorization: Bearer {token}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n\r\n"
+        )
+        self.writer.write(head.encode() + payload)
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while (line := await self.reader.readline()) not in (b'\r\n', b''):
+            name, _, value = line.decode().partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding') == 'chunked':
+            while size := int((await self.reader.readline()).strip(), 16):
+                await self.reader.readexactly(size + 2)
+            await self.reader.readline()
+        else:
+            await self.reader.readexactly(int(headers.get('content-length', 0)))
+        if headers.get('connection') == 'close':
+            self.close()
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = self.reader = None
+
+
+class Command(BaseCommand):
+    help = (
+        'Load test the messaging hot path over HTTP against a running server and report '
+        'throughput and latency. Run it once against the sync views under WSGI and once '
+        'against the async views under ASGI on the same machine, e.g.\n'
+        '  gunicorn backend.wsgi -w 1 --threads 32 -b :8000; bench_http --api /api/\n'
+        '  uvicorn backend.asgi:application --workers 1 --port 8000; bench_http --api /api/async/\n'
+        'It creates scratch users (bench-http-*) and removes them afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Server to load')
+        parser.add_argument('--api', default='/api/', help='/api/ for the sync views, /api/async/ for the async ones')
+        parser.add_argument('--concurrency', type=int, default=100, help='Requests in flight at once')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds to run for')
+        parser.add_argument('--users', type=int, default=20, help='Scratch users, paired up as friends')
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        users = self.create_users(options['users'])
+        try:
+            tokens = {user.id: str(RefreshToken.for_user(user).access_token) for user in users}
+            results = asyncio.run(self.load(url.hostname, url.port or 80, options, users, tokens))
+        finally:
+            self.delete_users(users)
+        self.report(results, options)
+
+    def create_users(self, count):
+        self.delete_users(User.objects.filter(username__startswith=USERNAME_PREFIX))
+        User.objects.bulk_create(User(username=f'{USERNAME_PREFIX}{i}') for i in range(count + count % 2))
+        users = list(User.objects.filter(username__startswith=USERNAME_PREFIX).order_by('id'))
+        pairs = list(zip(users[::2], users[1::2]))
+        Friend.objects.bulk_create(
+            [Friend(user=a, friend=b) for a, b in pairs] + [Friend(user=b, friend=a) for a, b in pairs]
+        )
+        return users
+
+    def delete_users(self, users):
+        users = list(users)
+        for a, b in zip(users[::2], users[1::2]):
+            cleanup_all_temp_messages(a.id, b.id)
+            cleanup_all_temp_messages(b.id, a.id)
+        User.objects.filter(id__in=[user.id for user in users]).delete()
+
+    async def load(self, host, port, options, users, tokens):
+        api = options['api']
+        partners = {}
+        for a, b in zip(users[::2], users[1::2]):
+            partners[a.id], partners[b.id] = b.id, a.id
+        deadline = time.perf_counter() + options['duration']
+        latencies = defaultdict(list)
+        statuses = defaultdict(lambda: defaultdict(int))
+
+        async def client(worker):
+            connection = HTTPConnection(host, port)
+            user = users[worker % len(users)]
+            token, partner = tokens[user.id], partners[user.id]
+            try:
+                while time.perf_counter() < deadline:
+                    # A chat client alternates sending and polling
+                    for name, method, path, body in (
+                        ('send-message', 'POST', f'{api}send-message/', {'receiver_id': partner, 'content': 'x' * 200}),
+                        ('get-messages', 'GET', f'{api}get-messages/?user_id={partner}&limit=50', None),
+                    ):
+                        started = time.perf_counter()
+                        status = await connection.request(method, path, token, body)
+                        latencies[name].append(time.perf_counter() - started)
+                        statuses[name][status] += 1
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client(worker) for worker in range(options['concurrency'])))
+        return latencies, statuses, time.perf_counter() - started
+
+    def report(self, results, options):
+        latencies, statuses, elapsed = results
+        self.stdout.write(
+            f"{options['url']}{options['api']}  concurrency {options['concurrency']}  {elapsed:.1f}s"
+        )
+        self.stdout.write(f"{'endpoint':<16}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}  statuses")
+        for name, timings in latencies.items():
+            timings.sort()
+            p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+            self.stdout.write(
+                f"{name:<16}{len(timings):>10}{len(timings) / elapsed:>10.0f}"
+                f"{statistics.median(timings) * 1000:>10.1f}{p99 * 1000:>10.1f}  {dict(statuses[name])}"
+            )
@@ -0,0 +1,124 @@
+import json
+import statistics
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat import redis_util
+from chat.redis_client import redis_client
+
+# Scratch user ids, far above anything a dev database hands out
+SENDER_ID = 900000001
+RECEIVER_ID = 900000002
+
+
+@contextmanager
+def count_round_trips():
+    """Count requests written to Redis (a pipeline or script call is one)"""
+    connection_class = redis_client.connection_pool.connection_class
+    original = connection_class.send_packed_command
+    counter = {'round_trips': 0}
+
+    def send_packed_command(self, *args, **kwargs):
+        counter['round_trips'] += 1
+        return original(self, *args, **kwargs)
+
+    connection_class.send_packed_command = send_packed_command
+    try:
+        yield counter
+    finally:
+        connection_class.send_packed_command = original
+
+
+# The original per-command implementation, kept here as the baseline
+
+def legacy_send(content, ttl=604800):
+    key = f"chat:{SENDER_ID}:{RECEIVER_ID}"
+    message = {
+        "sender_id": SENDER_ID,
+        "receiver_id": RECEIVER_ID,
+        "content": content,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+    }
+    redis_client.rpush(key, json.dumps(message))
+    redis_client.expire(key, ttl)
+    redis_client.publish(redis_util.events_channel(RECEIVER_ID), json.dumps({"type": "message", "message": message}))
+
+
+def legacy_fetch():
+    received = [json.loads(m) for m in redis_client.lrange(f"chat:{SENDER_ID}:{RECEIVER_ID}", 0, -1)]
+    sent = [json.loads(m) for m in redis_client.lrange(f"chat:{RECEIVER_ID}:{SENDER_ID}", 0, -1)]
+    return received, sent
+
+
+def legacy_remove(content):
+    key = f"chat:{SENDER_ID}:{RECEIVER_ID}"
+    for msg in redis_client.lrange(key, 0, -1):
+        if json.loads(msg)["content"] == content:
+            redis_client.lrem(key, 1, msg)
+            break
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare round trips and latency of the scripted ephemeral message store '
+        'against the original per-command implementation. Run against a local '
+        'redis-server; it only touches scratch keys and removes them afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000, help='Messages sent per implementation')
+        parser.add_argument('--fetches', type=int, default=200, help='Conversation fetches per implementation')
+        parser.add_argument('--removes', type=int, default=100, help='Single-message removals per implementation')
+
+    def handle(self, *args, **options):
+        self.cleanup()
+        redis_util.load_scripts()
+        self.stdout.write(f"Backend: {settings.CHAT_EPHEMERAL_BACKEND}, messages: {options['messages']}")
+        self.stdout.write(f"{'operation':<28}{'round trips/op':>16}{'p50 us':>10}{'p99 us':>10}")
+
+        try:
+            contents = [f"bench-{i}" for i in range(options['messages'])]
+            self.run('legacy send', legacy_send, [(c,) for c in contents])
+            self.run('legacy fetch (both ways)', legacy_fetch, [()] * options['fetches'])
+            self.run('legacy remove', legacy_remove, [(c,) for c in contents[-options['removes']:]])
+            self.cleanup()
+
+            sent = []
+            self.run('scripted send', lambda c: sent.append(
+                redis_util.save_temp_message(SENDER_ID, RECEIVER_ID, c)), [(c,) for c in contents])
+            self.run('scripted fetch (both ways)', redis_util.get_conversation_messages,
+                     [(RECEIVER_ID, SENDER_ID)] * options['fetches'])
+            self.run('scripted remove by id', lambda i: redis_util.remove_temp_message(
+                SENDER_ID, RECEIVER_ID, message_id=i), [(m['id'],) for m in sent[-options['removes']:]])
+        finally:
+            self.cleanup()
+
+    def run(self, label, operation, calls):
+        timings = []
+        with count_round_trips() as counter:
+            for call_args in calls:
+                started = time.perf_counter()
+                operation(*call_args)
+                timings.append((time.perf_counter() - started) * 1e6)
+        if not calls:
+            return
+        timings.sort()
+        p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+        self.stdout.write(
+            f"{label:<28}{counter['round_trips'] / len(calls):>16.2f}"
+            f"{statistics.median(timings):>10.0f}{p99:>10.0f}"
+        )
+
+    def cleanup(self):
+        redis_client.delete(
+            f"chat:{SENDER_ID}:{RECEIVER_ID}",
+            f"chat:{RECEIVER_ID}:{SENDER_ID}",
+            redis_util.sequence_key(SENDER_ID, RECEIVER_ID),
+            redis_util.size_key(SENDER_ID, RECEIVER_ID),
+            redis_util.inbox_key(RECEIVER_ID),
+            redis_util.unread_key(RECEIVER_ID),
+        )
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.models import OneTimeKeys
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete one-time keys that have already been claimed. They are never read '
+        'again, and left in place they only grow the table. Run once (e.g. from cron) '
+        'or keep running with --interval.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows deleted per transaction')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Seconds between collections; 0 collects once and exits')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            deleted = OneTimeKeys.objects.delete_used(options['batch_size'])
+            self.stdout.write(
+                f"Reclaimed {deleted} used one-time keys in {time.perf_counter() - started:.2f}s"
+            )
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
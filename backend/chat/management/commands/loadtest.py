@@ -0,0 +1,250 @@
+import json
+import random
+import statistics
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from chat.authentication import RefreshToken
+from chat.cache import friends_key, identity_keys_key
+from chat.models import Friend, OneTimeKeys, Profile, UserKeys
+from chat.redis_client import redis_client
+from chat.redis_util import cleanup_all_temp_messages, inbox_key, sequence_key, unread_key
+
+USERNAME_PREFIX = 'loadtest-'
+
+# Latency percentiles reported, and compared against a baseline
+PERCENTILES = (50, 95, 99)
+
+# Options that shape the workload; a baseline only compares against the same workload
+WORKLOAD_OPTIONS = ('users', 'friends', 'rounds', 'concurrency', 'seed')
+
+
+class RedisRoundTrips:
+    """Counts requests written to Redis by the current thread (a pipeline or script call is one)"""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def __enter__(self):
+        connection_class = redis_client.connection_pool.connection_class
+        self.original = original = connection_class.send_packed_command
+        local = self.local
+
+        def send_packed_command(conn, *args, **kwargs):
+            local.count = getattr(local, 'count', 0) + 1
+            return original(conn, *args, **kwargs)
+
+        connection_class.send_packed_command = send_packed_command
+        return self
+
+    def __exit__(self, *exc_info):
+        redis_client.connection_pool.connection_class.send_packed_command = self.original
+
+    def take(self):
+        count = getattr(self.local, 'count', 0)
+        self.local.count = 0
+        return count
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulate users chatting through the API in-process and report, per endpoint, '
+        'throughput, p50/p95/p99 latency and SQL queries and Redis round trips per '
+        'request. Runs against the configured PostgreSQL and Redis (local containers '
+        'or stand-ins); it creates scratch users (loadtest-*) and removes them '
+        'afterwards. Save a baseline with --output and check a change against it '
+        'with --baseline.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50, help='Simulated users')
+        parser.add_argument('--friends', type=int, default=10, help='Friends per user')
+        parser.add_argument('--rounds', type=int, default=20, help='Rounds of activity per user')
+        parser.add_argument('--concurrency', type=int, default=1, help='Users acting at the same time (threads)')
+        parser.add_argument('--seed', type=int, default=1, help='Random seed, so runs are comparable')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='Compare against a JSON file written by --output')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed p95 latency increase over the baseline, as a fraction')
+
+    def handle(self, *args, **options):
+        if options['friends'] >= options['users']:
+            raise CommandError('--friends must be lower than --users')
+
+        users = self.create_users(options['users'], options['friends'], options['rounds'])
+        try:
+            samples, elapsed = self.run(users, options)
+        finally:
+            self.delete_users(users)
+
+        results = self.summarise(samples, elapsed)
+        self.report(results, elapsed)
+        workload = {name: options[name] for name in WORKLOAD_OPTIONS}
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'options': workload, 'endpoints': results}, f, indent=2)
+            self.stdout.write(f"Wrote {options['output']}")
+        if options['baseline']:
+            self.compare(results, workload, options['baseline'], options['tolerance'])
+
+    # ---- Setup ----
+
+    def create_users(self, count, friends, rounds):
+        self.delete_users(User.objects.filter(username__startswith=USERNAME_PREFIX))
+        User.objects.bulk_create(User(username=f'{USERNAME_PREFIX}{i}') for i in range(count))
+        users = list(User.objects.filter(username__startswith=USERNAME_PREFIX).order_by('id'))
+        Profile.objects.bulk_create(Profile(user=user, user_name=f'{user.username}-name') for user in users)
+        # Everyone befriends the next `friends` users round a ring, in both directions
+        pairs = {(users[i].id, users[(i + k) % count].id) for i in range(count) for k in range(1, friends + 1)}
+        pairs |= {(b, a) for a, b in pairs}
+        Friend.objects.bulk_create(Friend(user_id=a, friend_id=b) for a, b in pairs)
+        UserKeys.objects.bulk_create(UserKeys(user=user, identity_key='identity', signing_key='signing') for user in users)
+        # Each friend may claim one of a user's keys every round, so the pool can
+        # never run dry (an empty pool answers keys/query with a 400)
+        friend_counts = defaultdict(int)
+        for a, _ in pairs:
+            friend_counts[a] += 1
+        OneTimeKeys.objects.bulk_create(
+            OneTimeKeys(user=user, key_id=f'key{i}', key_value='value')
+            for user in users for i in range(rounds * friend_counts[user.id])
+        )
+        return users
+
+    def delete_users(self, users):
+        ids = [user.id for user in users]
+        for a, b in Friend.objects.filter(user_id__in=ids).values_list('user_id', 'friend_id'):
+            cleanup_all_temp_messages(a, b)
+            redis_client.delete(sequence_key(a, b))
+        if ids:
+            redis_client.delete(
+                *(key(user_id) for user_id in ids for key in (inbox_key, unread_key, friends_key)),
+                *(identity_keys_key(user.username) for user in users),
+            )
+        User.objects.filter(id__in=ids).delete()
+
+    # ---- Load ----
+
+    def run(self, users, options):
+        friends = defaultdict(list)
+        for a, b in Friend.objects.filter(user__in=users).values_list('user_id', 'friend_id'):
+            friends[a].append(b)
+        usernames = {user.id: user.username for user in users}
+        samples = defaultdict(list)  # endpoint -> [(seconds, sql queries, redis round trips)]
+        lock = threading.Lock()
+
+        def act(user, round_trips):
+            rng = random.Random(options['seed'] * 100003 + user.id)
+            client = APIClient(HTTP_HOST='localhost')
+            client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(user).access_token}')
+            local = defaultdict(list)
+
+            def call(name, method, path, data=None):
+                round_trips.take()
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    response = getattr(client, method)(path, data, format='json' if method == 'post' else None)
+                    seconds = time.perf_counter() - started
+                local[name].append((seconds, len(queries), round_trips.take()))
+                if response.status_code >= 400:
+                    raise CommandError(f'{name} returned {response.status_code}: {response.content[:200]}')
+                return response
+
+            call('sync', 'post', '/api/sync/', {})
+            for _ in range(options['rounds']):
+                friend = rng.choice(friends[user.id])
+                call('send-message', 'post', '/api/send-message/', {'receiver_id': friend, 'content': 'x' * 200})
+                received = call('get-messages', 'get', '/api/get-messages/', {'user_id': friend, 'limit': 50})
+                call('unread', 'get', '/api/unread/')
+                incoming = [m for m in received.data['messages'] if m['source'] == 'redis' and m['sender_id'] == friend]
+                if incoming and rng.random() < 0.3:
+                    message = incoming[-1]
+                    call('save-to-vault', 'post', '/api/save-to-vault/', {
+                        'other_user_id': friend, 'content': message['content'], 'message_id': message['id'],
+                    })
+                if rng.random() < 0.2:
+                    call('keys/query', 'get', f'/api/keys/query/{usernames[friend]}/')
+                if rng.random() < 0.1:
+                    call('list-vault', 'get', '/api/list-vault/')
+            with lock:
+                for name, values in local.items():
+                    samples[name].extend(values)
+
+        def act_and_close(user, round_trips):
+            try:
+                act(user, round_trips)
+            finally:
+                if options['concurrency'] > 1:
+                    connection.close()
+
+        started = time.perf_counter()
+        with RedisRoundTrips() as round_trips:
+            if options['concurrency'] > 1:
+                with ThreadPoolExecutor(options['concurrency']) as pool:
+                    for future in [pool.submit(act_and_close, user, round_trips) for user in users]:
+                        future.result()
+            else:
+                for user in users:
+                    act(user, round_trips)
+        return samples, time.perf_counter() - started
+
+    # ---- Results ----
+
+    def summarise(self, samples, elapsed):
+        results = {}
+        for name, values in sorted(samples.items()):
+            timings = sorted(seconds for seconds, _, _ in values)
+            results[name] = {
+                'requests': len(values),
+                'throughput': len(values) / elapsed,
+                **{f'p{p}_ms': percentile(timings, p) * 1000 for p in PERCENTILES},
+                'sql_queries': statistics.mean(queries for _, queries, _ in values),
+                'redis_round_trips': statistics.mean(trips for _, _, trips in values),
+            }
+        return results
+
+    def report(self, results, elapsed):
+        self.stdout.write(f"{sum(r['requests'] for r in results.values())} requests in {elapsed:.1f}s")
+        self.stdout.write(
+            f"{'endpoint':<16}{'requests':>9}{'req/s':>8}"
+            + ''.join(f"{f'p{p} ms':>9}" for p in PERCENTILES)
+            + f"{'sql/req':>9}{'redis/req':>11}"
+        )
+        for name, r in results.items():
+            self.stdout.write(
+                f"{name:<16}{r['requests']:>9}{r['throughput']:>8.0f}"
+                + ''.join(f"{r[f'p{p}_ms']:>9.1f}" for p in PERCENTILES)
+                + f"{r['sql_queries']:>9.1f}{r['redis_round_trips']:>11.1f}"
+            )
+
+    def compare(self, results, workload, path, tolerance):
+        with open(path) as f:
+            baseline = json.load(f)
+        if baseline['options'] != workload:
+            raise CommandError(f"{path} was recorded with {baseline['options']}; rerun with the same options")
+        baseline = baseline['endpoints']
+        regressions = []
+        for name, r in results.items():
+            before = baseline.get(name)
+            if before is None:
+                continue
+            # Query counts are deterministic for a given seed, so any increase is a regression
+            for metric in ('sql_queries', 'redis_round_trips'):
+                if r[metric] > before[metric] + 0.05:
+                    regressions.append(f"{name}: {metric} {before[metric]:.1f} -> {r[metric]:.1f}")
+            if r['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+                regressions.append(f"{name}: p95 {before['p95_ms']:.1f}ms -> {r['p95_ms']:.1f}ms")
+        if regressions:
+            raise CommandError('Regressions against %s:\n  %s' % (path, '\n  '.join(regressions)))
+        self.stdout.write(f'No regressions against {path}')
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
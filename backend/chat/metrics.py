@@ -0,0 +1,389 @@
+"""
+Per-endpoint request metrics, exposed in the Prometheus text format at /metrics.
+
+MetricsMiddleware times every request and counts it by route, method and status.
+For a sampled share of requests (METRICS_SAMPLE_RATE) it also records what the
+request spent on the database and on Redis: a database execute wrapper and an
+instrumented Redis connection class (installed by install() from
+ChatConfig.ready()) add each query and each Redis command to the current
+request's RequestStats. Outside a sampled request they cost one ContextVar
+lookup. With METRICS_SERVER_TIMING on, sampled responses carry the breakdown
+in a Server-Timing header for the browser's network panel.
+
+Counters are kept in memory per worker and added to one Redis hash every
+METRICS_FLUSH_INTERVAL seconds with a single pipeline, so /metrics reports the
+totals of all workers whichever one serves the scrape. The flush runs in a
+background thread on a client of its own, with a METRICS_FLUSH_TIMEOUT socket
+timeout and no retries, so no request waits on it. /metrics is for staff users,
+or for scrapers sending METRICS_TOKEN.
+"""
+import functools
+import json
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+
+import redis
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+
+from .redis_client import async_redis_client, redis_client
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY = 'metrics'
+
+
+@functools.cache
+def flush_client():
+    """
+    The client flushes go through, made on the first flush. Not instrumented,
+    and gives up quickly: losing one interval's counts beats holding a
+    connection (and the shared pool's retries) while Redis is slow.
+    """
+    return redis.StrictRedis.from_url(
+        settings.REDIS_URL,
+        socket_timeout=settings.METRICS_FLUSH_TIMEOUT,
+        socket_connect_timeout=settings.METRICS_FLUSH_TIMEOUT,
+        retry=Retry(NoBackoff(), 0),
+    )
+
+
+# Upper bounds (seconds) of the request duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name: (type, help)
+FAMILIES = {
+    'chat_http_requests_total': ('counter', 'Requests by route, method and status'),
+    'chat_http_request_duration_seconds': ('histogram', 'Request wall time'),
+    'chat_http_response_bytes_total': ('counter', 'Response body bytes'),
+    'chat_http_sampled_requests_total': ('counter', 'Requests whose database and Redis use was recorded'),
+    'chat_http_sql_queries_total': ('counter', 'SQL queries run by sampled requests'),
+    'chat_http_sql_seconds_total': ('counter', 'Time sampled requests spent in SQL queries'),
+    'chat_http_redis_commands_total': ('counter', 'Redis commands sent by sampled requests'),
+    'chat_http_redis_seconds_total': ('counter', 'Time sampled requests spent waiting on Redis'),
+    'chat_http_redis_bytes_total': ('counter', 'Bytes sampled requests sent to Redis'),
+    'chat_ephemeral_trimmed_messages_total': (
+        'counter', 'Oldest ephemeral messages dropped to keep a conversation within its caps'
+    ),
+}
+
+
+class RequestStats:
+    """Database and Redis use of one sampled request"""
+
+    __slots__ = ('sql_queries', 'sql_seconds', 'redis_commands', 'redis_seconds', 'redis_bytes')
+
+    def __init__(self):
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.redis_commands = 0
+        self.redis_seconds = 0.0
+        self.redis_bytes = 0
+
+
+# The RequestStats of the sampled request being served, if any. Context variables
+# follow the request into sync_to_async threads and across awaits.
+current_stats = ContextVar('current_stats', default=None)
+
+
+class Registry:
+    """Counters accumulated in this process, added to the shared Redis hash on flush()"""
+
+    def __init__(self):
+        self._counts = defaultdict(float)
+        self._lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+        self._flushing = False
+
+    def increment(self, name, labels, value=1):
+        """Add `value` to the sample `name` with `labels` (a dict)"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counts[key] += value
+
+    def observe_request(self, route, method, status, seconds, response_bytes, stats):
+        labels = {'route': route, 'method': method}
+
+        def key(name, extra=None):
+            return (name, tuple(sorted({**labels, **(extra or {})}.items())))
+
+        with self._lock:
+            counts = self._counts
+            counts[key('chat_http_requests_total', {'status': str(status)})] += 1
+            counts[key('chat_http_request_duration_seconds_count')] += 1
+            counts[key('chat_http_request_duration_seconds_sum')] += seconds
+            for bound in DURATION_BUCKETS:
+                if seconds <= bound:
+                    counts[key('chat_http_request_duration_seconds_bucket', {'le': str(bound)})] += 1
+            counts[key('chat_http_request_duration_seconds_bucket', {'le': '+Inf'})] += 1
+            counts[key('chat_http_response_bytes_total')] += response_bytes
+            if stats is not None:
+                counts[key('chat_http_sampled_requests_total')] += 1
+                counts[key('chat_http_sql_queries_total')] += stats.sql_queries
+                counts[key('chat_http_sql_seconds_total')] += stats.sql_seconds
+                counts[key('chat_http_redis_commands_total')] += stats.redis_commands
+                counts[key('chat_http_redis_seconds_total')] += stats.redis_seconds
+                counts[key('chat_http_redis_bytes_total')] += stats.redis_bytes
+            return time.monotonic() - self._flushed_at >= settings.METRICS_FLUSH_INTERVAL
+
+    def flush(self):
+        """Add the counts gathered since the last flush to Redis, in one round trip"""
+        with self._lock:
+            counts, self._counts = self._counts, defaultdict(float)
+            self._flushed_at = time.monotonic()
+        if not counts:
+            return
+        pipe = flush_client().pipeline(transaction=False)
+        for key, value in counts.items():
+            pipe.hincrbyfloat(METRICS_KEY, json.dumps(key), value)
+        try:
+            pipe.execute()
+        except redis.RedisError as error:
+            # Metrics must never fail a request: drop this interval's counts
+            logger.warning('Could not flush %d metric samples to Redis: %s', len(counts), error)
+
+    def flush_in_background(self):
+        """flush() in a daemon thread, unless one is still running"""
+        with self._lock:
+            if self._flushing:
+                return
+            self._flushing = True
+        threading.Thread(target=self._background_flush, name='metrics-flush', daemon=True).start()
+
+    def _background_flush(self):
+        try:
+            self.flush()
+        finally:
+            self._flushing = False
+
+
+registry = Registry()
+
+
+def increment(name, labels, value=1):
+    """Count an event that is not a request counter; flushed along with the request counters"""
+    registry.increment(name, labels, value)
+
+
+# ============ INSTRUMENTATION ============
+
+def _record_query(execute, sql, params, many, context):
+    stats = current_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.sql_seconds += time.perf_counter() - started
+        stats.sql_queries += 1
+
+
+def _add_execute_wrapper(sender, connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+def _command_bytes(command):
+    # A packed command is either one buffer or a list of them
+    if isinstance(command, (bytes, str, memoryview)):
+        return len(command)
+    return sum(len(chunk) for chunk in command)
+
+
+def _instrumented_connection_class(base):
+    """`base` recording each command's bytes and the time spent sending it and reading its reply"""
+    class InstrumentedConnection(base):
+        def send_packed_command(self, command, *args, **kwargs):
+            stats = current_stats.get()
+            if stats is None:
+                return super().send_packed_command(command, *args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return super().send_packed_command(command, *args, **kwargs)
+            finally:
+                stats.redis_seconds += time.perf_counter() - started
+                stats.redis_bytes += _command_bytes(command)
+
+        def read_response(self, *args, **kwargs):
+            stats = current_stats.get()
+            if stats is None:
+                return super().read_response(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return super().read_response(*args, **kwargs)
+            finally:
+                # One reply per command, including each command of a pipeline
+                stats.redis_seconds += time.perf_counter() - started
+                stats.redis_commands += 1
+
+    InstrumentedConnection.__name__ = f'Instrumented{base.__name__}'
+    return InstrumentedConnection
+
+
+def _instrumented_async_connection_class(base):
+    class InstrumentedConnection(base):
+        async def send_packed_command(self, command, *args, **kwargs):
+            stats = current_stats.get()
+            if stats is None:
+                return await super().send_packed_command(command, *args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return await super().send_packed_command(command, *args, **kwargs)
+            finally:
+                stats.redis_seconds += time.perf_counter() - started
+                stats.redis_bytes += _command_bytes(command)
+
+        async def read_response(self, *args, **kwargs):
+            stats = current_stats.get()
+            if stats is None:
+                return await super().read_response(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return await super().read_response(*args, **kwargs)
+            finally:
+                stats.redis_seconds += time.perf_counter() - started
+                stats.redis_commands += 1
+
+    InstrumentedConnection.__name__ = f'Instrumented{base.__name__}'
+    return InstrumentedConnection
+
+
+def install():
+    """Record database queries and Redis commands against the current sampled request"""
+    connection_created.connect(_add_execute_wrapper, dispatch_uid='chat.metrics')
+    pool = redis_client.connection_pool
+    if not pool.connection_class.__name__.startswith('Instrumented'):
+        # Connections created from now on; the pool creates them lazily
+        pool.connection_class = _instrumented_connection_class(pool.connection_class)
+    # The async clients are created per event loop, each with the wrapped class
+    async_redis_client.connection_class_wrapper = _instrumented_async_connection_class
+
+
+# ============ MIDDLEWARE ============
+
+class MetricsMiddleware:
+    """Record every request's wall time and status, and a sample of requests' database and Redis use"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats, token, started = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_stats.reset(token)
+        if self.finish(request, response, stats, started):
+            registry.flush_in_background()
+        return response
+
+    async def __acall__(self, request):
+        stats, token, started = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_stats.reset(token)
+        if self.finish(request, response, stats, started):
+            registry.flush_in_background()
+        return response
+
+    def start(self):
+        sampled = random.random() < settings.METRICS_SAMPLE_RATE
+        stats = RequestStats() if sampled else None
+        return stats, current_stats.set(stats), time.perf_counter()
+
+    def finish(self, request, response, stats, started):
+        """Record the request; reports whether the registry is due a flush"""
+        seconds = time.perf_counter() - started
+        match = request.resolver_match
+        route = match.route if match is not None else 'unmatched'
+        response_bytes = 0 if response.streaming else len(response.content)
+        if stats is not None and settings.METRICS_SERVER_TIMING:
+            response['Server-Timing'] = server_timing(seconds, stats)
+        return registry.observe_request(route, request.method, response.status_code, seconds, response_bytes, stats)
+
+
+def server_timing(seconds, stats):
+    return ', '.join((
+        f'db;dur={stats.sql_seconds * 1000:.1f};desc="{stats.sql_queries} queries"',
+        f'redis;dur={stats.redis_seconds * 1000:.1f};desc="{stats.redis_commands} commands"',
+        f'total;dur={seconds * 1000:.1f}',
+    ))
+
+
+# ============ EXPOSITION ============
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _family(name):
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in FAMILIES:
+            return name[:-len(suffix)]
+    return name
+
+
+def render(samples):
+    """The Prometheus text format for `samples`, a dict of (name, ((label, value), ...)) to value"""
+    def order(item):
+        (name, labels), _ = item
+        le = dict(labels).get('le')
+        return (
+            _family(name),
+            [pair for pair in labels if pair[0] != 'le'],
+            name,
+            float(le) if le is not None else 0.0,
+        )
+
+    lines = []
+    family = None
+    for (name, labels), value in sorted(samples.items(), key=order):
+        if _family(name) != family:
+            family = _family(name)
+            kind, description = FAMILIES.get(family, ('untyped', ''))
+            lines.append(f'# HELP {family} {description}')
+            lines.append(f'# TYPE {family} {kind}')
+        label_text = ','.join(f'{label}="{_escape(str(label_value))}"' for label, label_value in labels)
+        lines.append(f'{name}{{{label_text}}} {value!r}' if label_text else f'{name} {value!r}')
+    return '\n'.join(lines) + '\n'
+
+
+def collect():
+    """Every counter flushed to Redis so far, by all workers"""
+    registry.flush()
+    samples = {}
+    for field, value in redis_client.hgetall(METRICS_KEY).items():
+        name, labels = json.loads(field)
+        samples[(name, tuple(tuple(pair) for pair in labels))] = float(value)
+    return samples
+
+
+def metrics_view(request):
+    """
+    GET /metrics - Prometheus scrape endpoint.
+
+    Open to staff users (session login) and, when METRICS_TOKEN is set, to
+    scrapers sending "Authorization: Bearer <token>".
+    """
+    token_ok = settings.METRICS_TOKEN and request.headers.get('Authorization') == f'Bearer {settings.METRICS_TOKEN}'
+    if not token_ok and not request.user.is_staff:
+        return HttpResponse(status=401 if settings.METRICS_TOKEN else 403)
+    return HttpResponse(render(collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
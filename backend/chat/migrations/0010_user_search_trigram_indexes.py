@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.db import migrations
+
+# Indexes behind chat.search. Both are on UPPER(column), the exact expression
+# Django emits for the case-insensitive lookups that search uses.
+INDEXES = [
+    ('chat_profile_user_name_trgm', 'chat_profile', 'USING gin (UPPER(user_name) gin_trgm_ops)'),
+    ('chat_profile_user_name_prefix', 'chat_profile', '(UPPER(user_name) text_pattern_ops)'),
+    ('chat_auth_user_username_trgm', 'auth_user', 'USING gin (UPPER(username) gin_trgm_ops)'),
+    ('chat_auth_user_username_prefix', 'auth_user', '(UPPER(username) text_pattern_ops)'),
+]
+
+
+def create_search_indexes(apps, schema_editor):
+    # pg_trgm is PostgreSQL-only; other databases use the unindexed fallback in chat.search
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, table, definition in INDEXES:
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} {definition}')
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, _, _ in INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_userkeys_onetimekeys'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
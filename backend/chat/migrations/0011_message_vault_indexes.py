@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:56
+
+import hashlib
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_content_hash(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    batch = []
+    for message in Message.objects.only('id', 'content').iterator(chunk_size=2000):
+        message.content_hash = hashlib.sha256(message.content.encode()).hexdigest()
+        batch.append(message)
+        if len(batch) == 2000:
+            Message.objects.bulk_update(batch, ['content_hash'])
+            batch = []
+    Message.objects.bulk_update(batch, ['content_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_user_search_trigram_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='content_hash',
+            field=models.CharField(default='', editable=False, max_length=64),
+        ),
+        migrations.RunPython(backfill_content_hash, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('saved_by_sender', True)), fields=['sender', 'receiver', 'id'], name='chat_msg_sender_conv_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('saved_by_receiver', True)), fields=['receiver', 'sender', 'id'], name='chat_msg_receiver_conv_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('saved_by_sender', True)), fields=['sender', 'timestamp', 'id'], name='chat_msg_sender_vault_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('saved_by_receiver', True)), fields=['receiver', 'timestamp', 'id'], name='chat_msg_receiver_vault_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'receiver', 'content_hash'], name='chat_msg_content_hash_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 03:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_message_ephemeral_id'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='onetimekeys',
+            index=models.Index(condition=models.Q(('is_used', False)), fields=['user', 'id'], name='chat_otk_unused_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='onetimekeys',
+            index=models.Index(condition=models.Q(('is_used', True)), fields=['id'], name='chat_otk_used_idx'),
+        ),
+    ]
@@ -1,5 +1,7 @@
+import hashlib
+
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import connections, models, transaction
 
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
@@ -31,10 +33,63 @@ class FriendRequest(models.Model):
     def __str__(self):
         return f"{self.from_user.username} -> {self.to_user.username} ({self.status})"
     
+class MessageQuerySet(models.QuerySet):
+    """The vault query shapes, each backed by an index in Message.Meta"""
+
+    def saved_in_conversation(self, user, other_user):
+        """Messages between two users that `user` has saved (users or user ids)"""
+        return self.filter(
+            models.Q(sender=user, receiver=other_user, saved_by_sender=True) |
+            models.Q(sender=other_user, receiver=user, saved_by_receiver=True)
+        )
+
+    def saved_by(self, user):
+        """Every message `user` (a user or user id) has saved, as sender or receiver"""
+        return self.filter(
+            models.Q(sender=user, saved_by_sender=True) |
+            models.Q(receiver=user, saved_by_receiver=True)
+        )
+
+    def vault_page(self, user, fields, before=None, limit=100):
+        """
+        values(*fields) of up to `limit` messages `user` has saved, newest first by
+        (timestamp, id), continuing after the (timestamp, id) pair `before`.
+
+        Each side of saved_by() is read backwards along its own vault index and
+        stops after `limit` rows, then the two are merged, so a page costs the same
+        however large the vault is. Databases that cannot order and slice inside a
+        UNION fall back to filtering saved_by() and sorting.
+        """
+        # The merged pages are ordered by these, so they must be selected
+        fields = list(dict.fromkeys(('id', 'timestamp', *fields)))
+        page = self
+        if before is not None:
+            timestamp, message_id = before
+            # The timestamp bound is an index condition; the id only breaks ties
+            page = page.filter(
+                models.Q(timestamp__lte=timestamp),
+                models.Q(timestamp__lt=timestamp) | models.Q(id__lt=message_id),
+            )
+        order = ('-timestamp', '-id')
+        if not connections[self.db].features.supports_slicing_ordering_in_compound:
+            return page.saved_by(user).values(*fields).order_by(*order)[:limit]
+        sent = page.filter(sender=user, saved_by_sender=True).values(*fields).order_by(*order)[:limit]
+        received = page.filter(receiver=user, saved_by_receiver=True).values(*fields).order_by(*order)[:limit]
+        # UNION, not UNION ALL: a message to oneself can match both sides
+        return sent.union(received).order_by(*order)[:limit]
+
+    def with_content(self, sender, receiver, content):
+        return self.filter(sender=sender, receiver=receiver, content_hash=Message.hash_content(content))
+
+
 class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
     content = models.TextField()
+    # SHA-256 of content, so duplicate lookups compare 64 chars instead of the whole ciphertext
+    content_hash = models.CharField(max_length=64, editable=False, default='')
+    # Id the message had in Redis (see redis_util.sequence_key), when the client sent it
+    ephemeral_id = models.PositiveBigIntegerField(null=True, blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
     
     # Vault tracking (Silent Save)
@@ -42,9 +97,39 @@ class Message(models.Model):
     saved_by_sender = models.BooleanField(default=False)  # Sender saved it
     saved_by_receiver = models.BooleanField(default=False)  # Receiver saved it
 
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # get-messages: one conversation, saved by the side asking, paged by id
+            models.Index(fields=['sender', 'receiver', 'id'], condition=models.Q(saved_by_sender=True),
+                         name='chat_msg_sender_conv_idx'),
+            models.Index(fields=['receiver', 'sender', 'id'], condition=models.Q(saved_by_receiver=True),
+                         name='chat_msg_receiver_conv_idx'),
+            # list-vault: everything one user saved, newest first
+            models.Index(fields=['sender', 'timestamp', 'id'], condition=models.Q(saved_by_sender=True),
+                         name='chat_msg_sender_vault_idx'),
+            models.Index(fields=['receiver', 'timestamp', 'id'], condition=models.Q(saved_by_receiver=True),
+                         name='chat_msg_receiver_vault_idx'),
+            # save-to-vault: is this ciphertext already stored?
+            models.Index(fields=['sender', 'receiver', 'content_hash'], name='chat_msg_content_hash_idx'),
+        ]
+        constraints = [
+            # One vault row per ephemeral message; identical ciphertexts with different ids stay apart
+            models.UniqueConstraint(fields=['sender', 'receiver', 'ephemeral_id'], name='chat_msg_unique_ephemeral_id'),
+        ]
+
     def __str__(self):
         return f"From {self.sender.username} to {self.receiver.username} at {self.timestamp}"
 
+    @staticmethod
+    def hash_content(content):
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def save(self, *args, **kwargs):
+        self.content_hash = self.hash_content(self.content)
+        super().save(*args, **kwargs)
+
 
 # ============ ENCRYPTION MODELS (Matrix/Olm E2EE) ============
 
@@ -63,6 +148,136 @@ class UserKeys(models.Model):
         return f"Keys for {self.user.username}"
 
 
+class OneTimeKeysQuerySet(models.QuerySet):
+    def claim(self, user):
+        """
+        Atomically mark one of `user`'s (a user or user id) unused keys as used and
+        return it, or None when the pool is empty. A key is never handed to two callers.
+        """
+        user_id = getattr(user, 'pk', user)
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            # One statement; concurrent claims skip rows locked by each other
+            # instead of queueing behind them
+            table = self.model._meta.db_table
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    UPDATE {table} SET is_used = TRUE
+                    WHERE id = (
+                        SELECT id FROM {table}
+                        WHERE user_id = %s AND NOT is_used
+                        ORDER BY id LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, key_id, key_value
+                    """,
+                    [user_id],
+                )
+                row = cursor.fetchone()
+            if row is None:
+                return None
+            return self.model(id=row[0], user_id=user_id, key_id=row[1], key_value=row[2], is_used=True)
+
+        # Elsewhere: compare-and-set, retried if another caller took the key first
+        while True:
+            otk = self.filter(user_id=user_id, is_used=False).order_by('id').first()
+            if otk is None:
+                return None
+            if self.filter(id=otk.id, is_used=False).update(is_used=True):
+                otk.is_used = True
+                return otk
+
+    def claim_many(self, user_ids):
+        """
+        claim() for each of `user_ids` at once: {user_id: key} for every user
+        whose pool was not empty. On PostgreSQL this is one statement however
+        many users are asked for.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            # claim()'s subquery, run once per user through a LATERAL join
+            table = self.model._meta.db_table
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    UPDATE {table} SET is_used = TRUE
+                    WHERE id IN (
+                        SELECT claimable.id FROM unnest(%s::bigint[]) AS claimant(user_id)
+                        CROSS JOIN LATERAL (
+                            SELECT id FROM {table}
+                            WHERE user_id = claimant.user_id AND NOT is_used
+                            ORDER BY id LIMIT 1
+                            FOR UPDATE SKIP LOCKED
+                        ) AS claimable
+                    )
+                    RETURNING id, user_id, key_id, key_value
+                    """,
+                    [user_ids],
+                )
+                rows = cursor.fetchall()
+            return {
+                user_id: self.model(id=pk, user_id=user_id, key_id=key_id, key_value=key_value, is_used=True)
+                for pk, user_id, key_id, key_value in rows
+            }
+
+        # Elsewhere: one claim per user
+        claimed = {user_id: self.claim(user_id) for user_id in user_ids}
+        return {user_id: otk for user_id, otk in claimed.items() if otk is not None}
+
+    def add(self, user, keys):
+        """
+        Store `keys` ({key id: key value}) for `user` (a user or user id), skipping
+        ids already in the pool, and return how many were stored. The count stays
+        exact when another upload of the same ids commits at the same moment.
+        """
+        user_id = getattr(user, 'pk', user)
+        if not keys:
+            return 0
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            # One statement; the unique (user, key_id) index decides which rows
+            # are new, and RETURNING reports exactly those
+            table = self.model._meta.db_table
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    INSERT INTO {table} (user_id, key_id, key_value, is_used, created_at)
+                    SELECT %s, new_key.key_id, new_key.key_value, FALSE, now()
+                    FROM unnest(%s::varchar[], %s::varchar[]) AS new_key(key_id, key_value)
+                    ON CONFLICT (user_id, key_id) DO NOTHING
+                    RETURNING id
+                    """,
+                    [user_id, list(keys), list(keys.values())],
+                )
+                return len(cursor.fetchall())
+
+        # Elsewhere: skip the ids already stored; the database has a single
+        # writer, so nothing can be inserted between the read and the INSERT
+        with transaction.atomic(using=self.db):
+            existing = set(self.filter(user_id=user_id, key_id__in=list(keys)).values_list('key_id', flat=True))
+            new_keys = [
+                self.model(user_id=user_id, key_id=key_id, key_value=key_value)
+                for key_id, key_value in keys.items()
+                if key_id not in existing
+            ]
+            self.bulk_create(new_keys)
+        return len(new_keys)
+
+    def delete_used(self, batch_size):
+        """
+        Delete consumed keys `batch_size` rows at a time, each batch in its own short
+        transaction, and return how many were deleted.
+        """
+        deleted = 0
+        while True:
+            ids = list(self.filter(is_used=True).values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return deleted
+            deleted += self.filter(id__in=ids).delete()[0]
+
+
 class OneTimeKeys(models.Model):
     """
     Disposable keys for initial key exchange (X3DH handshake).
@@ -74,9 +289,17 @@ class OneTimeKeys(models.Model):
     is_used = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = OneTimeKeysQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "One Time Keys"
         unique_together = ('user', 'key_id')
+        indexes = [
+            # Claiming and counting a user's pool only ever look at unused keys
+            models.Index(fields=['user', 'id'], condition=models.Q(is_used=False), name='chat_otk_unused_idx'),
+            # gc_one_time_keys: finds the consumed keys without scanning the pool
+            models.Index(fields=['id'], condition=models.Q(is_used=True), name='chat_otk_used_idx'),
+        ]
 
     def __str__(self):
         status = "used" if self.is_used else "available"
@@ -0,0 +1,139 @@
+"""
+Real-time message delivery over WebSockets.
+
+Clients connect to ws://<host>/ws/messages/?token=<access token> and receive a
+JSON frame for every ephemeral message sent to them:
+
+    {"type": "message", "message": {"sender_id": 1, "receiver_id": 2, "content": "..."}}
+
+save_temp_message() publishes each message on the receiver's Redis channel, so
+any ASGI worker process holding the receiver's socket can deliver it. Every
+worker multiplexes all of its sockets over a single pub/sub connection.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+
+from .redis_client import async_redis_client
+from .redis_util import events_channel
+
+logger = logging.getLogger(__name__)
+
+WEBSOCKET_PATH = '/ws/messages/'
+
+# Frames buffered per socket before a slow client starts losing pushes.
+# Anything dropped is still in Redis and is picked up by the next get-messages call.
+MAX_PENDING_FRAMES = 1000
+
+
+class EventHub:
+    """Fans one Redis pub/sub connection out to every socket in this process."""
+
+    def __init__(self):
+        self._queues = defaultdict(set)  # channel -> queues of connected sockets
+        self._pubsub = None
+        self._reader = None
+        self._lock = asyncio.Lock()
+
+    async def join(self, user_id):
+        channel = events_channel(user_id)
+        queue = asyncio.Queue(maxsize=MAX_PENDING_FRAMES)
+        async with self._lock:
+            if self._pubsub is None:
+                self._pubsub = async_redis_client.pubsub(ignore_subscribe_messages=True)
+            if channel not in self._queues:
+                await self._pubsub.subscribe(channel)
+            self._queues[channel].add(queue)
+            if self._reader is None or self._reader.done():
+                self._reader = asyncio.create_task(self._dispatch())
+        return queue
+
+    async def leave(self, user_id, queue):
+        channel = events_channel(user_id)
+        async with self._lock:
+            queues = self._queues.get(channel)
+            if queues is None:
+                return
+            queues.discard(queue)
+            if not queues:
+                del self._queues[channel]
+                await self._pubsub.unsubscribe(channel)
+
+    async def _dispatch(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(timeout=1.0)
+            except Exception:
+                logger.exception('Redis pub/sub connection failed, retrying')
+                await asyncio.sleep(1.0)
+                continue
+            if message is None or message['type'] != 'message':
+                continue
+            channel = message['channel'].decode()
+            for queue in list(self._queues.get(channel, ())):
+                try:
+                    queue.put_nowait(message['data'].decode())
+                except asyncio.QueueFull:
+                    logger.warning('Dropping real-time event for slow client on %s', channel)
+
+
+hub = EventHub()
+
+
+async def authenticate(scope):
+    """Resolve the user from the ?token= query parameter using SimpleJWT."""
+    params = parse_qs(scope.get('query_string', b'').decode())
+    raw_token = params.get('token', [None])[0]
+    if not raw_token:
+        return None
+
+    auth = JWTAuthentication()
+    try:
+        validated_token = auth.get_validated_token(raw_token)
+        user = await sync_to_async(auth.get_user)(validated_token)
+    except (InvalidToken, AuthenticationFailed):
+        return None
+    return user
+
+
+async def websocket_application(scope, receive, send):
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+
+    if scope['path'] != WEBSOCKET_PATH:
+        await send({'type': 'websocket.close', 'code': 4404})
+        return
+
+    user = await authenticate(scope)
+    if user is None:
+        await send({'type': 'websocket.close', 'code': 4401})
+        return
+
+    await send({'type': 'websocket.accept'})
+    queue = await hub.join(user.id)
+
+    async def push():
+        while True:
+            frame = await queue.get()
+            await send({'type': 'websocket.send', 'text': frame})
+
+    async def wait_for_disconnect():
+        # Clients never need to send anything; just drain until they go away
+        while True:
+            event = await receive()
+            if event['type'] == 'websocket.disconnect':
+                return
+
+    tasks = [asyncio.create_task(push()), asyncio.create_task(wait_for_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await hub.leave(user.id, queue)
@@ -1,2 +1,118 @@
-import redis 
-redis_client = redis.StrictRedis(host='localhost', port=6379, db=0)
\ No newline at end of file
+"""
+Redis clients shared by the whole process, built from the REDIS_* settings.
+
+async_redis_client keeps one asyncio client per event loop (see PerLoopRedis).
+Both clients sit on a blocking connection pool: when every connection is busy a
+caller waits up to REDIS_POOL_TIMEOUT for one instead of failing straight away.
+Socket timeouts, TCP keepalive, health checks and retries with backoff stop a
+Redis failover from hanging workers.
+"""
+import asyncio
+import threading
+
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+from redis.asyncio.retry import Retry as AsyncRetry
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+
+
+def _connection_options():
+    return {
+        'max_connections': settings.REDIS_MAX_CONNECTIONS,
+        'timeout': settings.REDIS_POOL_TIMEOUT,
+        'socket_timeout': settings.REDIS_SOCKET_TIMEOUT,
+        'socket_connect_timeout': settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        'socket_keepalive': True,
+        'health_check_interval': settings.REDIS_HEALTH_CHECK_INTERVAL,
+    }
+
+
+def create_redis_client():
+    pool = redis.BlockingConnectionPool.from_url(
+        settings.REDIS_URL,
+        retry=Retry(ExponentialBackoff(), settings.REDIS_RETRY_ATTEMPTS),
+        **_connection_options(),
+    )
+    return redis.StrictRedis(connection_pool=pool)
+
+
+def create_async_redis_client():
+    pool = aioredis.BlockingConnectionPool.from_url(
+        settings.REDIS_URL,
+        retry=AsyncRetry(ExponentialBackoff(), settings.REDIS_RETRY_ATTEMPTS),
+        **_connection_options(),
+    )
+    return aioredis.StrictRedis(connection_pool=pool)
+
+
+class PerLoopRedis:
+    """
+    Stands in for an asyncio Redis client, handing each call to a client (and
+    pool) of the event loop it runs on. redis.asyncio connections belong to the
+    loop that opened them, so one process-wide client breaks as soon as a second
+    loop uses it: under WSGI every async view runs in a loop of its own, and so
+    does every asyncio.run(). Under ASGI there is one loop per worker, so one client.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        # Applied to each new client's connection class (see metrics.install)
+        self.connection_class_wrapper = None
+        self._clients = {}  # event loop -> client
+        self._lock = threading.Lock()
+
+    def client(self):
+        """The client of the running event loop"""
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            with self._lock:
+                # Forget the clients of loops that have finished
+                for closed in [other for other in self._clients if other.is_closed()]:
+                    del self._clients[closed]
+                client = self._clients.get(loop)
+                if client is None:
+                    client = self._clients[loop] = self.factory()
+                    if self.connection_class_wrapper is not None:
+                        pool = client.connection_pool
+                        pool.connection_class = self.connection_class_wrapper(pool.connection_class)
+        return client
+
+    def clients(self):
+        """The clients of the loops still open"""
+        return [client for loop, client in list(self._clients.items()) if not loop.is_closed()]
+
+    def __getattr__(self, name):
+        return getattr(self.client(), name)
+
+
+redis_client = create_redis_client()
+
+# Used by the ASGI application for pub/sub (real-time delivery) and the async views
+async_redis_client = PerLoopRedis(create_async_redis_client)
+
+
+def pool_stats():
+    """Connection pool utilisation for both clients in this process"""
+    sync_pool = redis_client.connection_pool
+    sync_idle = sum(1 for connection in list(sync_pool.pool.queue) if connection is not None)
+    async_pools = [client.connection_pool for client in async_redis_client.clients()]
+    async_in_use = sum(len(pool._in_use_connections) for pool in async_pools)
+    async_idle = sum(len(pool._available_connections) for pool in async_pools)
+    return {
+        'sync': {
+            'max_connections': sync_pool.max_connections,
+            'created': len(sync_pool._connections),
+            'in_use': len(sync_pool._connections) - sync_idle,
+            'idle': sync_idle,
+        },
+        # Summed over the pools of every event loop (one per worker under ASGI)
+        'async': {
+            'max_connections': sum(pool.max_connections for pool in async_pools),
+            'created': async_in_use + async_idle,
+            'in_use': async_in_use,
+            'idle': async_idle,
+        },
+    }
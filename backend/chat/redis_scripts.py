@@ -0,0 +1,297 @@
+"""
+Server-side Lua for the ephemeral message stores in redis_util.
+
+Each script does one logical operation (send, fetch, remove) in a single round
+trip and runs atomically, so no other client can interleave between e.g. the
+read and the LREM of a removal. Arguments that are not set are passed as "".
+"""
+
+# Shared part of the save scripts, run once the new message is appended (the
+# script defines `message`, `length`, pop_oldest(), and `dropped` raw messages
+# the append itself already trimmed). Adds the message to the conversation's
+# byte counter and takes the dropped ones off it, then drops the oldest
+# messages until the conversation is within both the message and the byte cap,
+# always keeping the new message. Both keys live as long as the newest message.
+TRIM = """
+local delta = #message
+for _, raw in ipairs(dropped) do
+    delta = delta - #raw
+end
+local bytes = redis.call('INCRBY', KEYS[5], delta)
+local trimmed = #dropped
+while length > 1 and (length > tonumber(ARGV[9]) or bytes > tonumber(ARGV[10])) do
+    bytes = redis.call('DECRBY', KEYS[5], #pop_oldest())
+    length = length - 1
+    trimmed = trimmed + 1
+end
+if bytes < 0 then
+    -- Trimmed entries written before the counter existed
+    redis.call('SET', KEYS[5], 0)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+redis.call('EXPIRE', KEYS[5], ARGV[6])
+redis.call('PUBLISH', ARGV[7], '{"type": "message", "message": ' .. message .. '}')
+"""
+
+# Shared tail of the save scripts: record the conversation in the receiver's
+# inbox (sorted set of sender ids by last activity, in ms) and bump its unread
+# counter (hash of sender id to count). Both live as long as the messages, and
+# senders whose messages have all expired drop out of the inbox. Returns the
+# saved message and how many old ones were trimmed to make room for it.
+INDEX_INBOX = """
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', '(' .. (ARGV[8] - ARGV[6] * 1000))
+redis.call('ZADD', KEYS[3], ARGV[8], ARGV[1])
+redis.call('HINCRBY', KEYS[4], ARGV[1], 1)
+redis.call('EXPIRE', KEYS[3], ARGV[6])
+redis.call('EXPIRE', KEYS[4], ARGV[6])
+return {message, trimmed}
+"""
+
+# KEYS: conversation, sequence, receiver inbox, receiver unread counts, conversation bytes
+# ARGV: sender_id, receiver_id, content, digest, timestamp, ttl, events channel, activity (ms),
+#       max messages, max bytes
+LIST_SAVE = """
+local function pop_oldest()
+    return redis.call('LPOP', KEYS[1])
+end
+local message = cjson.encode({
+    id = redis.call('INCR', KEYS[2]),
+    sender_id = tonumber(ARGV[1]),
+    receiver_id = tonumber(ARGV[2]),
+    content = ARGV[3],
+    digest = ARGV[4],
+    timestamp = ARGV[5],
+})
+local length = redis.call('RPUSH', KEYS[1], message)
+local dropped = {}
+""" + TRIM + INDEX_INBOX
+
+# KEYS: conversation, sequence, receiver inbox, receiver unread counts, conversation bytes
+# ARGV: as LIST_SAVE
+# The message cap is XADD's exact MAXLEN; the entries it is about to drop are
+# read first for their sizes. Only the byte cap is left to the TRIM loop.
+STREAM_SAVE = """
+local function pop_oldest()
+    local oldest = redis.call('XRANGE', KEYS[1], '-', '+', 'COUNT', 1)[1]
+    redis.call('XDEL', KEYS[1], oldest[1])
+    return oldest[2][2]
+end
+local id = redis.call('INCR', KEYS[2])
+local message = cjson.encode({
+    id = id,
+    sender_id = tonumber(ARGV[1]),
+    receiver_id = tonumber(ARGV[2]),
+    content = ARGV[3],
+    digest = ARGV[4],
+    timestamp = ARGV[5],
+})
+local max_length = math.max(tonumber(ARGV[9]), 1)
+local over = redis.call('XLEN', KEYS[1]) + 1 - max_length
+local dropped = {}
+if over > 0 then
+    for i, entry in ipairs(redis.call('XRANGE', KEYS[1], '-', '+', 'COUNT', over)) do
+        dropped[i] = entry[2][2]
+    end
+end
+redis.call('XADD', KEYS[1], 'MAXLEN', max_length, id .. '-0', 'message', message)
+local length = redis.call('XLEN', KEYS[1])
+""" + TRIM + INDEX_INBOX
+
+# KEYS: one or more conversations
+# ARGV: since, before, limit, page size
+# Returns one array of JSON messages per key, oldest first. Lists are read
+# backwards from the tail a page at a time, so the work done follows the
+# distance to the cursor rather than the length of the list.
+LIST_FETCH = """
+local since = tonumber(ARGV[1])
+local before = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local page = tonumber(ARGV[4])
+local result = {}
+for k = 1, #KEYS do
+    if not since and not before and not limit then
+        result[k] = redis.call('LRANGE', KEYS[k], 0, -1)
+    else
+        local matches = {}  -- newest first
+        local stop = -1
+        local done = false
+        while not done do
+            local entries = redis.call('LRANGE', KEYS[k], stop - page + 1, stop)
+            for i = #entries, 1, -1 do
+                local id = cjson.decode(entries[i]).id or 0  -- entries written before ids existed
+                if since and id <= since then
+                    done = true
+                    break
+                end
+                if not before or id < before then
+                    matches[#matches + 1] = entries[i]
+                    if not since and limit and #matches == limit then
+                        done = true
+                        break
+                    end
+                end
+            end
+            if #entries < page then
+                done = true
+            end
+            stop = stop - page
+        end
+        local ordered = {}
+        local count = #matches
+        if since and limit and limit < count then
+            count = limit
+        end
+        for i = 1, count do
+            ordered[i] = matches[#matches - i + 1]
+        end
+        result[k] = ordered
+    end
+end
+return result
+"""
+
+# KEYS: one or more conversations
+# ARGV: since, before, limit
+STREAM_FETCH = """
+local since = tonumber(ARGV[1])
+local before = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local low = '-'
+local high = '+'
+if since then low = tostring(since + 1) end
+if before then high = tostring(before - 1) end
+local result = {}
+for k = 1, #KEYS do
+    local messages = {}
+    if not before or before > 1 then
+        local entries
+        if since or not limit then
+            if limit then
+                entries = redis.call('XRANGE', KEYS[k], low, high, 'COUNT', limit)
+            else
+                entries = redis.call('XRANGE', KEYS[k], low, high)
+            end
+            for i = 1, #entries do
+                messages[i] = entries[i][2][2]
+            end
+        else
+            entries = redis.call('XREVRANGE', KEYS[k], high, low, 'COUNT', limit)
+            for i = 1, #entries do
+                messages[i] = entries[#entries - i + 1][2][2]
+            end
+        end
+    end
+    result[k] = messages
+end
+return result
+"""
+
+# KEYS: conversation, conversation bytes, receiver inbox, receiver unread counts
+# ARGV: message id, digest, content, sender_id
+# Matches on id when given, otherwise on the SHA-256 digest stored with the
+# message (content only for entries written before digests existed). The
+# removed message is taken off the byte counter, if the conversation has one,
+# and off the receiver's unread count if it was unread. The unread messages are
+# always the newest ones, so that is when fewer than the count came after it.
+# A conversation left empty drops out of the receiver's inbox.
+MATCHES = """
+local function matches(message, id, digest, content)
+    if id then
+        return message.id == id
+    end
+    if message.digest then
+        return message.digest == digest
+    end
+    return message.content == content
+end
+local function uncount(raw)
+    if redis.call('EXISTS', KEYS[2]) == 1 and redis.call('DECRBY', KEYS[2], #raw) < 0 then
+        redis.call('SET', KEYS[2], 0, 'KEEPTTL')
+    end
+end
+-- count_newer(limit): how many messages follow the removed one, up to limit
+local function unindex(count_newer, remaining)
+    local unread = tonumber(redis.call('HGET', KEYS[4], ARGV[4])) or 0
+    if unread > 0 and count_newer(unread) < unread then
+        if unread > 1 then
+            redis.call('HINCRBY', KEYS[4], ARGV[4], -1)
+        else
+            redis.call('HDEL', KEYS[4], ARGV[4])
+        end
+    end
+    if remaining == 0 then
+        redis.call('ZREM', KEYS[3], ARGV[4])
+        redis.call('HDEL', KEYS[4], ARGV[4])
+    end
+end
+"""
+
+# KEYS: as MATCHES
+# ARGV: as MATCHES, then the page size
+# Ids grow towards the tail, so a removal by id reads the list backwards a page
+# at a time and stops at the first older message: removing a recent message
+# costs about the same however long the list is. Removal by digest or content
+# still reads the whole list.
+LIST_REMOVE = MATCHES + """
+local id = tonumber(ARGV[1])
+if id then
+    local page = tonumber(ARGV[5])
+    local newer = 0
+    local stop = -1
+    while true do
+        local entries = redis.call('LRANGE', KEYS[1], stop - page + 1, stop)
+        for i = #entries, 1, -1 do
+            local message = cjson.decode(entries[i])
+            if message.id == id then
+                uncount(entries[i])
+                local removed = redis.call('LREM', KEYS[1], -1, entries[i])
+                unindex(function() return newer end, redis.call('LLEN', KEYS[1]))
+                return removed
+            end
+            if (message.id or 0) < id then  -- entries written before ids existed
+                return 0
+            end
+            newer = newer + 1
+        end
+        if #entries < page then
+            return 0
+        end
+        stop = stop - page
+    end
+end
+local entries = redis.call('LRANGE', KEYS[1], 0, -1)
+for i, raw in ipairs(entries) do
+    local message = cjson.decode(raw)
+    if matches(message, id, ARGV[2], ARGV[3]) then
+        uncount(raw)
+        local removed = redis.call('LREM', KEYS[1], 1, raw)
+        unindex(function() return #entries - i end, #entries - 1)
+        return removed
+    end
+end
+return 0
+"""
+
+# KEYS: conversation, conversation bytes, receiver inbox, receiver unread counts
+# ARGV: message id, digest, content, sender_id
+STREAM_REMOVE = MATCHES + """
+local id = tonumber(ARGV[1])
+local entries
+if id then
+    entries = redis.call('XRANGE', KEYS[1], id .. '-0', id .. '-0')
+else
+    entries = redis.call('XRANGE', KEYS[1], '-', '+')
+end
+for _, entry in ipairs(entries) do
+    local message = cjson.decode(entry[2][2])
+    if matches(message, id, ARGV[2], ARGV[3]) then
+        uncount(entry[2][2])
+        local removed = redis.call('XDEL', KEYS[1], entry[1])
+        unindex(function(limit)
+            return #redis.call('XRANGE', KEYS[1], (message.id + 1) .. '-0', '+', 'COUNT', limit)
+        end, redis.call('XLEN', KEYS[1]))
+        return removed
+    end
+end
+return 0
+"""
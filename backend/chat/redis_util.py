@@ -1,34 +1,321 @@
-import json 
-from .redis_client import redis_client
+import hashlib
+import json
+from datetime import datetime, timezone
+from django.conf import settings
+from redis.exceptions import NoScriptError
+from . import metrics, redis_scripts
+from .redis_client import async_redis_client, redis_client
+
+# Entries read per LRANGE when scanning a conversation backwards from its newest message
+SCAN_PAGE_SIZE = 100
+
+def events_channel(user_id):
+    """Pub/sub channel carrying real-time events for one user (see realtime.py)"""
+    return f"events:{user_id}"
+
+def sequence_key(user_a, user_b):
+    """Message id counter shared by both directions of a conversation.
+    It has no TTL so ids are never reused once the messages themselves expire."""
+    low, high = sorted((int(user_a), int(user_b)))
+    return f"chatseq:{low}:{high}"
+
+def size_key(sender_id, receiver_id):
+    """Total bytes of the messages stored in chat:{sender_id}:{receiver_id}, kept by the scripts"""
+    return f"chatbytes:{sender_id}:{receiver_id}"
+
+
+def inbox_key(user_id):
+    """Sorted set of the ids of users who have sent `user_id` messages, scored by last send (ms)"""
+    return f"inbox:{user_id}"
+
+def unread_key(user_id):
+    """Hash of sender id to the number of messages `user_id` has not fetched yet"""
+    return f"unread:{user_id}"
+
+
+def content_digest(content):
+    """SHA-256 of a ciphertext, stored with each message. Same value as Message.content_hash."""
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _epoch_ms(timestamp):
+    return int(timestamp.timestamp() * 1000)
+
+def _arg(value):
+    """Scripts receive unset optional arguments as empty strings"""
+    return "" if value is None else value
+
+
+class MessageStore:
+    """
+    Runs the save/fetch/remove scripts of one storage engine. Subclasses provide
+    the scripts and the engine-specific script arguments. Every operation has a
+    sync form and an async one (prefixed with "a") for the ASGI views.
+
+    Each direction of a conversation is capped at CHAT_CONVERSATION_MAX_MESSAGES
+    messages and CHAT_CONVERSATION_MAX_BYTES bytes: a save drops the oldest
+    messages in the same script, so reads and memory stay bounded however busy
+    the pair is.
+    """
+    save_lua = fetch_lua = remove_lua = None
+
+    def __init__(self):
+        self.save_script = redis_client.register_script(self.save_lua)
+        self.fetch_script = redis_client.register_script(self.fetch_lua)
+        self.remove_script = redis_client.register_script(self.remove_lua)
+
+    @property
+    def scripts(self):
+        return [self.save_script, self.fetch_script, self.remove_script]
+
+    def append_args(self, key, sequence, channel, sender_id, receiver_id, content, timestamp, ttl):
+        keys = [key, sequence, inbox_key(receiver_id), unread_key(receiver_id), size_key(sender_id, receiver_id)]
+        args = [sender_id, receiver_id, content, content_digest(content), timestamp.isoformat(), ttl, channel,
+                _epoch_ms(timestamp), settings.CHAT_CONVERSATION_MAX_MESSAGES, settings.CHAT_CONVERSATION_MAX_BYTES]
+        return keys, args
+
+    def fetch_args(self, since=None, before=None, limit=None):
+        return [_arg(since), _arg(before), _arg(limit)]
+
+    def remove_args(self, sender_id, receiver_id, message_id=None, content=None):
+        keys = [f"chat:{sender_id}:{receiver_id}", size_key(sender_id, receiver_id),
+                inbox_key(receiver_id), unread_key(receiver_id)]
+        digest = None if content is None else content_digest(content)
+        return keys, [_arg(message_id), _arg(digest), _arg(content), sender_id]
+
+    def append(self, *args, client=None):
+        keys, argv = self.append_args(*args)
+        return self.save_script(keys=keys, args=argv, client=client)
+
+    def fetch(self, keys, since=None, before=None, limit=None, client=None):
+        return self.fetch_script(keys=keys, args=self.fetch_args(since, before, limit), client=client)
+
+    def remove(self, sender_id, receiver_id, message_id=None, content=None, client=None):
+        keys, args = self.remove_args(sender_id, receiver_id, message_id, content)
+        return self.remove_script(keys=keys, args=args, client=client)
+
+    async def aappend(self, *args):
+        return await _run_async(self.save_script, *self.append_args(*args))
+
+    async def afetch(self, keys, since=None, before=None, limit=None):
+        return await _run_async(self.fetch_script, keys, self.fetch_args(since, before, limit))
+
+
+class ListMessageStore(MessageStore):
+    """
+    Each direction of a conversation is a Redis list of JSON messages (RPUSH).
+    Removing a single message needs a scan of the list, done server-side; by
+    id it only reads back from the tail as far as that message.
+    """
+    save_lua = redis_scripts.LIST_SAVE
+    fetch_lua = redis_scripts.LIST_FETCH
+    remove_lua = redis_scripts.LIST_REMOVE
+
+    def fetch_args(self, since=None, before=None, limit=None):
+        return super().fetch_args(since, before, limit) + [SCAN_PAGE_SIZE]
+
+    def remove_args(self, sender_id, receiver_id, message_id=None, content=None):
+        keys, args = super().remove_args(sender_id, receiver_id, message_id, content)
+        return keys, args + [SCAN_PAGE_SIZE]
+
+
+class StreamMessageStore(MessageStore):
+    """
+    Each direction of a conversation is a Redis Stream. The entry id is the
+    message id ("<id>-0"), so reads are XRANGE by id and removal is one XDEL.
+    """
+    save_lua = redis_scripts.STREAM_SAVE
+    fetch_lua = redis_scripts.STREAM_FETCH
+    remove_lua = redis_scripts.STREAM_REMOVE
+
+
+async def _run_async(script, keys, args):
+    """Run a registered script on the async client (EVALSHA, loading it if Redis lost it)"""
+    try:
+        return await async_redis_client.evalsha(script.sha, len(keys), *keys, *args)
+    except NoScriptError:
+        await async_redis_client.script_load(script.script)
+        return await async_redis_client.evalsha(script.sha, len(keys), *keys, *args)
+
+
+MESSAGE_STORES = {
+    "list": ListMessageStore(),
+    "stream": StreamMessageStore(),
+}
+
+def get_message_store():
+    """Storage engine selected by settings.CHAT_EPHEMERAL_BACKEND ("list" or "stream")"""
+    return MESSAGE_STORES[settings.CHAT_EPHEMERAL_BACKEND]
+
+def load_scripts():
+    """Load every Lua script into Redis once at startup, so calls go straight to EVALSHA"""
+    for store in MESSAGE_STORES.values():
+        for script in store.scripts:
+            script.sha = redis_client.script_load(script.script)
+
+
+def _saved(result):
+    """The message a save script returned, counting the old messages it trimmed"""
+    raw, trimmed = result
+    if trimmed:
+        metrics.increment('chat_ephemeral_trimmed_messages_total', {'backend': settings.CHAT_EPHEMERAL_BACKEND}, trimmed)
+    return json.loads(raw)
+
+
+def publish_event(user_id, event):
+    """Push an event to the user's open WebSocket connections (see realtime.py)"""
+    redis_client.publish(events_channel(user_id), json.dumps(event))
+
+
+def publish_events(events):
+    """publish_event for many (user_id, event) pairs in one round trip"""
+    pipe = redis_client.pipeline(transaction=False)
+    for user_id, event in events:
+        pipe.publish(events_channel(user_id), json.dumps(event))
+    pipe.execute()
+
 
 def save_temp_message(sender_id, receiver_id, content, ttl=604800):
-    """Save message to Redis. Default TTL: 7 days (604800 seconds)"""
+    """
+    Save message to Redis and notify the receiver. Default TTL: 7 days (604800 seconds)
+    Id allocation, append, trimming, TTL refresh and publish happen in one atomic round trip.
+    """
+    result = get_message_store().append(
+        f"chat:{sender_id}:{receiver_id}",
+        sequence_key(sender_id, receiver_id),
+        events_channel(receiver_id),
+        sender_id, receiver_id, content,
+        datetime.now(timezone.utc),
+        ttl,
+    )
+    return _saved(result)
+
+def save_temp_messages(sender_id, messages, ttl=604800):
+    """
+    save_temp_message for a batch of (receiver_id, content) pairs. The scripts are
+    pipelined, so the whole batch costs one round trip (plus a SCRIPT EXISTS check).
+    Returns the saved messages in the order given.
+    """
+    store = get_message_store()
+    timestamp = datetime.now(timezone.utc)
+    pipe = redis_client.pipeline(transaction=False)
+    for receiver_id, content in messages:
+        store.append(
+            f"chat:{sender_id}:{receiver_id}",
+            sequence_key(sender_id, receiver_id),
+            events_channel(receiver_id),
+            sender_id, receiver_id, content,
+            timestamp,
+            ttl,
+            client=pipe,
+        )
+    return [_saved(result) for result in pipe.execute()]
+
+def get_temp_messages(sender_id, receiver_id, since=None, before=None, limit=None):
+    """
+    Fetch messages from Redis WITHOUT deleting them, oldest first.
+    Messages persist until manually removed or TTL expires.
+
+    since/before are exclusive message id bounds. With `since`, the oldest `limit`
+    newer messages are returned (catching up); otherwise the newest `limit` older
+    than `before` (paging back).
+    """
     key = f"chat:{sender_id}:{receiver_id}"
-    message = {
-        "sender_id": sender_id,
-        "receiver_id": receiver_id,
-        "content": content,
+    [messages] = get_message_store().fetch([key], since, before, limit)
+    return [json.loads(m) for m in messages]
+
+def get_conversation_messages(user_id, other_user_id, since=None, before=None, limit=None):
+    """
+    Both directions of a conversation in one round trip, as (received, sent).
+    Takes the same cursors as get_temp_messages, applied to each direction.
+    """
+    keys = [f"chat:{other_user_id}:{user_id}", f"chat:{user_id}:{other_user_id}"]
+    received, sent = get_message_store().fetch(keys, since, before, limit)
+    return [json.loads(m) for m in received], [json.loads(m) for m in sent]
+
+def get_conversations_messages(user_id, cursors, limit=None):
+    """
+    get_conversation_messages for many conversations at once, pipelined into one
+    round trip. `cursors` maps each other user's id to its `since` cursor (or None
+    for the newest page). Returns {other_user_id: (received, sent)}.
+    """
+    store = get_message_store()
+    pipe = redis_client.pipeline(transaction=False)
+    for other_user_id, since in cursors.items():
+        keys = [f"chat:{other_user_id}:{user_id}", f"chat:{user_id}:{other_user_id}"]
+        store.fetch(keys, since, None, limit, client=pipe)
+    return {
+        other_user_id: ([json.loads(m) for m in received], [json.loads(m) for m in sent])
+        for other_user_id, (received, sent) in zip(cursors, pipe.execute())
     }
-    redis_client.rpush(key, json.dumps(message))
-    redis_client.expire(key, ttl)  # Set 7-day TTL by default
 
-def get_temp_messages(sender_id, receiver_id):
-    """Fetch messages from Redis WITHOUT deleting them. Messages persist until manually removed or TTL expires."""
-    key = f"chat:{sender_id}:{receiver_id}"
-    messages = [json.loads(m) for m in redis_client.lrange(key, 0, -1)]
-    return messages
+def remove_temp_message(sender_id, receiver_id, content=None, message_id=None):
+    """
+    Remove a specific message from Redis (when saved to vault), by id when the client
+    knows it. The receiver's unread count and inbox are updated in the same script.
+    """
+    get_message_store().remove(sender_id, receiver_id, message_id=message_id, content=content)
 
-def remove_temp_message(sender_id, receiver_id, content):
-    """Remove a specific message from Redis (when saved to vault)"""
-    key = f"chat:{sender_id}:{receiver_id}"
-    messages = redis_client.lrange(key, 0, -1)
-    for msg in messages:
-        msg_obj = json.loads(msg)
-        if msg_obj["content"] == content:
-            redis_client.lrem(key, 1, msg)
-            break
+def remove_temp_messages(removals):
+    """
+    remove_temp_message for many (sender_id, receiver_id, content, message_id)
+    tuples, pipelined into one round trip.
+    """
+    store = get_message_store()
+    pipe = redis_client.pipeline(transaction=False)
+    for sender_id, receiver_id, content, message_id in removals:
+        store.remove(sender_id, receiver_id, message_id=message_id, content=content, client=pipe)
+    pipe.execute()
 
 def cleanup_all_temp_messages(sender_id, receiver_id):
     """Delete ALL ephemeral messages (called on tab switch or logout)"""
     key = f"chat:{sender_id}:{receiver_id}"
-    redis_client.delete(key)
\ No newline at end of file
+    pipe = redis_client.pipeline()
+    pipe.delete(key, size_key(sender_id, receiver_id))
+    pipe.zrem(inbox_key(receiver_id), sender_id)
+    pipe.hdel(unread_key(receiver_id), sender_id)
+    pipe.execute()
+
+def get_unread(user_id, limit=None):
+    """
+    The conversations with messages for `user_id`, most recent first, as dicts of
+    user_id, unread and last_activity (ms). One round trip, O(log n) in the inbox size.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.zrevrange(inbox_key(user_id), 0, -1 if limit is None else limit - 1, withscores=True)
+    pipe.hgetall(unread_key(user_id))
+    inbox, counts = pipe.execute()
+    return [{
+        'user_id': int(sender_id),
+        'unread': int(counts.get(sender_id, 0)),
+        'last_activity': int(score),
+    } for sender_id, score in inbox]
+
+def mark_read(user_id, other_user_id):
+    """Reset the unread count of the conversation with `other_user_id`"""
+    redis_client.hdel(unread_key(user_id), other_user_id)
+
+
+# Async variants for the ASGI views (async_views.py), on the asyncio client
+
+async def asave_temp_message(sender_id, receiver_id, content, ttl=604800):
+    result = await get_message_store().aappend(
+        f"chat:{sender_id}:{receiver_id}",
+        sequence_key(sender_id, receiver_id),
+        events_channel(receiver_id),
+        sender_id, receiver_id, content,
+        datetime.now(timezone.utc),
+        ttl,
+    )
+    return _saved(result)
+
+async def aget_conversation_messages(user_id, other_user_id, since=None, before=None, limit=None):
+    keys = [f"chat:{other_user_id}:{user_id}", f"chat:{user_id}:{other_user_id}"]
+    received, sent = await get_message_store().afetch(keys, since, before, limit)
+    return [json.loads(m) for m in received], [json.loads(m) for m in sent]
+
+async def amark_read(user_id, other_user_id):
+    await async_redis_client.hdel(unread_key(user_id), other_user_id)
+
+async def apublish_event(user_id, event):
+    await async_redis_client.publish(events_channel(user_id), json.dumps(event))
@@ -0,0 +1,69 @@
+"""
+User search for SearchUsersView.
+
+On PostgreSQL, profile names and usernames are matched through pg_trgm GIN
+indexes on UPPER(column) (migration 0010): prefix matches rank first, then
+fuzzy matches by trigram similarity. Each column is searched by its own indexed
+query, bounded by the page being asked for, and the two are merged here. Other
+databases (SQLite in tests) fall back to a case-insensitive substring match.
+"""
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connection
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.db.models.functions import Upper
+
+from .models import Profile
+
+# Trigram similarity needs at least one full trigram; shorter queries are prefix-only
+MIN_FUZZY_QUERY_LENGTH = 3
+
+RESULT_FIELDS = ('user_id', 'user__username', 'user_name')
+
+
+def search_profiles(query, exclude_user_id, limit, offset=0):
+    """
+    Return up to `limit` matching profiles starting at `offset`, and whether more exist.
+    Each result is a dict with user_id, user__username and user_name.
+    """
+    window = offset + limit + 1  # one extra row tells us whether there is a next page
+    profiles = Profile.objects.exclude(user_id=exclude_user_id)
+
+    if connection.vendor != 'postgresql':
+        matches = list(
+            profiles.filter(Q(user_name__icontains=query) | Q(user__username__icontains=query))
+            .annotate(is_prefix=_prefix_rank(Q(user_name__istartswith=query) | Q(user__username__istartswith=query)))
+            .order_by('-is_prefix', 'user_id')
+            .values(*RESULT_FIELDS)[offset:window]
+        )
+        return matches[:limit], len(matches) > limit
+
+    term = query.upper()
+    ranked = []
+    for column in ('user_name', 'user__username'):
+        candidates = profiles.annotate(match=Upper(column))
+        prefix = Q(match__startswith=term)
+        if len(query) < MIN_FUZZY_QUERY_LENGTH:
+            # Fast path: a pure prefix scan, served by the same index
+            candidates = candidates.filter(prefix).annotate(score=Value(1.0))
+        else:
+            candidates = candidates.filter(prefix | Q(match__trigram_similar=term)).annotate(
+                score=TrigramSimilarity('match', term)
+            )
+        ranked += candidates.annotate(is_prefix=_prefix_rank(prefix)).order_by(
+            '-is_prefix', '-score', 'user_id'
+        ).values('is_prefix', 'score', *RESULT_FIELDS)[:window]
+
+    # A profile can match on both columns; keep its best ranking
+    ranked.sort(key=lambda row: (-row['is_prefix'], -row['score'], row['user_id']))
+    seen = set()
+    merged = []
+    for row in ranked:
+        if row['user_id'] not in seen:
+            seen.add(row['user_id'])
+            merged.append({field: row[field] for field in RESULT_FIELDS})
+    page = merged[offset:window]
+    return page[:limit], len(page) > limit
+
+
+def _prefix_rank(condition):
+    return Case(When(condition, then=Value(1)), default=Value(0), output_field=IntegerField())
@@ -1,3 +1,1210 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt import tokens
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from . import realtime, redis_util
+from .authentication import RefreshToken, user_active
+from .cache import local_friends
+from .metrics import Registry, flush_client, render
+from .models import Friend, FriendRequest, Message, OneTimeKeys, Profile, UserKeys
+from .redis_client import PerLoopRedis
+
+LIST_SIZES = (1, 10, 1000)
+
+# Requests are counted as usual, but never flushed to Redis from the middleware
+# (MetricsTests flush through a mock client)
+no_metrics_flush = override_settings(METRICS_FLUSH_INTERVAL=float('inf'))
+
+
+def setUpModule():
+    no_metrics_flush.enable()
+
+
+def tearDownModule():
+    no_metrics_flush.disable()
+
+
+def create_users(prefix, count):
+    """Bulk-create `count` users with profiles, returned in id order."""
+    User.objects.bulk_create(User(username=f'{prefix}{i}') for i in range(count))
+    users = list(User.objects.filter(username__startswith=prefix).order_by('id'))
+    Profile.objects.bulk_create(Profile(user=user, user_name=f'{user.username}-name') for user in users)
+    return users
+
+
+class ListQueryCountTests(TestCase):
+    """List endpoints must cost a fixed number of queries whatever the list size."""
+
+    def setUp(self):
+        self.me = User.objects.create_user('me', password='pw')
+        Profile.objects.create(user=self.me, user_name='me-name')
+        self.client = APIClient()
+        self.client.force_authenticate(self.me)
+
+    def test_list_friends(self):
+        for size in LIST_SIZES:
+            with self.subTest(size=size):
+                Friend.objects.filter(user=self.me).delete()
+                friends = create_users(f'friend{size}-', size)
+                Friend.objects.bulk_create(Friend(user=self.me, friend=friend) for friend in friends)
+
+                with self.assertNumQueries(1):
+                    response = self.client.get('/api/list-friends/')
+                self.assertEqual(response.data['count'], size)
+                self.assertEqual(response.data['friends'][0]['user_name'], f'{friends[0].username}-name')
+
+    def test_pending_requests(self):
+        for size in LIST_SIZES:
+            with self.subTest(size=size):
+                FriendRequest.objects.filter(to_user=self.me).delete()
+                senders = create_users(f'sender{size}-', size)
+                FriendRequest.objects.bulk_create(FriendRequest(from_user=sender, to_user=self.me) for sender in senders)
+
+                with self.assertNumQueries(1):
+                    response = self.client.get('/api/pending-requests/')
+                self.assertEqual(response.data['count'], size)
+                self.assertEqual(response.data['requests'][0]['username'], senders[0].username)
+
+    def test_search_users(self):
+        # PostgreSQL searches the profile-name and username indexes separately
+        queries = 2 if connection.vendor == 'postgresql' else 1
+        for size in LIST_SIZES:
+            with self.subTest(size=size):
+                create_users(f'search{size}x', size)
+
+                with self.assertNumQueries(queries):
+                    response = self.client.get('/api/search-users/', {'q': f'search{size}x', 'limit': 50})
+                self.assertEqual(len(response.data['results']), min(size, 50))
+
+    def test_list_vault(self):
+        other = User.objects.create_user('other', password='pw')
+        for size in LIST_SIZES:
+            with self.subTest(size=size):
+                Message.objects.all().delete()
+                Message.objects.bulk_create(
+                    Message(sender=other, receiver=self.me, content=f'msg {i}', saved_by_receiver=True)
+                    for i in range(size)
+                )
+
+                with self.assertNumQueries(1):
+                    response = self.client.get('/api/list-vault/')
+                self.assertEqual(response.data['count'], min(size, settings.CHAT_MESSAGES_DEFAULT_LIMIT))
+                self.assertEqual(response.data['has_more'], size > settings.CHAT_MESSAGES_DEFAULT_LIMIT)
+                self.assertEqual(response.data['messages'][0]['sender_username'], 'other')
+
+    @mock.patch('chat.views.mark_read')
+    @mock.patch('chat.views.get_conversation_messages', return_value=([], []))
+    def test_get_messages(self, *_):
+        other = User.objects.create_user('other', password='pw')
+        for size in LIST_SIZES:
+            with self.subTest(size=size):
+                Message.objects.all().delete()
+                Message.objects.bulk_create(
+                    Message(sender=other if i % 2 else self.me, receiver=self.me if i % 2 else other,
+                            content=f'msg {i}', saved_by_sender=True, saved_by_receiver=True)
+                    for i in range(size)
+                )
+
+                # The other user, then the vault page
+                with self.assertNumQueries(2):
+                    response = self.client.get('/api/get-messages/', {'user_id': other.id, 'limit': 500})
+                self.assertEqual(response.data['count'], min(size, 500))
+
+    @mock.patch('chat.views.get_conversations_messages')
+    def test_sync(self, get_conversations_messages):
+        get_conversations_messages.side_effect = lambda user_id, cursors, limit: {
+            friend_id: ([{'id': 1, 'sender_id': friend_id, 'receiver_id': user_id, 'content': 'hi'}], [])
+            for friend_id in cursors
+        }
+        for size in LIST_SIZES:
+            with self.subTest(size=size):
+                Friend.objects.filter(user=self.me).delete()
+                friends = create_users(f'sync{size}-', size)
+                Friend.objects.bulk_create(Friend(user=self.me, friend=friend) for friend in friends)
+
+                # Friends, vault, pending requests, one-time key count
+                with self.assertNumQueries(4):
+                    response = self.client.post('/api/sync/', {}, format='json')
+                self.assertEqual(len(response.data['friends']), size)
+                self.assertEqual(len(response.data['conversations']), size)
+                self.assertEqual(
+                    response.data['conversations'][str(friends[0].id)]['messages'][0]['sender_username'],
+                    friends[0].username,
+                )
+                get_conversations_messages.assert_called_once()
+                get_conversations_messages.reset_mock()
+
+
+@mock.patch('chat.views.remove_temp_message')
+class SaveToVaultTests(TestCase):
+    """Vault rows are keyed by ephemeral id when the client sends one, else by content hash."""
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+        self.client = APIClient()
+
+    def save(self, user, other, message_id=None, **extra):
+        self.client.force_authenticate(user)
+        data = {'other_user_id': other.id, 'content': 'same ciphertext', **extra}
+        if message_id is not None:
+            data['message_id'] = message_id
+        return self.client.post('/api/save-to-vault/', data, format='json')
+
+    def test_both_sides_share_one_row(self, _):
+        self.save(self.bob, self.alice, message_id=1)
+        self.save(self.alice, self.bob, message_id=1, is_sender=True)
+        self.assertEqual(
+            list(Message.objects.values_list('ephemeral_id', 'saved_by_sender', 'saved_by_receiver')),
+            [(1, True, True)],
+        )
+
+    def test_identical_ciphertexts_stay_apart(self, _):
+        self.save(self.bob, self.alice, message_id=1)
+        self.save(self.bob, self.alice, message_id=2)
+        self.assertEqual(sorted(Message.objects.values_list('ephemeral_id', flat=True)), [1, 2])
+
+    def test_without_id_falls_back_to_content_hash(self, remove):
+        self.save(self.bob, self.alice, message_id=1)
+        self.save(self.alice, self.bob, is_sender=True)
+        self.assertEqual(Message.objects.count(), 1)
+        remove.assert_called_with(self.alice.id, self.bob.id, 'same ciphertext', None)
+
+    def test_each_side_saves_its_own_encryption(self, remove):
+        self.save(self.bob, self.alice, message_id=1, content='bob vault copy')
+        self.save(self.alice, self.bob, message_id=1, is_sender=True, content='alice vault copy')
+        self.assertEqual(
+            list(Message.objects.values_list('ephemeral_id', 'saved_by_sender', 'saved_by_receiver')),
+            [(1, True, True)],
+        )
+        remove.assert_called_with(self.alice.id, self.bob.id, 'alice vault copy', 1)
+
+    def test_row_saved_without_id_is_adopted(self, _):
+        self.save(self.bob, self.alice)
+        self.save(self.alice, self.bob, message_id=3, is_sender=True)
+        self.assertEqual(
+            list(Message.objects.values_list('ephemeral_id', 'saved_by_sender', 'saved_by_receiver')),
+            [(3, True, True)],
+        )
+
+    def test_only_the_savers_flag_is_written(self, _):
+        self.save(self.bob, self.alice, message_id=1)
+        with CaptureQueriesContext(connection) as queries:
+            self.save(self.alice, self.bob, message_id=1, is_sender=True)
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('saved_by_sender', updates[0])
+        self.assertNotIn('saved_by_receiver', updates[0])
+
+    def test_content_must_be_a_string(self, remove):
+        self.assertEqual(self.save(self.bob, self.alice, content=['same ciphertext']).status_code, 400)
+        self.assertFalse(Message.objects.exists())
+        remove.assert_not_called()
+
+
+@mock.patch('chat.views.remove_temp_messages')
+class BulkVaultTests(TestCase):
+    def setUp(self):
+        self.me = User.objects.create_user('me', password='pw')
+        self.others = create_users('other', 3)
+        self.client = APIClient()
+        self.client.force_authenticate(self.me)
+
+    def save(self, messages):
+        return self.client.post('/api/bulk-save-to-vault/', {'messages': messages}, format='json')
+
+    def test_save(self, remove_temp_messages):
+        other = self.others[0]
+        # Already saved by its sender
+        shared = Message.objects.create(sender=other, receiver=self.me, content='shared', ephemeral_id=1, saved_by_sender=True)
+        response = self.save([
+            {'other_user_id': other.id, 'content': 'shared', 'message_id': 1},
+            {'other_user_id': other.id, 'content': 'new', 'message_id': 2},
+            {'other_user_id': other.id, 'content': 'new', 'message_id': 2},
+            {'other_user_id': other.id, 'content': 'mine', 'is_sender': True},
+            {'other_user_id': self.others[-1].id + 1, 'content': 'nobody'},
+            {'content': 'no user'},
+            {'other_user_id': other.id, 'content': 42},
+        ])
+        results = response.data['results']
+        self.assertEqual([result['status'] for result in results], [201, 201, 201, 201, 404, 400, 400])
+        self.assertEqual(results[0]['message_id'], shared.id)
+        self.assertEqual(results[1]['message_id'], results[2]['message_id'])
+        self.assertEqual(
+            set(Message.objects.values_list('content', 'sender_id', 'saved_by_sender', 'saved_by_receiver')),
+            {('shared', other.id, True, True), ('new', other.id, False, True), ('mine', self.me.id, True, False)},
+        )
+        self.assertEqual(Message.objects.get(content='mine').content_hash, Message.hash_content('mine'))
+        remove_temp_messages.assert_called_once_with([
+            (other.id, self.me.id, 'shared', 1), (other.id, self.me.id, 'new', 2),
+            (other.id, self.me.id, 'new', 2), (self.me.id, other.id, 'mine', None),
+        ])
+
+    def test_save_query_count_is_fixed(self, remove_temp_messages):
+        counts = []
+        for size in (1, 100):
+            Message.objects.create(sender=self.others[1], receiver=self.me, content='old', ephemeral_id=0)
+            with CaptureQueriesContext(connection) as queries:
+                self.save([
+                    {'other_user_id': self.others[i % 3].id, 'content': f'msg {i}', 'message_id': i}
+                    for i in range(size)
+                ])
+            counts.append(len(queries))
+            Message.objects.all().delete()
+        self.assertEqual(counts[0], counts[1])
+
+    def test_delete(self, remove_temp_messages):
+        other = self.others[0]
+        both, mine, theirs = Message.objects.bulk_create([
+            Message(sender=other, receiver=self.me, content='both', saved_by_sender=True, saved_by_receiver=True),
+            Message(sender=self.me, receiver=other, content='mine', saved_by_sender=True),
+            Message(sender=other, receiver=self.me, content='theirs', saved_by_sender=True),
+        ])
+        # Lookup, then one UPDATE per side and the DELETE in a savepoint
+        with self.assertNumQueries(6):
+            response = self.client.delete('/api/bulk-delete-from-vault/', {
+                'message_ids': [both.id, mine.id, theirs.id, 0],
+            }, format='json')
+        self.assertEqual([result['status'] for result in response.data['results']], [200, 200, 403, 404])
+        self.assertEqual(
+            set(Message.objects.values_list('content', 'saved_by_sender', 'saved_by_receiver')),
+            {('both', True, False), ('theirs', True, False)},
+        )
+
+
+class VaultPagingTests(TestCase):
+    def setUp(self):
+        self.me = User.objects.create_user('me', password='pw')
+        other = User.objects.create_user('other', password='pw')
+        Message.objects.bulk_create(
+            Message(sender=self.me if i % 2 else other, receiver=other if i % 2 else self.me, content=f'msg {i}',
+                    saved_by_sender=i % 2 == 1, saved_by_receiver=i % 2 == 0 or i % 5 == 0)
+            for i in range(40)
+        )
+        # Runs of equal timestamps, so pages have to break ties on id
+        now = timezone.now()
+        for message_id in Message.objects.values_list('id', flat=True):
+            Message.objects.filter(id=message_id).update(timestamp=now + timedelta(seconds=message_id // 4))
+        self.saved = list(
+            Message.objects.saved_by(self.me).order_by('-timestamp', '-id').values_list('id', flat=True)
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.me)
+
+    def test_pages_cover_the_vault_once(self):
+        ids, params = [], {'limit': 7}
+        while True:
+            response = self.client.get('/api/list-vault/', params)
+            ids += [msg['id'] for msg in response.data['messages']]
+            if not response.data['has_more']:
+                break
+            params['before'] = response.data['cursors']['before']
+        self.assertEqual(ids, self.saved)
+
+    def test_bad_cursor(self):
+        for cursor in ('latest', '99999999999999999999-1', '253402300800000000-1', '1-99999999999999999999'):
+            self.assertEqual(self.client.get('/api/list-vault/', {'before': cursor}).status_code, 400)
+
+    def test_export_streams_ndjson(self):
+        response = self.client.get('/api/export-vault/')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], self.saved[::-1])
+
+    async def test_async_export(self):
+        token = await sync_to_async(lambda: str(RefreshToken.for_user(self.me).access_token))()
+        response = await AsyncClient().get('/api/async/export-vault/', headers={'Authorization': f'Bearer {token}'})
+        lines = b''.join([chunk async for chunk in response.streaming_content]).decode().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], self.saved[::-1])
+
+
+@skipUnless(connection.vendor == 'postgresql', 'EXPLAIN plans are PostgreSQL-specific')
+class VaultQueryPlanTests(TestCase):
+    """
+    The vault queries must stay on the indexes declared in Message.Meta (all named
+    chat_msg_*), not a sequential scan or the plain foreign key indexes. Sequential
+    scans are disabled so the planner only picks one when no usable index exists.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='pw')
+        cls.bob = User.objects.create_user('bob', password='pw')
+        Message.objects.create(sender=cls.alice, receiver=cls.bob, content='hello', saved_by_sender=True)
+
+    def assertUsesIndex(self, queryset):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = queryset.explain()
+        self.assertNotIn('Seq Scan on chat_message', plan)
+        self.assertRegex(plan, r'chat_msg_\w+')
+
+    def test_conversation_page(self):
+        self.assertUsesIndex(Message.objects.saved_in_conversation(self.alice, self.bob).order_by('-id')[:101])
+
+    def test_vault_listing(self):
+        self.assertUsesIndex(Message.objects.saved_by(self.alice).order_by('-timestamp'))
+
+    def test_vault_page(self):
+        message = Message.objects.get()
+        self.assertUsesIndex(Message.objects.vault_page(self.alice, ['id'], (message.timestamp, message.id), 101))
+
+    def test_duplicate_lookup(self):
+        self.assertUsesIndex(Message.objects.with_content(self.alice, self.bob, 'hello'))
+
+
+@mock.patch('chat.views.save_temp_message', return_value={'id': 1, 'timestamp': 'now'})
+@mock.patch('chat.cache.redis_client')
+class FriendCacheTests(TestCase):
+    def setUp(self):
+        local_friends.clear()
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+        self.carol = User.objects.create_user('carol', password='pw')
+        Profile.objects.create(user=self.alice, user_name='alice-name')
+        Friend.objects.create(user=self.alice, friend=self.bob)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def send(self, receiver):
+        return self.client.post('/api/send-message/', {'receiver_id': receiver.id, 'content': 'hi'}, format='json')
+
+    def test_send_is_authorised_without_queries(self, redis, _):
+        redis.smembers.return_value = set()  # Redis miss: loaded from the database once
+        with self.assertNumQueries(1):
+            self.assertEqual(self.send(self.bob).status_code, 201)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.send(self.bob).status_code, 201)
+
+    def test_loaded_from_redis(self, redis, _):
+        redis.smembers.return_value = {b'0', str(self.bob.id).encode()}
+        with self.assertNumQueries(0):
+            self.assertEqual(self.send(self.bob).status_code, 201)
+        redis.scard.return_value = 2
+        self.assertEqual(self.client.get('/api/profile/').data['friend_count'], 1)
+
+    def test_count_skips_the_local_cache(self, redis, _):
+        # Another worker made a friendship: this worker's LRU still has the old set
+        local_friends.set(self.alice.id, frozenset({self.bob.id}))
+        redis.scard.return_value = 3
+        self.assertEqual(self.client.get('/api/profile/').data['friend_count'], 2)
+
+    def test_accepting_a_request_invalidates(self, redis, _):
+        redis.smembers.return_value = set()
+        self.assertEqual(self.send(self.carol).status_code, 403)
+
+        request = FriendRequest.objects.create(from_user=self.carol, to_user=self.alice)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/accept-request/', {'request_id': request.id}, format='json')
+        redis.delete.assert_called_with(f'friends:{self.carol.id}', f'friends:{self.alice.id}')
+
+        self.assertEqual(self.send(self.carol).status_code, 201)
+        redis.scard.return_value = 0  # Dropped by the invalidation: loaded from the database
+        self.assertEqual(self.client.get('/api/profile/').data['friend_count'], 2)
+
+    def test_deleting_a_friend_invalidates(self, redis, _):
+        redis.smembers.return_value = set()
+        self.assertEqual(self.send(self.bob).status_code, 201)
+
+        bob_id = self.bob.id
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bob.delete()  # Cascades to the Friend row
+        redis.delete.assert_any_call(f'friends:{self.alice.id}', f'friends:{bob_id}')
+
+        self.assertEqual(self.client.post('/api/send-message/', {'receiver_id': bob_id, 'content': 'hi'}, format='json').status_code, 403)
+        redis.scard.return_value = 0
+        self.assertEqual(self.client.get('/api/profile/').data['friend_count'], 0)
+
+
+@mock.patch('chat.cache.redis_client')
+class SendMessagesTests(TestCase):
+    def setUp(self):
+        local_friends.clear()
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.friends = create_users('friend', 3)
+        self.stranger = User.objects.create_user('stranger', password='pw')
+        Friend.objects.bulk_create(Friend(user=self.alice, friend=friend) for friend in self.friends)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    @mock.patch('chat.views.save_temp_messages')
+    def test_per_item_results(self, save_temp_messages, redis):
+        # A Redis miss the first time, then the set the first load stored
+        redis.smembers.side_effect = [set(), {b'0', *(str(friend.id).encode() for friend in self.friends)}]
+        save_temp_messages.side_effect = lambda sender_id, messages: [
+            {'id': i, 'timestamp': 'now'} for i, _ in enumerate(messages, 1)
+        ]
+        batch = [{'receiver_id': friend.id, 'content': f'hi {friend.id}'} for friend in self.friends * 100]
+        batch += [{'receiver_id': self.stranger.id, 'content': 'hi'}, {'receiver_id': 'x', 'content': 'hi'}, {}]
+        # Not ids, although int() would take them for friends[0]
+        batch += [{'receiver_id': True, 'content': 'hi'}, {'receiver_id': self.friends[0].id + 0.9, 'content': 'hi'}]
+        batch += [{'receiver_id': self.friends[0].id, 'content': 'x' * (settings.CHAT_MESSAGE_MAX_BYTES + 1)}]
+        batch += [{'receiver_id': self.friends[0].id, 'content': 12345}, {'receiver_id': self.friends[0].id, 'content': ['hi']}]
+
+        # The friend set, then the stranger confirmed as not a friend
+        with self.assertNumQueries(2):
+            response = self.client.post('/api/send-messages/', {'messages': batch}, format='json')
+
+        self.assertEqual((response.data['sent'], response.data['failed']), (300, 8))
+        self.assertEqual([r['status'] for r in response.data['results'][-9:]], [201, 403, 400, 400, 400, 400, 413, 400, 400])
+        self.assertEqual(response.data['results'][-5]['error'], 'receiver_id must be an integer')
+        self.assertEqual(response.data['results'][-1]['error'], 'content must be a string')
+        self.assertEqual(response.data['results'][299]['message_data']['id'], 300)
+        save_temp_messages.assert_called_once()
+        self.assertEqual(len(save_temp_messages.call_args.args[1]), 300)
+
+    @mock.patch('chat.views.save_temp_message')
+    def test_content_must_be_a_string(self, save_temp_message, redis):
+        response = self.client.post('/api/send-message/', {'receiver_id': self.friends[0].id, 'content': 7}, format='json')
+        self.assertEqual(response.status_code, 400)
+        save_temp_message.assert_not_called()
+
+    @mock.patch('chat.views.save_temp_message')
+    def test_receiver_id_must_be_an_integer(self, save_temp_message, redis):
+        for receiver_id in (True, self.friends[0].id + 0.9, str(self.friends[0].id)):
+            response = self.client.post('/api/send-message/', {'receiver_id': receiver_id, 'content': 'hi'}, format='json')
+            self.assertEqual(response.status_code, 400)
+        save_temp_message.assert_not_called()
+
+    def test_batch_size_is_capped(self, redis):
+        batch = [{'receiver_id': self.friends[0].id, 'content': 'hi'}] * 501
+        response = self.client.post('/api/send-messages/', {'messages': batch}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+@mock.patch('chat.cache.redis_client')
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        local_friends.clear()
+        user_active.clear()
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+        Friend.objects.create(user=self.alice, friend=self.bob)
+        self.client = AsyncClient()
+        self.auth = {'Authorization': f'Bearer {RefreshToken.for_user(self.alice).access_token}'}
+
+    @mock.patch('chat.async_views.asave_temp_message', new_callable=mock.AsyncMock)
+    async def test_send_message(self, asave_temp_message, redis):
+        redis.smembers.return_value = {b'0', str(self.bob.id).encode()}
+        asave_temp_message.return_value = {'id': 7, 'timestamp': 'now'}
+
+        response = await self.client.post(
+            '/api/async/send-message/', {'receiver_id': self.bob.id, 'content': 'hi'},
+            content_type='application/json', headers=self.auth,
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['message_data']['id'], 7)
+        asave_temp_message.assert_awaited_once_with(self.alice.id, self.bob.id, 'hi')
+
+        response = await self.client.post(
+            '/api/async/send-message/', {'receiver_id': self.bob.id, 'content': {'text': 'hi'}},
+            content_type='application/json', headers=self.auth,
+        )
+        self.assertEqual(response.status_code, 400)
+
+        response = await self.client.post(
+            '/api/async/send-message/', {'receiver_id': self.bob.id, 'content': 'hi'}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 401)
+
+    @mock.patch('chat.cache.async_redis_client', new_callable=mock.AsyncMock)
+    @mock.patch('chat.async_views.apublish_event', new_callable=mock.AsyncMock)
+    async def test_query_keys(self, apublish_event, aredis, redis):
+        aredis.get.return_value = None
+        await UserKeys.objects.acreate(user=self.bob, identity_key='identity', signing_key='signing')
+        await OneTimeKeys.objects.acreate(user=self.bob, key_id='key0', key_value='value0')
+
+        response = await self.client.get('/api/async/keys/query/bob/', headers=self.auth)
+        self.assertEqual(response.json()['oneTimeKeyId'], 'key0')
+        # The directory entry is filled through the asyncio client, unless another writer got there first
+        (key, entry), options = aredis.set.await_args
+        self.assertEqual(key, 'userkeys:bob')
+        self.assertEqual(json.loads(entry)['identity_key'], 'identity')
+        self.assertTrue(options['nx'])
+        redis.get.assert_not_called()
+
+        aredis.get.return_value = entry
+        response = await self.client.get('/api/async/keys/query/bob/', headers=self.auth)
+        self.assertEqual(response.status_code, 400)
+        apublish_event.assert_awaited_once()
+
+
+@skipUnless(fakeredis, 'fakeredis (with Lua support) is not installed')
+class RealtimeTests(TestCase):
+    """The WebSocket application driven with ASGI events, its pub/sub on fakeredis"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+        self.redis = fakeredis.FakeAsyncRedis()
+        self.hub = realtime.EventHub()
+        for target, value in (('chat.realtime.async_redis_client', self.redis), ('chat.realtime.hub', self.hub)):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def close(self, *sockets):
+        """Disconnect the sockets, then stop the hub's reader so it does not outlive the test's loop"""
+        for task, received, _ in sockets:
+            received.put_nowait({'type': 'websocket.disconnect'})
+            await asyncio.wait_for(task, 5)
+        self.hub._reader.cancel()
+
+    def connect(self, token):
+        """Open a socket: returns the application task, its receive queue and what it sent"""
+        received, sent = asyncio.Queue(), asyncio.Queue()
+        received.put_nowait({'type': 'websocket.connect'})
+        scope = {'type': 'websocket', 'path': realtime.WEBSOCKET_PATH, 'query_string': f'token={token}'.encode()}
+        task = asyncio.create_task(realtime.websocket_application(scope, received.get, sent.put))
+        return task, received, sent
+
+    async def open(self, user):
+        """connect() as `user`, once the hub has subscribed to their channel"""
+        socket = self.connect(RefreshToken.for_user(user).access_token)
+        self.assertEqual(await asyncio.wait_for(socket[2].get(), 5), {'type': 'websocket.accept'})
+        while redis_util.events_channel(user.id) not in self.hub._queues:
+            await asyncio.sleep(0.01)
+        return socket
+
+    async def test_rejected_token_closes_the_socket(self):
+        task, _, sent = self.connect('not-a-token')
+        await asyncio.wait_for(task, 5)
+        self.assertEqual(sent.get_nowait(), {'type': 'websocket.close', 'code': 4401})
+        self.assertEqual(dict(self.hub._queues), {})
+
+    async def test_message_reaches_only_the_receiver(self):
+        alice, bob = await self.open(self.alice), await self.open(self.bob)
+
+        event = json.dumps({'type': 'message', 'message': {'sender_id': self.alice.id, 'receiver_id': self.bob.id}})
+        await self.redis.publish(redis_util.events_channel(self.bob.id), event)
+        self.assertEqual(await asyncio.wait_for(bob[2].get(), 5), {'type': 'websocket.send', 'text': event})
+
+        await self.close(alice, bob)
+        self.assertTrue(alice[2].empty())
+
+    async def test_disconnect_removes_the_subscription(self):
+        socket = await self.open(self.bob)
+        channel = redis_util.events_channel(self.bob.id)
+        self.assertEqual(await self.redis.pubsub_numsub(channel), [(channel.encode(), 1)])
+
+        await self.close(socket)
+        self.assertEqual(dict(self.hub._queues), {})
+        self.assertEqual(await self.redis.pubsub_numsub(channel), [(channel.encode(), 0)])
+
+
+@mock.patch('chat.views.get_unread', return_value=[])
+class TokenAuthenticationTests(TestCase):
+    def setUp(self):
+        user_active.clear()
+        self.me = User.objects.create_user('me', password='pw')
+        Profile.objects.create(user=self.me, user_name='me-name')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.me).access_token}')
+
+    def test_no_user_query_once_active_status_is_cached(self, get_unread):
+        # The first request loads the user to check it is active; after that the token is enough
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/api/unread/').status_code, 200)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/api/unread/').status_code, 200)
+        get_unread.assert_called_with(self.me.id, None)
+
+    def test_deactivated_user_is_refused_when_cache_expires(self, get_unread):
+        self.client.get('/api/unread/')
+        User.objects.filter(id=self.me.id).update(is_active=False)
+        self.assertEqual(self.client.get('/api/unread/').status_code, 200)
+
+        user_active.clear()
+        self.assertEqual(self.client.get('/api/unread/').status_code, 401)
+
+    @mock.patch('chat.views.friend_count', return_value=0)
+    def test_username_comes_from_token(self, friend_count, get_unread):
+        self.client.get('/api/unread/')
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/profile/')
+        self.assertEqual(response.data['username'], 'me')
+
+        # Tokens issued without the claim still work, loading the user when it is needed
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens.RefreshToken.for_user(self.me).access_token}')
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/profile/')
+        self.assertEqual(response.data['username'], 'me')
+
+    def test_login_token_carries_username(self, get_unread):
+        response = self.client.post('/api/login/', {'username': 'me', 'password': 'pw'}, format='json')
+        self.assertEqual(tokens.AccessToken(response.data['access'])['username'], 'me')
+
+
+class UploadKeysTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch('chat.cache.redis_client')
+        patcher.start().get.return_value = None
+        self.addCleanup(patcher.stop)
+        self.me = User.objects.create_user('me', password='pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.me)
+
+    def upload(self, key_ids):
+        return self.client.post('/api/keys/upload/', {
+            'identityKey': 'identity',
+            'signingKey': 'signing',
+            'oneTimeKeys': {key_id: f'value-{key_id}' for key_id in key_ids},
+        }, format='json')
+
+    def test_bulk_upload_query_count(self):
+        self.upload(['key0'])
+        # Identity keys (4 with the savepoint), one INSERT ... ON CONFLICT, pool count.
+        # Elsewhere the existing ids are read first, in a savepoint, and SQLite caps
+        # bound parameters, so Django splits its INSERT into batches of 199 rows.
+        queries = 6 if connection.vendor == 'postgresql' else 14
+        with self.assertNumQueries(queries):
+            response = self.upload([f'key{i}' for i in range(1000)])
+        self.assertEqual(response.data['oneTimeKeysAdded'], 999)
+        self.assertEqual(response.data['availableOneTimeKeys'], 1000)
+        self.assertEqual(OneTimeKeys.objects.count(), 1000)
+
+        response = self.upload(['key999', 'key1000'])
+        self.assertEqual(response.data['oneTimeKeysAdded'], 1)
+        self.assertEqual(OneTimeKeys.objects.get(key_id='key1000').key_value, 'value-key1000')
+
+    def test_replenish_watermarks(self):
+        response = self.upload([f'key{i}' for i in range(5)])
+        self.assertTrue(response.data['replenish'])
+        self.assertEqual(response.data['replenishCount'], 95)
+
+        self.upload([f'key{i}' for i in range(50)])
+        response = self.client.get('/api/keys/me/')
+        self.assertEqual(response.data['availableOneTimeKeys'], 50)
+        self.assertFalse(response.data['replenish'])
+        self.assertEqual(response.data['replenishCount'], 0)
+
+
+@mock.patch('chat.views.publish_event')
+class ClaimOneTimeKeyTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch('chat.cache.redis_client')
+        patcher.start().get.return_value = None
+        self.addCleanup(patcher.stop)
+        self.bob = User.objects.create_user('bob', password='pw')
+        UserKeys.objects.create(user=self.bob, identity_key='identity', signing_key='signing')
+        OneTimeKeys.objects.bulk_create(
+            OneTimeKeys(user=self.bob, key_id=f'key{i}', key_value=f'value{i}') for i in range(3)
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('alice', password='pw'))
+
+    def test_each_key_is_issued_once(self, publish_event):
+        issued = [self.client.get('/api/keys/query/bob/').data['oneTimeKeyId'] for _ in range(3)]
+        self.assertCountEqual(issued, ['key0', 'key1', 'key2'])
+        self.assertFalse(OneTimeKeys.objects.filter(is_used=False).exists())
+
+        response = self.client.get('/api/keys/query/bob/')
+        self.assertEqual(response.status_code, 400)
+
+        # The owner is told to replenish after every claim below the low watermark
+        self.assertEqual(publish_event.call_count, 3)
+        publish_event.assert_called_with(self.bob.id, {
+            'type': 'otk_low', 'availableOneTimeKeys': 0, 'replenish': True, 'replenishCount': 100,
+        })
+
+
+@mock.patch('chat.views.publish_events')
+class ClaimKeysTests(TestCase):
+    def setUp(self):
+        self.users = create_users('claim-', 30)
+        UserKeys.objects.bulk_create(
+            UserKeys(user=user, identity_key=f'identity-{user.id}', signing_key='signing') for user in self.users[:-1]
+        )
+        OneTimeKeys.objects.bulk_create(
+            OneTimeKeys(user=user, key_id=f'key{i}', key_value='value') for user in self.users[:-2] for i in range(2)
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('alice', password='pw'))
+
+    def claim(self, users):
+        return self.client.post('/api/keys/claim/', {'users': users}, format='json')
+
+    def test_per_user_results(self, publish_events):
+        no_otks, no_keys = self.users[-2], self.users[-1]
+        response = self.claim([self.users[0].username, self.users[1].id, no_otks.username, no_keys.id, 'nobody', 1.5])
+        self.assertEqual([result['status'] for result in response.data['results']], [200, 200, 400, 404, 404, 400])
+        self.assertEqual(response.data['results'][1]['identityKey'], f'identity-{self.users[1].id}')
+        self.assertEqual(response.data['results'][1]['oneTimeKeyId'], 'key0')
+        self.assertEqual((response.data['claimed'], response.data['failed']), (2, 4))
+        self.assertEqual(OneTimeKeys.objects.filter(is_used=True).count(), 2)
+        publish_events.assert_called_once()
+        self.assertCountEqual(publish_events.call_args.args[0], [
+            (user.id, {'type': 'otk_low', 'availableOneTimeKeys': 1, 'replenish': True, 'replenishCount': 99})
+            for user in self.users[:2]
+        ])
+
+    def test_user_listed_twice_gets_one_key(self, publish_events):
+        user = self.users[0]
+        response = self.claim([user.username, user.id, user.username])
+        self.assertEqual([result['status'] for result in response.data['results']], [200, 400, 400])
+        self.assertEqual(response.data['results'][1]['error'], 'User listed more than once')
+        self.assertEqual(OneTimeKeys.objects.filter(is_used=True).count(), 1)
+
+    @skipUnless(connection.vendor == 'postgresql', 'Batch claiming is one statement on PostgreSQL only')
+    def test_query_count_is_fixed(self, publish_events):
+        for size in (1, 28):
+            with self.subTest(size=size), self.assertNumQueries(3):
+                response = self.claim([user.username for user in self.users[:size]])
+            self.assertEqual(response.data['claimed'], size)
+
+
+class KeyDirectoryTests(TestCase):
+    def setUp(self):
+        # A dict standing in for Redis GET and SET
+        self.cache = {}
+        patcher = mock.patch('chat.cache.redis_client')
+        redis = patcher.start()
+        self.addCleanup(patcher.stop)
+        redis.get.side_effect = self.cache.get
+        redis.set.side_effect = lambda key, value, ex, nx=False: (
+            self.cache.setdefault(key, value) if nx else self.cache.__setitem__(key, value)
+        )
+        redis.delete.side_effect = lambda *keys: [self.cache.pop(key, None) for key in keys]
+        self.bob = User.objects.create_user('bob', password='pw')
+        UserKeys.objects.create(user=self.bob, identity_key='identity', signing_key='signing')
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+
+    @mock.patch('chat.views.publish_event')
+    def test_query_keys_reads_identity_keys_from_cache(self, publish_event):
+        OneTimeKeys.objects.bulk_create(
+            OneTimeKeys(user=self.bob, key_id=f'key{i}', key_value=f'value{i}') for i in range(2)
+        )
+        self.client.get('/api/keys/query/bob/')
+        # Only the claim (a SELECT and an UPDATE outside PostgreSQL) and the pool count
+        with self.assertNumQueries(2 if connection.vendor == 'postgresql' else 3):
+            response = self.client.get('/api/keys/query/bob/')
+        self.assertEqual(response.data['identityKey'], 'identity')
+        self.assertEqual(response.data['oneTimeKeyId'], 'key1')
+
+    def test_upload_writes_through(self):
+        self.client.get('/api/keys/identity/bob/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/keys/upload/', {'identityKey': 'new', 'signingKey': 'signing'}, format='json')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/keys/identity/bob/')
+        self.assertEqual(response.data['identityKey'], 'new')
+
+    def test_conditional_get(self):
+        response = self.client.get('/api/keys/identity/bob/')
+        etag = response['ETag']
+        response = self.client.get('/api/keys/identity/bob/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/keys/upload/', {'identityKey': 'new', 'signingKey': 'signing'}, format='json')
+        response = self.client.get('/api/keys/identity/bob/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_unknown_user(self):
+        self.assertEqual(self.client.get('/api/keys/identity/nobody/').status_code, 404)
+
+    def test_deleting_keys_or_user_drops_the_entry(self):
+        self.client.get('/api/keys/identity/bob/')
+        with self.captureOnCommitCallbacks(execute=True):
+            UserKeys.objects.filter(user=self.bob).delete()
+        self.assertEqual(self.client.get('/api/keys/identity/bob/').status_code, 404)
+
+        UserKeys.objects.create(user=self.bob, identity_key='identity', signing_key='signing')
+        self.client.get('/api/keys/identity/bob/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bob.delete()
+        # The username signs up again: none of the old user's keys are served
+        self.client.force_authenticate(User.objects.create_user('bob', password='pw'))
+        self.assertEqual(self.client.get('/api/keys/identity/bob/').status_code, 404)
+
+
+class GarbageCollectOneTimeKeysTests(TestCase):
+    def test_deletes_only_used_keys(self):
+        bob = User.objects.create_user('bob', password='pw')
+        OneTimeKeys.objects.bulk_create(
+            OneTimeKeys(user=bob, key_id=f'key{i}', key_value=f'value{i}', is_used=i < 25) for i in range(30)
+        )
+        out = StringIO()
+        call_command('gc_one_time_keys', batch_size=10, stdout=out)
+        self.assertIn('Reclaimed 25 used one-time keys', out.getvalue())
+        self.assertEqual(OneTimeKeys.objects.count(), 5)
+        self.assertFalse(OneTimeKeys.objects.filter(is_used=True).exists())
+
+
+@skipUnless(connection.vendor == 'postgresql', 'SKIP LOCKED claiming is PostgreSQL-specific')
+class ConcurrentClaimOneTimeKeyTests(TransactionTestCase):
+    """Many threads draining one user's pool must never receive the same key, nor count one uploaded twice."""
+
+    THREADS = 16
+    KEYS = 400
+
+    def test_no_key_is_issued_twice(self):
+        bob = User.objects.create_user('bob', password='pw')
+        OneTimeKeys.objects.bulk_create(
+            OneTimeKeys(user=bob, key_id=f'key{i}', key_value=f'value{i}') for i in range(self.KEYS)
+        )
+        claimed = [[] for _ in range(self.THREADS)]
+        start = threading.Barrier(self.THREADS)
+
+        def drain(results):
+            try:
+                start.wait()
+                while (otk := OneTimeKeys.objects.claim(bob)) is not None:
+                    results.append(otk.key_id)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=drain, args=(results,)) for results in claimed]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        issued = [key_id for results in claimed for key_id in results]
+        self.assertEqual(len(issued), self.KEYS)
+        self.assertEqual(len(set(issued)), self.KEYS)
+        self.assertFalse(OneTimeKeys.objects.filter(is_used=False).exists())
+
+    def test_no_key_is_issued_twice_in_batches(self):
+        users = create_users('claimant-', 10)
+        OneTimeKeys.objects.bulk_create(
+            OneTimeKeys(user=user, key_id=f'key{i}', key_value=f'value{i}')
+            for user in users for i in range(self.KEYS // len(users))
+        )
+        claimed = [[] for _ in range(self.THREADS)]
+        start = threading.Barrier(self.THREADS)
+
+        def drain(results):
+            try:
+                start.wait()
+                while keys := OneTimeKeys.objects.claim_many([user.id for user in users]):
+                    results.extend(otk.id for otk in keys.values())
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=drain, args=(results,)) for results in claimed]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        issued = [otk_id for results in claimed for otk_id in results]
+        self.assertEqual(len(issued), self.KEYS)
+        self.assertEqual(len(set(issued)), self.KEYS)
+        self.assertFalse(OneTimeKeys.objects.filter(is_used=False).exists())
+
+    def test_concurrent_uploads_count_each_key_once(self):
+        bob = User.objects.create_user('bob', password='pw')
+        keys = {f'key{i}': f'value{i}' for i in range(self.KEYS)}
+        added = [0] * self.THREADS
+        start = threading.Barrier(self.THREADS)
+
+        def upload(index):
+            try:
+                start.wait()
+                added[index] = OneTimeKeys.objects.add(bob, keys)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=upload, args=(index,)) for index in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sum(added), self.KEYS)
+        self.assertEqual(OneTimeKeys.objects.filter(user=bob).count(), self.KEYS)
+
+
+@override_settings(METRICS_SAMPLE_RATE=1.0, METRICS_SERVER_TIMING=True, METRICS_FLUSH_INTERVAL=3600, METRICS_TOKEN='')
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.me = User.objects.create_user('me', password='pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.me)
+        self.registry = Registry()
+        patcher = mock.patch('chat.metrics.registry', self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sample(self, name, **labels):
+        return self.registry._counts[(name, tuple(sorted(labels.items())))]
+
+    def test_records_request(self):
+        response = self.client.get('/api/list-friends/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+
+        labels = {'route': 'api/list-friends/', 'method': 'GET'}
+        self.assertEqual(self.sample('chat_http_requests_total', status='200', **labels), 1)
+        self.assertEqual(self.sample('chat_http_sql_queries_total', **labels), 1)
+        self.assertEqual(self.sample('chat_http_request_duration_seconds_bucket', le='+Inf', **labels), 1)
+        self.assertEqual(self.sample('chat_http_response_bytes_total', **labels), len(response.content))
+
+    @override_settings(METRICS_SAMPLE_RATE=0.0)
+    def test_unsampled_request_is_only_timed(self):
+        response = self.client.get('/api/list-friends/')
+        self.assertNotIn('Server-Timing', response)
+
+        labels = {'route': 'api/list-friends/', 'method': 'GET'}
+        self.assertEqual(self.sample('chat_http_requests_total', status='200', **labels), 1)
+        self.assertEqual(self.sample('chat_http_sampled_requests_total', **labels), 0)
+
+    def test_render(self):
+        labels = (('method', 'GET'), ('route', 'api/unread/'))
+        text = render({
+            ('chat_http_request_duration_seconds_bucket', labels + (('le', '10.0'),)): 2.0,
+            ('chat_http_request_duration_seconds_bucket', labels + (('le', '+Inf'),)): 2.0,
+            ('chat_http_request_duration_seconds_bucket', labels + (('le', '0.005'),)): 1.0,
+            ('chat_http_request_duration_seconds_count', labels): 2.0,
+            ('chat_http_requests_total', labels + (('status', '200'),)): 2.0,
+        })
+        self.assertEqual(text.splitlines(), [
+            '# HELP chat_http_request_duration_seconds Request wall time',
+            '# TYPE chat_http_request_duration_seconds histogram',
+            'chat_http_request_duration_seconds_bucket{method="GET",route="api/unread/",le="0.005"} 1.0',
+            'chat_http_request_duration_seconds_bucket{method="GET",route="api/unread/",le="10.0"} 2.0',
+            'chat_http_request_duration_seconds_bucket{method="GET",route="api/unread/",le="+Inf"} 2.0',
+            'chat_http_request_duration_seconds_count{method="GET",route="api/unread/"} 2.0',
+            '# HELP chat_http_requests_total Requests by route, method and status',
+            '# TYPE chat_http_requests_total counter',
+            'chat_http_requests_total{method="GET",route="api/unread/",status="200"} 2.0',
+        ])
+
+    @override_settings(METRICS_TOKEN='secret')
+    @mock.patch('chat.metrics.flush_client')
+    @mock.patch('chat.metrics.redis_client')
+    def test_scrape_requires_token(self, redis, flush_client):
+        redis.hgetall.return_value = {b'["chat_http_requests_total", [["method", "GET"]]]': b'3'}
+
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('chat_http_requests_total{method="GET"} 3.0', response.content.decode())
+
+    @mock.patch('chat.metrics.flush_client')
+    @mock.patch('chat.metrics.redis_client')
+    def test_scrape_is_staff_only_without_token(self, redis, flush_client):
+        redis.hgetall.return_value = {}
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+        self.client.force_login(self.me)
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+        User.objects.filter(id=self.me.id).update(is_staff=True)
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    @override_settings(METRICS_FLUSH_INTERVAL=0)
+    def test_flush_runs_off_the_request_thread(self):
+        flushed = threading.Event()
+        threads = []
+
+        def flush():
+            threads.append(threading.current_thread())
+            flushed.set()
+
+        with mock.patch.object(self.registry, 'flush', side_effect=flush):
+            self.client.get('/api/list-friends/')
+            self.assertTrue(flushed.wait(5))
+        self.assertEqual([thread.name for thread in threads], ['metrics-flush'])
+
+    def test_flush_client_gives_up_quickly(self):
+        options = flush_client().connection_pool.connection_kwargs
+        self.assertEqual(options['socket_timeout'], settings.METRICS_FLUSH_TIMEOUT)
+        self.assertEqual(options['retry'].get_retries(), 0)
+
+
+@skipUnless(fakeredis, 'fakeredis (with Lua support) is not installed')
+class MessageStoreTests(SimpleTestCase):
+    """The real save/fetch/remove scripts of the list backend, on fakeredis; StreamMessageStoreTests reruns them"""
+    backend = 'list'
+
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=server)
+        self.async_redis = fakeredis.FakeAsyncRedis(server=server)
+        for target, client in (
+            ('chat.redis_util.redis_client', self.redis),
+            ('chat.redis_util.async_redis_client', self.async_redis),
+        ):
+            patcher = mock.patch(target, client)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # The scripts were registered on the real client at import
+        for store in redis_util.MESSAGE_STORES.values():
+            for script in store.scripts:
+                patcher = mock.patch.object(script, 'registered_client', self.redis)
+                patcher.start()
+                self.addCleanup(patcher.stop)
+        patcher = override_settings(CHAT_EPHEMERAL_BACKEND=self.backend)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+    def send(self, count, sender_id=1, receiver_id=2):
+        return [redis_util.save_temp_message(sender_id, receiver_id, f'message {i}')['id'] for i in range(count)]
+
+    def ids(self, **cursors):
+        return [m['id'] for m in redis_util.get_temp_messages(1, 2, **cursors)]
+
+    def stored_bytes(self):
+        [messages] = redis_util.get_message_store().fetch(['chat:1:2'])
+        return sum(len(m) for m in messages)
+
+    def test_save_fetch_remove(self):
+        self.assertEqual(self.send(4), [1, 2, 3, 4])
+        messages = redis_util.get_temp_messages(1, 2)
+        self.assertEqual([m['content'] for m in messages], ['message 0', 'message 1', 'message 2', 'message 3'])
+        self.assertEqual(messages[0]['digest'], Message.hash_content('message 0'))
+
+        # By id, by digest, and a message that is not there
+        redis_util.remove_temp_message(1, 2, message_id=2)
+        redis_util.remove_temp_message(1, 2, content='message 3')
+        redis_util.remove_temp_messages([(1, 2, None, 9), (1, 2, 'message 0', 1)])
+        self.assertEqual(self.ids(), [3])
+        self.assertEqual(int(self.redis.get('chatbytes:1:2')), self.stored_bytes())
+
+    def test_cursor_paging(self):
+        self.send(7)
+        self.assertEqual(self.ids(limit=3), [5, 6, 7])
+        self.assertEqual(self.ids(before=5, limit=3), [2, 3, 4])
+        self.assertEqual(self.ids(before=3, limit=3), [1, 2])
+        self.assertEqual(self.ids(since=2, limit=3), [3, 4, 5])
+        self.assertEqual(self.ids(since=6, limit=3), [7])
+        self.assertEqual(self.ids(since=2, before=5), [3, 4])
+        self.assertEqual(self.ids(since=7), [])
+
+    def test_conversation_shares_one_sequence(self):
+        self.send(2)
+        redis_util.save_temp_messages(2, [(1, 'reply'), (3, 'elsewhere')])
+        self.send(1)
+
+        received, sent = redis_util.get_conversation_messages(2, 1)
+        self.assertEqual(([m['id'] for m in received], [m['id'] for m in sent]), ([1, 2, 4], [3]))
+        received, sent = redis_util.get_conversation_messages(2, 1, since=2, limit=1)
+        self.assertEqual(([m['id'] for m in received], [m['id'] for m in sent]), ([4], [3]))
+        pages = redis_util.get_conversations_messages(2, {1: 3, 3: None})
+        self.assertEqual([m['id'] for m in pages[1][0]], [4])
+        self.assertEqual([m['content'] for m in pages[3][1]], ['elsewhere'])
+
+    def test_inbox_and_unread(self):
+        self.send(2)
+        self.send(1, sender_id=3)
+        unread = redis_util.get_unread(2)
+        self.assertEqual([(entry['user_id'], entry['unread']) for entry in unread], [(3, 1), (1, 2)])
+        self.assertEqual(len(redis_util.get_unread(2, limit=1)), 1)
+
+        redis_util.mark_read(2, 1)
+        self.assertEqual([(entry['user_id'], entry['unread']) for entry in redis_util.get_unread(2)], [(3, 1), (1, 0)])
+        redis_util.cleanup_all_temp_messages(3, 2)
+        self.assertEqual([entry['user_id'] for entry in redis_util.get_unread(2)], [1])
+        self.assertFalse(self.redis.exists('chat:3:2', 'chatbytes:3:2'))
+
+    def test_removal_updates_unread_and_inbox(self):
+        def unread():
+            return [(entry['user_id'], entry['unread']) for entry in redis_util.get_unread(2)]
+
+        self.send(3)
+        redis_util.mark_read(2, 1)
+        self.send(2)
+        self.send(1, sender_id=3)
+
+        # Message 2 was read already; 5 and 4 are the reader's unread ones
+        redis_util.remove_temp_message(1, 2, message_id=2)
+        self.assertEqual(unread(), [(3, 1), (1, 2)])
+        redis_util.remove_temp_messages([(1, 2, None, 5)])
+        self.assertEqual(unread(), [(3, 1), (1, 1)])
+        redis_util.remove_temp_message(1, 2, message_id=4)
+        self.assertEqual(unread(), [(3, 1), (1, 0)])
+
+        # The last message of a conversation takes it out of the inbox
+        redis_util.remove_temp_messages([(1, 2, None, 1), (1, 2, None, 3), (3, 2, 'message 0', None)])
+        self.assertEqual(unread(), [])
+        self.assertFalse(self.redis.exists('unread:2'))
+
+    @mock.patch('chat.redis_util.SCAN_PAGE_SIZE', 2)
+    def test_remove_by_id_across_pages(self):
+        self.send(5)
+        redis_util.mark_read(2, 1)
+        self.send(2)
+
+        # The oldest message is on the last, partial page; 8 is newer than any
+        redis_util.remove_temp_messages([(1, 2, None, 1), (1, 2, None, 4), (1, 2, None, 8)])
+        self.assertEqual(self.ids(), [2, 3, 5, 6, 7])
+        self.assertEqual(int(self.redis.get('chatbytes:1:2')), self.stored_bytes())
+        redis_util.remove_temp_message(1, 2, message_id=6)
+        self.assertEqual([entry['unread'] for entry in redis_util.get_unread(2)], [1])
+
+    @mock.patch('chat.redis_util.metrics.increment')
+    def test_trims_to_the_caps(self, increment):
+        self.send(3)
+        size = self.stored_bytes() // 3 + 1
+        with override_settings(CHAT_CONVERSATION_MAX_BYTES=3 * size):
+            self.send(2)
+        self.assertEqual(self.ids(), [3, 4, 5])
+        self.assertEqual(int(self.redis.get('chatbytes:1:2')), self.stored_bytes())
+        self.assertEqual(sum(call.args[2] for call in increment.call_args_list), 2)
+
+        with override_settings(CHAT_CONVERSATION_MAX_MESSAGES=2):
+            self.send(1)
+        self.assertEqual(self.ids(), [5, 6])
+        self.assertEqual(int(self.redis.get('chatbytes:1:2')), self.stored_bytes())
+        self.assertEqual(sum(call.args[2] for call in increment.call_args_list), 4)
+
+    def test_async_reloads_scripts_redis_lost(self):
+        self.send(1)
+        self.redis.script_flush()
+
+        async def send_and_fetch():
+            await redis_util.asave_temp_message(1, 2, 'async')
+            return await redis_util.aget_conversation_messages(2, 1)
+
+        with mock.patch.object(self.async_redis, 'script_load', wraps=self.async_redis.script_load) as script_load:
+            received, sent = asyncio.run(send_and_fetch())
+        self.assertEqual([m['content'] for m in received], ['message 0', 'async'])
+        self.assertEqual(sent, [])
+        # EVALSHA failed with NOSCRIPT once per script, then it was loaded and retried
+        self.assertEqual(script_load.call_count, 2)
+
+
+class StreamMessageStoreTests(MessageStoreTests):
+    backend = 'stream'
+
+
+class PerLoopRedisTests(TestCase):
+    def test_client_per_event_loop(self):
+        redis = PerLoopRedis(mock.AsyncMock)
+        redis.connection_class_wrapper = lambda base: 'wrapped'
+
+        async def get():
+            await redis.get('key')
+            return redis.client()
+
+        first = asyncio.run(get())
+        second = asyncio.run(get())
+        self.assertIsNot(first, second)
+        first.get.assert_awaited_once_with('key')
+        self.assertEqual(second.connection_pool.connection_class, 'wrapped')
+        # The first loop has closed, so its client was dropped
+        self.assertEqual(redis.clients(), [])
+        self.assertEqual(len(redis._clients), 1)
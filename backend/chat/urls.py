@@ -1,10 +1,13 @@
 from django.urls import path
+from . import async_views
 from .views import (
     SignupView, LoginView, SearchUsersView, AddFriendView, ListFriendsView, UserProfileView,
     SendFriendRequestView, ListPendingRequestsView, AcceptFriendRequestView, RejectFriendRequestView,
-    SendMessageView, GetMessagesView,
-    SaveMessageToVaultView, ListVaultMessagesView, DeleteFromVaultView, CleanupEphemeralView,
-    UploadKeysView, QueryKeysView, GetOwnKeysView
+    SendMessageView, SendMessagesView, GetMessagesView, SyncView, UnreadView,
+    SaveMessageToVaultView, BulkSaveToVaultView, ListVaultMessagesView, ExportVaultView,
+    DeleteFromVaultView, BulkDeleteFromVaultView, CleanupEphemeralView,
+    UploadKeysView, QueryKeysView, ClaimKeysView, IdentityKeysView, GetOwnKeysView,
+    RedisPoolStatsView
 )
 
 urlpatterns = [
@@ -21,12 +24,18 @@ urlpatterns = [
     
     # Messaging endpoints (Redis: ephemeral messages)
     path('send-message/', SendMessageView.as_view(), name='send-message'),
+    path('send-messages/', SendMessagesView.as_view(), name='send-messages'),
     path('get-messages/', GetMessagesView.as_view(), name='get-messages'),
+    path('sync/', SyncView.as_view(), name='sync'),
+    path('unread/', UnreadView.as_view(), name='unread'),
     
     # Vault endpoints
     path('save-to-vault/', SaveMessageToVaultView.as_view(), name='save-to-vault'),
+    path('bulk-save-to-vault/', BulkSaveToVaultView.as_view(), name='bulk-save-to-vault'),
     path('list-vault/', ListVaultMessagesView.as_view(), name='list-vault'),
+    path('export-vault/', ExportVaultView.as_view(), name='export-vault'),
     path('delete-from-vault/', DeleteFromVaultView.as_view(), name='delete-from-vault'),
+    path('bulk-delete-from-vault/', BulkDeleteFromVaultView.as_view(), name='bulk-delete-from-vault'),
     
     # Cleanup endpoints
     path('cleanup-ephemeral/', CleanupEphemeralView.as_view(), name='cleanup-ephemeral'),
@@ -34,5 +43,18 @@ urlpatterns = [
     # Encryption key management endpoints (Matrix/Olm E2EE)
     path('keys/upload/', UploadKeysView.as_view(), name='upload-keys'),
     path('keys/query/<str:username>/', QueryKeysView.as_view(), name='query-keys'),
+    path('keys/claim/', ClaimKeysView.as_view(), name='claim-keys'),
+    path('keys/identity/<str:username>/', IdentityKeysView.as_view(), name='identity-keys'),
     path('keys/me/', GetOwnKeysView.as_view(), name='get-own-keys'),
+    
+    # Async (ASGI-native) versions of the hot path; same requests and responses
+    path('async/send-message/', async_views.send_message, name='async-send-message'),
+    path('async/get-messages/', async_views.get_messages, name='async-get-messages'),
+    path('async/export-vault/', async_views.export_vault, name='async-export-vault'),
+    path('async/keys/upload/', async_views.upload_keys, name='async-upload-keys'),
+    path('async/keys/query/<str:username>/', async_views.query_keys, name='async-query-keys'),
+    path('async/keys/me/', async_views.own_keys, name='async-get-own-keys'),
+    
+    # Operations endpoints (staff only)
+    path('metrics/redis-pool/', RedisPoolStatsView.as_view(), name='redis-pool-stats'),
 ]
\ No newline at end of file
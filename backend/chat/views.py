@@ -1,16 +1,26 @@
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone as dt_timezone
+
 from django.shortcuts import render
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.http import StreamingHttpResponse
 from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
 from rest_framework import generics, status
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from rest_framework.utils.encoders import JSONEncoder
 from .models import Profile, Message
-from rest_framework_simplejwt.tokens import RefreshToken
+from .authentication import RefreshToken, TokenObtainPairSerializer
 from rest_framework_simplejwt.views import TokenObtainPairView
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.db.models import Q
-from .redis_util import save_temp_message, get_temp_messages, remove_temp_message, cleanup_all_temp_messages
+from .redis_client import pool_stats
+from .search import search_profiles
+from .cache import friend_count, friends_among, get_identity_keys, invalidate_friends, is_friend, store_identity_keys
+from .redis_util import save_temp_message, save_temp_messages, get_conversation_messages, get_conversations_messages, remove_temp_message, remove_temp_messages, cleanup_all_temp_messages, publish_event, publish_events, get_unread, mark_read
 
 class SignupView(generics.GenericAPIView):
     def post(self, request):
@@ -32,10 +42,16 @@ class SignupView(generics.GenericAPIView):
         }, status=status.HTTP_201_CREATED)
 
 class LoginView(TokenObtainPairView):
-    pass
+    serializer_class = TokenObtainPairSerializer
 
 # Search for users by username or profile name
 class SearchUsersView(generics.GenericAPIView):
+    """
+    GET /api/search-users/?q=<query>[&limit=<n>][&cursor=<next_cursor>]
+    
+    Prefix matches first, then fuzzy matches by similarity (see chat/search.py).
+    Pass back `next_cursor` to get the next page; it is null on the last page.
+    """
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
@@ -44,20 +60,24 @@ class SearchUsersView(generics.GenericAPIView):
         if not query or len(query) < 2:
             return Response({'error': 'Query must be at least 2 characters'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Search by username or profile name
-        users = Profile.objects.filter(
-            Q(user_name__icontains=query) | Q(user__username__icontains=query)
-        ).exclude(user=request.user)  # Exclude current user
-        
-        results = []
-        for profile in users:
-            results.append({
-                'id': profile.user.id,
-                'username': profile.user.username,
-                'user_name': profile.user_name,
-            })
-        
-        return Response({'results': results})
+        try:
+            limit = int(request.query_params.get('limit', settings.CHAT_SEARCH_DEFAULT_LIMIT))
+            offset = int(request.query_params.get('cursor', 0))
+        except ValueError:
+            return Response({'error': 'limit and cursor must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+        limit = min(max(limit, 1), settings.CHAT_SEARCH_MAX_LIMIT)
+        offset = max(offset, 0)
+        
+        # Search by username or profile name, excluding the current user
+        users, has_more = search_profiles(query, request.user.id, limit, offset)
+        
+        results = [{
+            'id': profile['user_id'],
+            'username': profile['user__username'],
+            'user_name': profile['user_name'],
+        } for profile in users]
+        
+        return Response({'results': results, 'next_cursor': str(offset + limit) if has_more else None})
 
 # Add a friend
 class AddFriendView(generics.GenericAPIView):
@@ -76,11 +96,12 @@ class AddFriendView(generics.GenericAPIView):
         
         # Check if already friends
         from .models import Friend
-        if Friend.objects.filter(user=request.user, friend=friend_user).exists():
+        if is_friend(request.user.id, friend_user.id):
             return Response({'error': 'Already friends'}, status=status.HTTP_400_BAD_REQUEST)
         
         # Create friendship
         Friend.objects.create(user=request.user, friend=friend_user)
+        invalidate_friends(request.user.id)
         
         return Response({'message': f'Added {friend_user.username} as friend!'}, status=status.HTTP_201_CREATED)
 
@@ -90,16 +111,16 @@ class ListFriendsView(generics.GenericAPIView):
     
     def get(self, request):
         from .models import Friend
-        friends = Friend.objects.filter(user=request.user)
+        # One joined query for the friend's user row and profile
+        friends = Friend.objects.filter(user_id=request.user.id).values(
+            'friend_id', 'friend__username', 'friend__profile__user_name'
+        )
         
-        results = []
-        for friendship in friends:
-            friend_profile = Profile.objects.get(user=friendship.friend)
-            results.append({
-                'id': friendship.friend.id,
-                'username': friendship.friend.username,
-                'user_name': friend_profile.user_name,
-            })
+        results = [{
+            'id': friendship['friend_id'],
+            'username': friendship['friend__username'],
+            'user_name': friendship['friend__profile__user_name'],
+        } for friendship in friends]
         
         return Response({
             'friends': results,
@@ -111,14 +132,12 @@ class UserProfileView(generics.GenericAPIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
-        profile = Profile.objects.get(user=request.user)
-        from .models import Friend
-        friend_count = Friend.objects.filter(user=request.user).count()
+        profile = Profile.objects.get(user_id=request.user.id)
         
         return Response({
             'username': request.user.username,
             'user_name': profile.user_name,
-            'friend_count': friend_count,
+            'friend_count': friend_count(request.user.id),
         })
 
 # Send friend request
@@ -139,10 +158,10 @@ class SendFriendRequestView(generics.GenericAPIView):
         if request.user == to_user:
             return Response({'error': 'Cannot send request to yourself'}, status=status.HTTP_400_BAD_REQUEST)
         
-        from .models import FriendRequest, Friend
+        from .models import FriendRequest
         
         # Check if already friends
-        if Friend.objects.filter(user=request.user, friend=to_user).exists():
+        if is_friend(request.user.id, to_user.id):
             return Response({'error': 'Already friends'}, status=status.HTTP_400_BAD_REQUEST)
         
         # Check if request already exists
@@ -161,17 +180,17 @@ class ListPendingRequestsView(generics.GenericAPIView):
     
     def get(self, request):
         from .models import FriendRequest
-        pending = FriendRequest.objects.filter(to_user=request.user, status='pending')
+        # One joined query for the requester's user row and profile
+        pending = FriendRequest.objects.filter(to_user_id=request.user.id, status='pending').values(
+            'id', 'from_user_id', 'from_user__username', 'from_user__profile__user_name'
+        )
         
-        results = []
-        for req in pending:
-            from_profile = Profile.objects.get(user=req.from_user)
-            results.append({
-                'request_id': req.id,
-                'from_user_id': req.from_user.id,
-                'username': req.from_user.username,
-                'user_name': from_profile.user_name,
-            })
+        results = [{
+            'request_id': req['id'],
+            'from_user_id': req['from_user_id'],
+            'username': req['from_user__username'],
+            'user_name': req['from_user__profile__user_name'],
+        } for req in pending]
         
         return Response({'requests': results, 'count': len(results)})
 
@@ -201,6 +220,7 @@ class AcceptFriendRequestView(generics.GenericAPIView):
         # Create friendship (both ways for mutual friendship)
         Friend.objects.get_or_create(user=friend_req.from_user, friend=friend_req.to_user)
         Friend.objects.get_or_create(user=friend_req.to_user, friend=friend_req.from_user)
+        invalidate_friends(friend_req.from_user_id, friend_req.to_user_id)
         
         return Response({'message': 'Friend request accepted!'}, status=status.HTTP_200_OK)
 
@@ -231,6 +251,20 @@ class RejectFriendRequestView(generics.GenericAPIView):
 
 # ============ MESSAGING ENDPOINTS ============
 
+def message_too_large(content):
+    """Whether the `content` string is over CHAT_MESSAGE_MAX_BYTES once UTF-8 encoded"""
+    return len(content.encode()) > settings.CHAT_MESSAGE_MAX_BYTES
+
+MESSAGE_TOO_LARGE = f'content must be at most {settings.CHAT_MESSAGE_MAX_BYTES} bytes'
+
+# Content is stored and hashed as text; JSON numbers, lists and objects are refused
+CONTENT_NOT_STRING = 'content must be a string'
+
+def is_integer_id(value):
+    """Whether a JSON value is an integer id (JSON true/false decode to bools, which are ints too)"""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
 # Send a message to a friend (Ephemeral: stored in Redis, deleted after being seen)
 class SendMessageView(generics.GenericAPIView):
     permission_classes = [IsAuthenticated]
@@ -242,33 +276,199 @@ class SendMessageView(generics.GenericAPIView):
         if not receiver_id or not content:
             return Response({'error': 'receiver_id and content are required'}, status=status.HTTP_400_BAD_REQUEST)
         
-        try:
-            receiver = User.objects.get(id=receiver_id)
-        except User.DoesNotExist:
-            return Response({'error': 'Receiver not found'}, status=status.HTTP_404_NOT_FOUND)
+        if not is_integer_id(receiver_id):
+            return Response({'error': 'receiver_id must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Check if they are friends
-        from .models import Friend
-        if not Friend.objects.filter(user=request.user, friend=receiver).exists():
+        if not isinstance(content, str):
+            return Response({'error': CONTENT_NOT_STRING}, status=status.HTTP_400_BAD_REQUEST)
+        
+        if message_too_large(content):
+            return Response({'error': MESSAGE_TOO_LARGE}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        
+        # Check if they are friends (from the friend graph cache; a friend is an existing user)
+        if not is_friend(request.user.id, receiver_id):
             return Response({'error': 'You can only message friends'}, status=status.HTTP_403_FORBIDDEN)
         
         # Save to Redis (not DB)
-        save_temp_message(request.user.id, receiver.id, content)
+        saved = save_temp_message(request.user.id, receiver_id, content)
         
         return Response({
             'message': 'Message sent!',
             'message_data': {
+                'id': saved['id'],
                 'sender_id': request.user.id,
                 'sender_username': request.user.username,
-                'receiver_id': receiver.id,
+                'receiver_id': receiver_id,
                 'content': content,
+                'timestamp': saved['timestamp'],
             }
         }, status=status.HTTP_201_CREATED)
 
+# Send many messages in one request (offline outbox flush, multi-device fan-out)
+class SendMessagesView(generics.GenericAPIView):
+    """
+    POST /api/send-messages/
+    Body: {"messages": [{"receiver_id": 2, "content": "..."}, ...]}
+
+    Every receiver is checked against the friend graph cache at once and all
+    messages are written in one Redis pipeline. Returns one result per item, in
+    order: {"status": 201, "message_data": {...}} or {"status": 4xx, "error": "..."}.
+    """
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request):
+        messages = request.data.get('messages')
+        
+        if not isinstance(messages, list) or not messages:
+            return Response({'error': 'messages must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        if len(messages) > settings.CHAT_SEND_BATCH_MAX:
+            return Response(
+                {'error': f'At most {settings.CHAT_SEND_BATCH_MAX} messages per request'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        results = [None] * len(messages)
+        valid = []  # (index, receiver_id, content)
+        for index, item in enumerate(messages):
+            receiver_id = item.get('receiver_id') if isinstance(item, dict) else None
+            content = item.get('content') if isinstance(item, dict) else None
+            if not receiver_id or not content:
+                results[index] = {'status': 400, 'error': 'receiver_id and content are required'}
+                continue
+            if not isinstance(content, str):
+                results[index] = {'status': 400, 'error': CONTENT_NOT_STRING}
+                continue
+            if not is_integer_id(receiver_id):
+                results[index] = {'status': 400, 'error': 'receiver_id must be an integer'}
+                continue
+            if message_too_large(content):
+                results[index] = {'status': 413, 'error': MESSAGE_TOO_LARGE}
+                continue
+            valid.append((index, receiver_id, content))
+        
+        friends = friends_among(request.user.id, {receiver_id for _, receiver_id, _ in valid}) if valid else set()
+        allowed = []
+        for index, receiver_id, content in valid:
+            if receiver_id in friends:
+                allowed.append((index, receiver_id, content))
+            else:
+                results[index] = {'status': 403, 'error': 'You can only message friends'}
+        
+        saved = save_temp_messages(request.user.id, [(receiver_id, content) for _, receiver_id, content in allowed])
+        for (index, receiver_id, content), message in zip(allowed, saved):
+            results[index] = {
+                'status': 201,
+                'message_data': {
+                    'id': message['id'],
+                    'sender_id': request.user.id,
+                    'sender_username': request.user.username,
+                    'receiver_id': receiver_id,
+                    'content': content,
+                    'timestamp': message['timestamp'],
+                }
+            }
+        
+        return Response({
+            'results': results,
+            'sent': len(allowed),
+            'failed': len(messages) - len(allowed),
+        })
+
+def parse_message_cursors(params):
+    """get-messages paging parameters as ({name: int}, clamped limit). Raises ValueError."""
+    cursors = {
+        name: int(params[name])
+        for name in ('since', 'before', 'vault_since', 'vault_before', 'limit')
+        if params.get(name)
+    }
+    limit = min(max(cursors.get('limit', settings.CHAT_MESSAGES_DEFAULT_LIMIT), 1), settings.CHAT_MESSAGES_MAX_LIMIT)
+    return cursors, limit
+
+def vault_message_result(msg, sender_username):
+    return {
+        'id': msg['id'],
+        'sender_id': msg['sender_id'],
+        'sender_username': sender_username,
+        'receiver_id': msg['receiver_id'],
+        'content': msg['content'],
+        'timestamp': msg['timestamp'].isoformat(),
+        'is_saved': True,
+        'source': 'vault'
+    }
+
+def ephemeral_message_result(m, sender_username):
+    return {
+        'id': m.get('id'),
+        'sender_id': m['sender_id'],
+        'sender_username': sender_username,
+        'receiver_id': m['receiver_id'],
+        'content': m['content'],
+        'timestamp': m.get('timestamp'),
+        'is_saved': False,
+        'source': 'redis'
+    }
+
+def conversation_vault_rows(saved_messages, cursors, limit):
+    """
+    The vault page query of get-messages: saved_messages narrowed to the vault
+    cursors, one row more than limit so the caller learns whether there are more
+    """
+    if 'vault_since' in cursors:
+        saved_messages = saved_messages.filter(id__gt=cursors['vault_since']).order_by('id')
+    else:
+        saved_messages = saved_messages.order_by('-id')
+    if 'vault_before' in cursors:
+        saved_messages = saved_messages.filter(id__lt=cursors['vault_before'])
+    return saved_messages.values('id', 'sender_id', 'receiver_id', 'content', 'timestamp')[:limit + 1]
+
+def conversation_page(cursors, limit, saved_messages, temp_messages, usernames):
+    """
+    The get-messages response body from up to limit + 1 vault rows and Redis
+    messages (both directions). Each source is cut to limit, and the cursors
+    point past the page, or stay put when a source returned nothing.
+    """
+    vault_has_more = len(saved_messages) > limit
+    saved_messages = sorted(saved_messages[:limit], key=lambda msg: msg['id'])
+    saved_results = [vault_message_result(msg, usernames[msg['sender_id']]) for msg in saved_messages]
+
+    # Both directions share one id sequence, so they merge into a single ordered page
+    since, before = cursors.get('since'), cursors.get('before')
+    temp_messages = sorted(temp_messages, key=lambda m: m.get('id', 0))
+    temp_has_more = len(temp_messages) > limit
+    temp_messages = temp_messages[:limit] if since is not None else temp_messages[-limit:]
+    temp_results = [ephemeral_message_result(m, usernames[m['sender_id']]) for m in temp_messages]
+
+    # Saved messages + ephemeral messages in send order
+    all_messages = saved_results + temp_results
+    return {
+        'messages': all_messages,
+        'count': len(all_messages),
+        'has_more': temp_has_more or vault_has_more,
+        'cursors': {
+            'since': temp_results[-1]['id'] if temp_results else since,
+            'before': temp_results[0]['id'] if temp_results else before,
+            'vault_since': saved_results[-1]['id'] if saved_results else cursors.get('vault_since'),
+            'vault_before': saved_results[0]['id'] if saved_results else cursors.get('vault_before'),
+        },
+    }
+
 # Get messages between current user and another user
 # Returns vault messages (Postgres) + ephemeral messages (Redis)
 # Ephemeral messages are auto-expired 10 seconds after being read
 class GetMessagesView(generics.GenericAPIView):
+    """
+    GET /api/get-messages/?user_id=<id>
+
+    Optional paging (all ids are exclusive bounds):
+    - since / before: ephemeral message ids (Redis)
+    - vault_since / vault_before: vault message ids (Postgres)
+    - limit: max messages per source (default CHAT_MESSAGES_DEFAULT_LIMIT)
+
+    With a `since` cursor the oldest new messages come first, so polling clients
+    catch up page by page; otherwise the newest page is returned. Pass back the
+    returned `cursors` to fetch the next page.
+    """
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
@@ -276,6 +476,11 @@ class GetMessagesView(generics.GenericAPIView):
         if not other_user_id:
             return Response({'error': 'user_id is required'}, status=status.HTTP_400_BAD_REQUEST)
         
+        try:
+            cursors, limit = parse_message_cursors(request.query_params)
+        except ValueError:
+            return Response({'error': 'Cursors and limit must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+        
         try:
             other_user = User.objects.get(id=other_user_id)
         except User.DoesNotExist:
@@ -283,52 +488,145 @@ class GetMessagesView(generics.GenericAPIView):
         
         # 1. Get saved messages from Postgres where current user is either sender or receiver
         # Messages where current user saved them
-        saved_messages = Message.objects.filter(
-            models.Q(sender=request.user, receiver=other_user, saved_by_sender=True) |
-            models.Q(sender=other_user, receiver=request.user, saved_by_receiver=True)
-        ).order_by('timestamp')
-        
-        saved_results = [{
-            'id': msg.id,
-            'sender_id': msg.sender.id,
-            'sender_username': msg.sender.username,
-            'receiver_id': msg.receiver.id,
-            'content': msg.content,
-            'timestamp': msg.timestamp.isoformat(),
-            'is_saved': True,
-            'source': 'vault'
-        } for msg in saved_messages]
+        saved_messages = Message.objects.saved_in_conversation(request.user.id, other_user)
+        saved_messages = list(conversation_vault_rows(saved_messages, cursors, limit))
 
         # 2. Get ephemeral messages from Redis
-        # Messages sent BY other_user TO current_user (receiver gets these)
-        temp_messages_received = get_temp_messages(other_user.id, request.user.id)
-        temp_results_received = [{
-            'id': None,
-            'sender_id': other_user.id,
-            'sender_username': other_user.username,
-            'receiver_id': request.user.id,
-            'content': m['content'],
-            'timestamp': None,
-            'is_saved': False,
-            'source': 'redis'
-        } for m in temp_messages_received]
-        
-        # Messages sent BY current_user TO other_user (sender gets these back from Redis for their own sent messages)
-        temp_messages_sent = get_temp_messages(request.user.id, other_user.id)
-        temp_results_sent = [{
-            'id': None,
-            'sender_id': request.user.id,
-            'sender_username': request.user.username,
-            'receiver_id': other_user.id,
-            'content': m['content'],
-            'timestamp': None,
-            'is_saved': False,
-            'source': 'redis'
-        } for m in temp_messages_sent]
-
-        # Combine and return - saved messages + received ephemeral + sent ephemeral
-        all_messages = saved_results + temp_results_received + temp_results_sent
-        return Response({'messages': all_messages, 'count': len(all_messages)})
+        # Received: sent BY other_user TO current_user (receiver gets these)
+        # Sent: sent BY current_user TO other_user (sender gets these back from Redis for their own sent messages)
+        # Both directions are read in a single round trip
+        temp_messages_received, temp_messages_sent = get_conversation_messages(
+            request.user.id, other_user.id, cursors.get('since'), cursors.get('before'), limit + 1
+        )
+        if 'before' not in cursors:
+            # The client is looking at the latest messages of this conversation
+            mark_read(request.user.id, other_user.id)
+
+        # Every message is between these two users, so no per-row user lookups are needed
+        usernames = {other_user.id: other_user.username, request.user.id: request.user.username}
+        return Response(conversation_page(
+            cursors, limit, saved_messages, temp_messages_received + temp_messages_sent, usernames
+        ))
+
+# Which conversations have new messages
+class UnreadView(generics.GenericAPIView):
+    """
+    GET /api/unread/?limit=<n>
+
+    Conversations with ephemeral messages for the current user, most recently
+    active first, with how many messages arrived since the user last opened the
+    conversation with get-messages. Served from the Redis inbox index kept by
+    the send scripts: one round trip, no database queries.
+    """
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request):
+        try:
+            limit = int(request.query_params['limit']) if request.query_params.get('limit') else None
+        except ValueError:
+            return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        conversations = get_unread(request.user.id, limit)
+        return Response({
+            'conversations': conversations,
+            'total_unread': sum(conversation['unread'] for conversation in conversations),
+        })
+
+# Catch up on everything at once (app start-up, reconnect)
+class SyncView(generics.GenericAPIView):
+    """
+    POST /api/sync/
+    Body (all optional): {
+        "cursors": {"<friend id>": <last ephemeral message id seen>, ...},
+        "vault_since": <last vault message id seen>,
+        "limit": <max messages per conversation and for the vault>
+    }
+
+    Returns the friend list, new ephemeral messages for every conversation
+    (friends without a cursor get their newest page), vault messages saved since
+    `vault_since`, pending friend requests and the one-time key pool status.
+    Costs four queries and one pipelined Redis round trip however many friends
+    there are. Pass the returned cursors back on the next sync.
+    """
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request):
+        from .models import Friend, FriendRequest, OneTimeKeys
+        
+        raw_cursors = request.data.get('cursors') or {}
+        if not isinstance(raw_cursors, dict):
+            return Response({'error': 'cursors must be an object of friend id to message id'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            cursors = {int(friend_id): int(since) for friend_id, since in raw_cursors.items() if since is not None}
+            vault_since = int(request.data.get('vault_since') or 0)
+            limit = int(request.data.get('limit') or settings.CHAT_MESSAGES_DEFAULT_LIMIT)
+        except (TypeError, ValueError):
+            return Response({'error': 'Cursors and limit must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+        limit = min(max(limit, 1), settings.CHAT_MESSAGES_MAX_LIMIT)
+        
+        # 1. Friends, which are also the conversations to sync
+        friends = list(Friend.objects.filter(user_id=request.user.id).values(
+            'friend_id', 'friend__username', 'friend__profile__user_name'
+        ))
+        usernames = {friendship['friend_id']: friendship['friend__username'] for friendship in friends}
+        usernames[request.user.id] = request.user.username
+        
+        # 2. Ephemeral messages for every conversation, one pipelined Redis round trip
+        conversations = {}
+        fetched = get_conversations_messages(
+            request.user.id,
+            {friendship['friend_id']: cursors.get(friendship['friend_id']) for friendship in friends},
+            limit + 1,
+        )
+        for friend_id, (received, sent) in fetched.items():
+            temp_messages = sorted(received + sent, key=lambda m: m.get('id', 0))
+            if not temp_messages:
+                continue
+            since = cursors.get(friend_id)
+            has_more = len(temp_messages) > limit
+            temp_messages = temp_messages[:limit] if since is not None else temp_messages[-limit:]
+            conversations[str(friend_id)] = {
+                'messages': [ephemeral_message_result(m, usernames.get(m['sender_id'])) for m in temp_messages],
+                'has_more': has_more,
+                'cursor': temp_messages[-1].get('id'),
+            }
+        
+        # 3. Vault messages saved since the last sync, oldest first
+        saved_messages = list(
+            Message.objects.saved_by(request.user.id).filter(id__gt=vault_since).order_by('id')
+            .values('id', 'sender_id', 'sender__username', 'receiver_id', 'content', 'timestamp')[:limit + 1]
+        )
+        vault_has_more = len(saved_messages) > limit
+        saved_messages = saved_messages[:limit]
+        
+        # 4. Pending friend requests
+        pending = FriendRequest.objects.filter(to_user_id=request.user.id, status='pending').values(
+            'id', 'from_user_id', 'from_user__username', 'from_user__profile__user_name'
+        )
+        
+        # 5. One-time key pool
+        available_otks = OneTimeKeys.objects.filter(user_id=request.user.id, is_used=False).count()
+        
+        return Response({
+            'friends': [{
+                'id': friendship['friend_id'],
+                'username': friendship['friend__username'],
+                'user_name': friendship['friend__profile__user_name'],
+            } for friendship in friends],
+            'conversations': conversations,
+            'vault': {
+                'messages': [vault_message_result(msg, msg['sender__username']) for msg in saved_messages],
+                'has_more': vault_has_more,
+                'cursor': saved_messages[-1]['id'] if saved_messages else vault_since,
+            },
+            'pending_requests': [{
+                'request_id': req['id'],
+                'from_user_id': req['from_user_id'],
+                'username': req['from_user__username'],
+                'user_name': req['from_user__profile__user_name'],
+            } for req in pending],
+            'one_time_keys': one_time_key_pool(available_otks),
+        })
 
 # ============ VAULT ENDPOINTS ============
 
@@ -344,14 +642,28 @@ class SaveMessageToVaultView(generics.GenericAPIView):
         - other_user_id: The ID of the other user in the conversation
         - content: The message content to save
         - is_sender: Boolean indicating if current user is the sender
+
+        Optional:
+        - message_id: The ephemeral message id from get-messages, so the Redis
+          copy is removed by id instead of by matching content
         """
         other_user_id = request.data.get('other_user_id')
         content = request.data.get('content')
+        message_id = request.data.get('message_id')
         is_sender = request.data.get('is_sender', False)  # True if current user is sender
         
         if not other_user_id or not content:
             return Response({'error': 'other_user_id and content are required'}, status=status.HTTP_400_BAD_REQUEST)
         
+        if not isinstance(content, str):
+            return Response({'error': CONTENT_NOT_STRING}, status=status.HTTP_400_BAD_REQUEST)
+        
+        if message_id is not None:
+            try:
+                message_id = int(message_id)
+            except (TypeError, ValueError):
+                return Response({'error': 'message_id must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        
         try:
             other_user = User.objects.get(id=other_user_id)
         except User.DoesNotExist:
@@ -372,63 +684,291 @@ class SaveMessageToVaultView(generics.GenericAPIView):
             saved_by_receiver = True
         
         # Check if message already exists (both users saving the same message)
-        existing_msg = Message.objects.filter(
-            sender=sender,
-            receiver=receiver,
-            content=content
-        ).first()
+        # Messages are identified by their ephemeral id when the client sends it,
+        # otherwise by the SHA-256 of the ciphertext; both are index lookups.
+        # Ids are never reused (the sequence key has no TTL), and each side saves
+        # its own vault encryption of the message, so rows are not compared by
+        # content once the id matches.
+        existing_msg = None
+        if message_id is not None:
+            existing_msg = Message.objects.filter(sender=sender, receiver=receiver, ephemeral_id=message_id).first()
+            if not existing_msg:
+                existing_msg = self.adopt(sender, receiver, content, message_id)
+        else:
+            existing_msg = Message.objects.with_content(sender, receiver, content).first()
+        
+        if not existing_msg:
+            # Create new message in vault
+            try:
+                with transaction.atomic():
+                    message = Message.objects.create(
+                        sender=sender,
+                        receiver=receiver,
+                        content=content,
+                        ephemeral_id=message_id,
+                        saved_by_sender=saved_by_sender,
+                        saved_by_receiver=saved_by_receiver
+                    )
+            except IntegrityError:
+                # The other side saved the same message at the same moment
+                existing_msg = Message.objects.get(sender=sender, receiver=receiver, ephemeral_id=message_id)
         
         if existing_msg:
-            # Message already in vault, just update the save flags
-            if is_sender:
-                existing_msg.saved_by_sender = True
-            else:
-                existing_msg.saved_by_receiver = True
-            existing_msg.save()
+            # Message already in vault: set only this side's flag, so a concurrent
+            # save or delete by the other side is not overwritten
+            field = 'saved_by_sender' if is_sender else 'saved_by_receiver'
+            Message.objects.filter(pk=existing_msg.pk).update(**{field: True})
             message = existing_msg
-        else:
-            # Create new message in vault
-            message = Message.objects.create(
-                sender=sender,
-                receiver=receiver,
-                content=content,
-                saved_by_sender=saved_by_sender,
-                saved_by_receiver=saved_by_receiver
-            )
         
         # Remove from Redis (the sender's ephemeral messages)
         if is_sender:
-            remove_temp_message(request.user.id, other_user_id, content)
+            remove_temp_message(request.user.id, other_user_id, content, message_id)
         else:
-            remove_temp_message(other_user_id, request.user.id, content)
+            remove_temp_message(other_user_id, request.user.id, content, message_id)
         
         return Response({
             'message': 'Message saved to vault',
             'message_id': message.id
         }, status=status.HTTP_201_CREATED)
-# List all saved messages (Vault)
+    
+    def adopt(self, sender, receiver, content, message_id):
+        """
+        A row saved by content hash alone (without an id) for the same ciphertext,
+        now given `message_id`; None if there is none
+        """
+        legacy = Message.objects.with_content(sender, receiver, content).filter(ephemeral_id__isnull=True).first()
+        if legacy is None:
+            return None
+        try:
+            with transaction.atomic():
+                Message.objects.filter(pk=legacy.pk, ephemeral_id__isnull=True).update(ephemeral_id=message_id)
+        except IntegrityError:
+            # The other side created the row for this id meanwhile
+            return Message.objects.get(sender=sender, receiver=receiver, ephemeral_id=message_id)
+        return legacy
+
+# A bulk-save-to-vault item, once validated
+VaultSave = namedtuple('VaultSave', 'index sender_id receiver_id content digest message_id is_sender')
+
+# Save many messages to vault at once
+class BulkSaveToVaultView(generics.GenericAPIView):
+    """
+    POST /api/bulk-save-to-vault/
+    Body: {"messages": [{"other_user_id": 2, "content": "...", "message_id": 7, "is_sender": false}, ...]}
+    
+    SaveMessageToVaultView for a batch ("pin all"). Items take the same fields
+    and are matched to existing vault rows the same way. Every row is written in
+    one transaction (one INSERT for the new rows, one UPDATE per side for the
+    rest) and the Redis copies are removed in one pipeline, so the batch costs a
+    fixed number of queries. Returns one result per item, in order:
+    {"status": 201, "message_id": <vault id>} or {"status": 4xx, "error": "..."}.
+    """
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request):
+        messages = request.data.get('messages')
+        
+        if not isinstance(messages, list) or not messages:
+            return Response({'error': 'messages must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        if len(messages) > settings.CHAT_VAULT_BATCH_MAX:
+            return Response(
+                {'error': f'At most {settings.CHAT_VAULT_BATCH_MAX} messages per request'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        results = [None] * len(messages)
+        valid = []  # (index, other_user_id, content, message_id, is_sender)
+        for index, item in enumerate(messages):
+            if not isinstance(item, dict) or not item.get('other_user_id') or not item.get('content'):
+                results[index] = {'status': 400, 'error': 'other_user_id and content are required'}
+                continue
+            if not isinstance(item['content'], str):
+                results[index] = {'status': 400, 'error': CONTENT_NOT_STRING}
+                continue
+            try:
+                other_user_id = int(item['other_user_id'])
+                message_id = item.get('message_id')
+                message_id = None if message_id is None else int(message_id)
+            except (TypeError, ValueError):
+                results[index] = {'status': 400, 'error': 'other_user_id and message_id must be integers'}
+                continue
+            valid.append((index, other_user_id, item['content'], message_id, bool(item.get('is_sender', False))))
+        
+        known = set(User.objects.filter(id__in={item[1] for item in valid}).values_list('id', flat=True)) if valid else set()
+        items = []
+        for index, other_user_id, content, message_id, is_sender in valid:
+            if other_user_id not in known:
+                results[index] = {'status': 404, 'error': 'User not found'}
+                continue
+            sender_id, receiver_id = (request.user.id, other_user_id) if is_sender else (other_user_id, request.user.id)
+            items.append(VaultSave(index, sender_id, receiver_id, content, Message.hash_content(content), message_id, is_sender))
+        
+        for attempt in range(2):
+            try:
+                with transaction.atomic():
+                    rows = self.save(items)
+                break
+            except IntegrityError:
+                # The other side saved one of these messages at the same moment:
+                # its row is committed now, so the retry updates it instead
+                if attempt:
+                    raise
+        
+        for item, row in zip(items, rows):
+            results[item.index] = {'status': 201, 'message_id': row.id}
+        
+        # Remove from Redis (the sender's ephemeral messages)
+        if items:
+            remove_temp_messages([(item.sender_id, item.receiver_id, item.content, item.message_id) for item in items])
+        
+        return Response({
+            'results': results,
+            'saved': len(items),
+            'failed': len(messages) - len(items),
+        })
+    
+    def save(self, items):
+        """The vault row of each item, creating or flagging rows as needed"""
+        if not items:
+            return []
+        by_id, by_hash = {}, {}
+        candidates = Message.objects.filter(
+            Q(sender_id__in={item.sender_id for item in items}, receiver_id__in={item.receiver_id for item in items}),
+            Q(ephemeral_id__in={item.message_id for item in items if item.message_id is not None})
+            | Q(content_hash__in={item.digest for item in items if item.message_id is None}),
+        ).order_by('-id').only('id', 'sender_id', 'receiver_id', 'ephemeral_id', 'content_hash')
+        for message in candidates:
+            if message.ephemeral_id is not None:
+                by_id[message.sender_id, message.receiver_id, message.ephemeral_id] = message
+            # Lowest id wins, like .first() on the single save
+            by_hash[message.sender_id, message.receiver_id, message.content_hash] = message
+        
+        rows, new, flags = [], {}, {True: set(), False: set()}
+        for _, sender_id, receiver_id, content, digest, message_id, is_sender in items:
+            if message_id is not None:
+                # Ids are never reused, so a matching id is the same message (see SaveMessageToVaultView)
+                key = (sender_id, receiver_id, message_id)
+                message = by_id.get(key)
+            else:
+                key = (sender_id, receiver_id, digest)
+                message = by_hash.get(key)
+            if message is None:
+                # Items naming the same message share one new row
+                message = new.setdefault(key, Message(
+                    sender_id=sender_id, receiver_id=receiver_id, content=content,
+                    content_hash=digest, ephemeral_id=message_id,
+                ))
+            if message.pk is None:
+                setattr(message, 'saved_by_sender' if is_sender else 'saved_by_receiver', True)
+            else:
+                flags[is_sender].add(message.pk)
+            rows.append(message)
+        
+        Message.objects.bulk_create(new.values())
+        # Set only the saving side's flag, so a concurrent save by the other side is kept
+        for field, ids in (('saved_by_sender', flags[True]), ('saved_by_receiver', flags[False])):
+            if ids:
+                Message.objects.filter(id__in=ids).update(**{field: True})
+        return rows
+
+VAULT_FIELDS = ('id', 'sender_id', 'sender__username', 'receiver_id', 'content', 'timestamp')
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+def vault_entry(msg):
+    """A list-vault / export-vault item for a VAULT_FIELDS row"""
+    return {
+        'id': msg['id'],
+        'sender_id': msg['sender_id'],
+        'sender_username': msg['sender__username'],
+        'receiver_id': msg['receiver_id'],
+        'content': msg['content'],
+        'timestamp': msg['timestamp'],
+    }
+
+def vault_cursor(msg):
+    """The list-vault cursor continuing after `msg`: <timestamp in microseconds>-<id>"""
+    return f"{(msg['timestamp'] - EPOCH) // timedelta(microseconds=1)}-{msg['id']}"
+
+def parse_vault_cursor(cursor):
+    """The (timestamp, id) of a vault_cursor(). Raises ValueError, or OverflowError when out of range."""
+    microseconds, _, message_id = cursor.partition('-')
+    message_id = int(message_id)
+    if message_id >= 2 ** 63:
+        # Past any bigint primary key; the query would fail
+        raise OverflowError('message id out of range')
+    return EPOCH + timedelta(microseconds=int(microseconds)), message_id
+
+VAULT_EXPORT_LINES_PER_CHUNK = 500
+
+def vault_export_chunks(entries):
+    """NDJSON for an iterable of vault entries, a few hundred lines per chunk"""
+    encoder = JSONEncoder()
+    lines = []
+    for entry in entries:
+        lines.append(encoder.encode(entry))
+        if len(lines) == VAULT_EXPORT_LINES_PER_CHUNK:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+# List saved messages (Vault)
 class ListVaultMessagesView(generics.GenericAPIView):
+    """
+    GET /api/list-vault/?limit=<n>&before=<cursor>
+    
+    The messages the current user has saved (as sender or receiver), newest
+    first, a page at a time. Pass the response's cursors.before back as
+    `before` for the next page while has_more is true. Pages are keyed on
+    (timestamp, id) rather than offsets, so every page costs the same.
+    """
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
-        # Get all messages saved by current user (either as sender or receiver)
-        messages = Message.objects.filter(
-            models.Q(sender=request.user, saved_by_sender=True) |
-            models.Q(receiver=request.user, saved_by_receiver=True)
-        ).order_by('-timestamp')
-        
-        results = []
-        for msg in messages:
-            results.append({
-                'id': msg.id,
-                'sender_id': msg.sender.id,
-                'sender_username': msg.sender.username,
-                'receiver_id': msg.receiver.id,
-                'content': msg.content,
-                'timestamp': msg.timestamp,
-            })
+        try:
+            limit = int(request.query_params.get('limit', settings.CHAT_MESSAGES_DEFAULT_LIMIT))
+            before = request.query_params.get('before')
+            before = parse_vault_cursor(before) if before else None
+        except (ValueError, OverflowError):
+            return Response({'error': 'limit must be an integer and before a list-vault cursor'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        limit = min(max(limit, 1), settings.CHAT_MESSAGES_MAX_LIMIT)
+        
+        messages = list(Message.objects.vault_page(request.user.id, VAULT_FIELDS, before, limit + 1))
+        has_more = len(messages) > limit
+        messages = messages[:limit]
         
-        return Response({'messages': results, 'count': len(results)})
+        return Response({
+            'messages': [vault_entry(msg) for msg in messages],
+            'count': len(messages),
+            'has_more': has_more,
+            'cursors': {'before': vault_cursor(messages[-1]) if messages else None},
+        })
+
+# Export the whole vault
+class ExportVaultView(generics.GenericAPIView):
+    """
+    GET /api/export-vault/
+    
+    The whole vault, oldest first, as NDJSON: one list-vault item per line. Rows
+    are read through a server-side cursor CHAT_VAULT_EXPORT_CHUNK_SIZE at a time
+    and streamed out as they arrive, so memory stays flat however large the vault.
+    Under ASGI use /api/async/export-vault/, which streams without a thread.
+    """
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request):
+        messages = (
+            Message.objects.saved_by(request.user.id).order_by('timestamp', 'id').values(*VAULT_FIELDS)
+            .iterator(chunk_size=settings.CHAT_VAULT_EXPORT_CHUNK_SIZE)
+        )
+        response = StreamingHttpResponse(
+            vault_export_chunks(vault_entry(msg) for msg in messages), content_type='application/x-ndjson'
+        )
+        response['Content-Disposition'] = 'attachment; filename="vault.ndjson"'
+        return response
 
 # Delete message from vault
 class DeleteFromVaultView(generics.GenericAPIView):
@@ -446,9 +986,9 @@ class DeleteFromVaultView(generics.GenericAPIView):
             return Response({'error': 'Message not found'}, status=status.HTTP_404_NOT_FOUND)
         
         # Check if current user has saved this message
-        if message.sender == request.user and message.saved_by_sender:
+        if message.sender_id == request.user.id and message.saved_by_sender:
             message.saved_by_sender = False
-        elif message.receiver == request.user and message.saved_by_receiver:
+        elif message.receiver_id == request.user.id and message.saved_by_receiver:
             message.saved_by_receiver = False
         else:
             return Response({'error': 'Message not saved by you'}, status=status.HTTP_403_FORBIDDEN)
@@ -461,6 +1001,70 @@ class DeleteFromVaultView(generics.GenericAPIView):
         
         return Response({'message': 'Message removed from vault'}, status=status.HTTP_200_OK)
 
+# Delete many messages from vault at once
+class BulkDeleteFromVaultView(generics.GenericAPIView):
+    """
+    DELETE /api/bulk-delete-from-vault/
+    Body: {"message_ids": [1, 2, ...]}
+    
+    DeleteFromVaultView for a batch ("clear vault"). In one transaction the
+    user's save flag is cleared on every listed row with one UPDATE per side,
+    then the rows neither user has saved any more are deleted with one DELETE.
+    Returns one result per id, in order: {"status": 200} or {"status": 4xx, "error": "..."}.
+    """
+    permission_classes = [IsAuthenticated]
+    
+    def delete(self, request):
+        message_ids = request.data.get('message_ids')
+        
+        if not isinstance(message_ids, list) or not message_ids:
+            return Response({'error': 'message_ids must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        if len(message_ids) > settings.CHAT_VAULT_BATCH_MAX:
+            return Response(
+                {'error': f'At most {settings.CHAT_VAULT_BATCH_MAX} messages per request'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if not all(is_integer_id(message_id) for message_id in message_ids):
+            return Response({'error': 'message_ids must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        # The ids the user saved, per side
+        sides = {'saved_by_sender': set(), 'saved_by_receiver': set()}
+        found = set()
+        for message_id, sender_id, receiver_id, saved_by_sender, saved_by_receiver in Message.objects.filter(
+            id__in=set(message_ids)
+        ).values_list('id', 'sender_id', 'receiver_id', 'saved_by_sender', 'saved_by_receiver'):
+            found.add(message_id)
+            if sender_id == request.user.id and saved_by_sender:
+                sides['saved_by_sender'].add(message_id)
+            elif receiver_id == request.user.id and saved_by_receiver:
+                sides['saved_by_receiver'].add(message_id)
+        removed = sides['saved_by_sender'] | sides['saved_by_receiver']
+        
+        if removed:
+            with transaction.atomic():
+                for field, ids in sides.items():
+                    if ids:
+                        Message.objects.filter(id__in=ids).update(**{field: False})
+                # If neither user saved them anymore, delete them from Postgres
+                Message.objects.filter(id__in=removed, saved_by_sender=False, saved_by_receiver=False).delete()
+        
+        results = []
+        for message_id in message_ids:
+            if message_id in removed:
+                results.append({'status': 200})
+            elif message_id in found:
+                results.append({'status': 403, 'error': 'Message not saved by you'})
+            else:
+                results.append({'status': 404, 'error': 'Message not found'})
+        
+        return Response({
+            'results': results,
+            'removed': len(removed),
+            'failed': sum(message_id not in removed for message_id in message_ids),
+        })
+
 # Cleanup ephemeral messages on tab switch
 class CleanupEphemeralView(generics.GenericAPIView):
     permission_classes = [IsAuthenticated]
@@ -485,6 +1089,34 @@ class CleanupEphemeralView(generics.GenericAPIView):
 
 # ============ ENCRYPTION KEY MANAGEMENT ENDPOINTS ============
 
+def one_time_key_pool(available):
+    """Pool size plus how many keys the client should upload, if it has dropped below the low watermark"""
+    replenish = available < settings.ONE_TIME_KEYS_LOW_WATERMARK
+    return {
+        'availableOneTimeKeys': available,
+        'replenish': replenish,
+        'replenishCount': settings.ONE_TIME_KEYS_HIGH_WATERMARK - available if replenish else 0,
+    }
+
+
+def parse_key_upload(data):
+    """
+    (identity key, signing key, {key id: one-time key}) from an upload body.
+    Raises ValueError with the message for the client.
+    """
+    identity_key = data.get('identityKey')
+    signing_key = data.get('signingKey')
+    one_time_keys = data.get('oneTimeKeys', {})
+    if not identity_key or not signing_key:
+        raise ValueError('identityKey and signingKey are required')
+    if not isinstance(one_time_keys, dict):
+        raise ValueError('oneTimeKeys must be an object of key id to key')
+    if len(one_time_keys) > settings.ONE_TIME_KEYS_MAX_UPLOAD:
+        raise ValueError(f'At most {settings.ONE_TIME_KEYS_MAX_UPLOAD} one-time keys per upload')
+    return identity_key, signing_key, one_time_keys
+
+
+
 class UploadKeysView(generics.GenericAPIView):
     """
     User uploads their identity key + batch of one-time keys after login.
@@ -496,52 +1128,61 @@ class UploadKeysView(generics.GenericAPIView):
         "signingKey": "base64...",
         "oneTimeKeys": {"AAAAAQ": "base64...", "AAAAAg": "base64...", ...}
     }
+    Key ids already on the server are skipped; the new ones are inserted in one
+    statement and counted in oneTimeKeysAdded (see OneTimeKeysQuerySet.add). The
+    response includes the pool size and replenish hint.
     """
     permission_classes = [IsAuthenticated]
     
     def post(self, request):
         from .models import UserKeys, OneTimeKeys
         
-        identity_key = request.data.get('identityKey')
-        signing_key = request.data.get('signingKey')
-        one_time_keys = request.data.get('oneTimeKeys', {})
-        
-        if not identity_key or not signing_key:
-            return Response(
-                {'error': 'identityKey and signingKey are required'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        try:
+            identity_key, signing_key, one_time_keys = parse_key_upload(request.data)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
         # Save/update user's identity keys
-        UserKeys.objects.update_or_create(
-            user=request.user,
+        user_keys, _ = UserKeys.objects.update_or_create(
+            user_id=request.user.id,
             defaults={
                 'identity_key': identity_key,
                 'signing_key': signing_key
             }
         )
+        store_identity_keys(request.user.username, user_keys)
         
         # Save one-time keys (can be called multiple times to replenish)
-        keys_added = 0
-        for key_id, key_value in one_time_keys.items():
-            _, created = OneTimeKeys.objects.get_or_create(
-                user=request.user,
-                key_id=key_id,
-                defaults={'key_value': key_value}
-            )
-            if created:
-                keys_added += 1
+        added = OneTimeKeys.objects.add(request.user.id, one_time_keys)
+        available = OneTimeKeys.objects.filter(user_id=request.user.id, is_used=False).count()
         
         return Response({
             'message': 'Keys registered successfully',
-            'oneTimeKeysAdded': keys_added
+            'oneTimeKeysAdded': added,
+            **one_time_key_pool(available),
         }, status=status.HTTP_201_CREATED)
 
 
+def lookup_identity_keys(username):
+    """
+    (keys, None) with `username`'s identity_keys_entry from the key directory
+    cache, or (None, 404 response) when they are unknown or have no keys.
+    """
+    keys = get_identity_keys(username)
+    if keys is not None:
+        return keys, None
+    if not User.objects.filter(username=username).exists():
+        return None, Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+    return None, Response({'error': 'User has not uploaded encryption keys'}, status=status.HTTP_404_NOT_FOUND)
+
+
 class QueryKeysView(generics.GenericAPIView):
     """
     Sender fetches recipient's identity key + one OTK to establish a session.
     The OTK is marked as used after being fetched (one-time use only).
+    When the target's pool drops below the low watermark they get an
+    "otk_low" event over the WebSocket. Identity keys come from the key
+    directory cache; the OTK claim always goes to the database.
     
     GET /api/keys/query/<username>/
     Returns: {
@@ -554,24 +1195,15 @@ class QueryKeysView(generics.GenericAPIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request, username):
-        from .models import UserKeys, OneTimeKeys
-        
-        try:
-            target_user = User.objects.get(username=username)
-        except User.DoesNotExist:
-            return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+        from .models import OneTimeKeys
         
-        # Get user's identity keys
-        try:
-            user_keys = target_user.keys
-        except UserKeys.DoesNotExist:
-            return Response(
-                {'error': 'User has not uploaded encryption keys'},
-                status=status.HTTP_404_NOT_FOUND
-            )
+        keys, error = lookup_identity_keys(username)
+        if error:
+            return error
         
-        # Get an available one-time key
-        otk = target_user.one_time_keys.filter(is_used=False).first()
+        # Take an available one-time key and mark it used in one atomic step,
+        # so concurrent senders never receive the same key
+        otk = OneTimeKeys.objects.claim(keys['user_id'])
         
         if not otk:
             return Response(
@@ -579,42 +1211,188 @@ class QueryKeysView(generics.GenericAPIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Mark OTK as used (consumed)
-        otk.is_used = True
-        otk.save()
+        # Tell the key owner to top up before the pool runs dry
+        pool = one_time_key_pool(OneTimeKeys.objects.filter(user_id=keys['user_id'], is_used=False).count())
+        if pool['replenish']:
+            publish_event(keys['user_id'], {'type': 'otk_low', **pool})
         
         return Response({
-            'identityKey': user_keys.identity_key,
-            'signingKey': user_keys.signing_key,
+            'identityKey': keys['identity_key'],
+            'signingKey': keys['signing_key'],
             'oneTimeKey': otk.key_value,
             'oneTimeKeyId': otk.key_id,
         })
 
 
+class ClaimKeysView(generics.GenericAPIView):
+    """
+    QueryKeysView for many users at once, e.g. to open sessions with every
+    friend after logging in.
+    
+    POST /api/keys/claim/
+    Body: {"users": ["bob", 42, ...]}  (usernames, or user ids as integers)
+    
+    Returns one result per item, in order: {"status": 200, "userId": 42,
+    "username": "bob", "identityKey": ..., "signingKey": ..., "oneTimeKey": ...,
+    "oneTimeKeyId": ...} or {"status": 4xx, "error": "..."}. One key is claimed
+    per user: a user listed again (by username or id) gets a 400, since handing
+    out the same key twice would break the session opened with it. On PostgreSQL it
+    costs three SQL statements whatever the batch size: the users with their
+    identity keys, the claim (see OneTimeKeysQuerySet.claim_many) and the
+    remaining pool sizes.
+    """
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request):
+        from .models import OneTimeKeys
+        
+        users = request.data.get('users')
+        
+        if not isinstance(users, list) or not users:
+            return Response({'error': 'users must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        if len(users) > settings.ONE_TIME_KEYS_CLAIM_BATCH_MAX:
+            return Response(
+                {'error': f'At most {settings.ONE_TIME_KEYS_CLAIM_BATCH_MAX} users per request'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        usernames = {user for user in users if isinstance(user, str)}
+        user_ids = {user for user in users if is_integer_id(user)}
+        by_username, by_id = {}, {}
+        if usernames or user_ids:
+            for row in User.objects.filter(Q(username__in=usernames) | Q(id__in=user_ids)).values(
+                'id', 'username', 'keys__identity_key', 'keys__signing_key'
+            ):
+                by_username[row['username']] = by_id[row['id']] = row
+        
+        claimed = OneTimeKeys.objects.claim_many(
+            row['id'] for row in by_id.values() if row['keys__identity_key'] is not None
+        )
+        # Remaining pool sizes of the users who got a key
+        pools = {user_id: 0 for user_id in claimed}
+        if claimed:
+            pools.update(
+                OneTimeKeys.objects.filter(user_id__in=list(claimed), is_used=False)
+                .values('user_id').annotate(available=models.Count('id')).values_list('user_id', 'available')
+            )
+        
+        results = []
+        listed = set()
+        for user in users:
+            if isinstance(user, str):
+                row = by_username.get(user)
+            elif is_integer_id(user):
+                row = by_id.get(user)
+            else:
+                results.append({'status': 400, 'error': 'Each user must be a username or an integer id'})
+                continue
+            if row is None:
+                results.append({'status': 404, 'error': 'User not found'})
+            elif row['id'] in listed:
+                results.append({'status': 400, 'error': 'User listed more than once'})
+            elif row['keys__identity_key'] is None:
+                results.append({'status': 404, 'error': 'User has not uploaded encryption keys'})
+            elif row['id'] not in claimed:
+                results.append({'status': 400, 'error': 'No one-time keys available. User needs to replenish.'})
+            else:
+                otk = claimed[row['id']]
+                listed.add(row['id'])
+                results.append({
+                    'status': 200,
+                    'userId': row['id'],
+                    'username': row['username'],
+                    'identityKey': row['keys__identity_key'],
+                    'signingKey': row['keys__signing_key'],
+                    'oneTimeKey': otk.key_value,
+                    'oneTimeKeyId': otk.key_id,
+                })
+        
+        # Tell every key owner whose pool is now low, in one round trip
+        events = []
+        for user_id, available in pools.items():
+            pool = one_time_key_pool(available)
+            if pool['replenish']:
+                events.append((user_id, {'type': 'otk_low', **pool}))
+        if events:
+            publish_events(events)
+        
+        claimed_count = sum(result['status'] == 200 for result in results)
+        return Response({
+            'results': results,
+            'claimed': claimed_count,
+            'failed': len(users) - claimed_count,
+        })
+
+
+class IdentityKeysView(generics.GenericAPIView):
+    """
+    A user's identity and signing keys only, without claiming a one-time key:
+    for setting up an inbound session or verifying a sender.
+    
+    GET /api/keys/identity/<username>/
+    Returns: {"identityKey": "base64...", "signingKey": "base64..."} with an ETag.
+    Send it back in If-None-Match to get 304 Not Modified while the keys are
+    unchanged; either way only the key directory cache is read.
+    """
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request, username):
+        keys, error = lookup_identity_keys(username)
+        if error:
+            return error
+        
+        etag = quote_etag(keys['version'])
+        headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match and (etag in parse_etags(if_none_match) or if_none_match.strip() == '*'):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        
+        return Response({
+            'identityKey': keys['identity_key'],
+            'signingKey': keys['signing_key'],
+        }, headers=headers)
+
+
 class GetOwnKeysView(generics.GenericAPIView):
     """
     Get current user's own public keys and OTK count.
-    Useful for checking if keys need to be replenished.
+    Useful for checking if keys need to be replenished: below
+    ONE_TIME_KEYS_LOW_WATERMARK, replenish is true and replenishCount says how
+    many keys to upload.
     
     GET /api/keys/me/
     """
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
-        from .models import UserKeys, OneTimeKeys
+        from .models import OneTimeKeys
         
-        try:
-            user_keys = request.user.keys
-            available_otks = request.user.one_time_keys.filter(is_used=False).count()
-            
-            return Response({
-                'hasKeys': True,
-                'identityKey': user_keys.identity_key,
-                'signingKey': user_keys.signing_key,
-                'availableOneTimeKeys': available_otks
-            })
-        except UserKeys.DoesNotExist:
+        keys = get_identity_keys(request.user.username)
+        if keys is None:
             return Response({
                 'hasKeys': False,
-                'availableOneTimeKeys': 0
+                **one_time_key_pool(0),
             })
+        
+        available_otks = OneTimeKeys.objects.filter(user_id=request.user.id, is_used=False).count()
+        return Response({
+            'hasKeys': True,
+            'identityKey': keys['identity_key'],
+            'signingKey': keys['signing_key'],
+            **one_time_key_pool(available_otks),
+        })
+
+
+# ============ OPERATIONS ENDPOINTS ============
+
+class RedisPoolStatsView(generics.GenericAPIView):
+    """
+    Redis connection pool utilisation for the worker serving the request.
+    
+    GET /api/metrics/redis-pool/  (staff only)
+    """
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        return Response(pool_stats())
@@ -198,6 +198,16 @@ function SideBar({ friends, onSelectFriend, token, onFriendsUpdated }) {
   );
 }
 
+// Vault and Redis ids are separate sequences, so a message is known by both
+const messageKey = (msg) => `${msg.source}-${msg.id}`;
+
+// `incoming` added after (or, for an older page, before) `existing`, skipping known messages
+function mergeMessages(existing, incoming, older = false) {
+  const known = new Set(existing.map(messageKey));
+  const fresh = incoming.filter(msg => !known.has(messageKey(msg)));
+  return older ? [...fresh, ...existing] : [...existing, ...fresh];
+}
+
 function ChatUI({ selectedFriend, token, username }) {
   const [message, setMessage] = useState("");
   const [messages, setMessages] = useState([]); // Server-stored messages
@@ -254,88 +264,145 @@ function ChatUI({ selectedFriend, token, username }) {
     }
   }, [selectedFriend, token, ensureEncryptionSession]);
 
-  const fetchMessages = React.useCallback(async () => {
-    if (selectedFriend && token) {
-      try {
-        const res = await fetch(`http://localhost:8000/api/get-messages/?user_id=${selectedFriend.id}`, {
-          headers: { 'Authorization': `Bearer ${token}` }
-        });
-        const data = await res.json();
-        const rawMessages = data.messages || [];
+  // Paging cursors of the open conversation (see GetMessagesView); null until the first page
+  const cursorsRef = React.useRef(null);
+  const [hasOlder, setHasOlder] = useState(false);
 
-        // Decrypt messages
-        const decryptedMessages = await Promise.all(rawMessages.map(async (msg) => {
+  const decryptMessages = React.useCallback(async (rawMessages) => {
+    return Promise.all(rawMessages.map(async (msg) => {
+      try {
+        // If message is from Redis (encrypted with Olm)
+        if (msg.source === 'redis') {
+          // Try to parse as encrypted JSON
           try {
-            // If message is from Redis (encrypted with Olm)
-            if (msg.source === 'redis') {
-              // Try to parse as encrypted JSON
-              try {
-                const encrypted = JSON.parse(msg.content);
-                if (encrypted.type !== undefined && encrypted.body) {
-                  // Determine the friendId based on who sent it
-                  const friendId = msg.sender_id === selectedFriend.id 
-                    ? selectedFriend.id 
-                    : selectedFriend.id;
-                  
-                  // For incoming messages without session, create inbound session
-                  if (encrypted.type === 0 && !hasSession(friendId)) {
-                    // We need the sender's identity key for inbound session
-                    // For now, try to fetch it
-                    try {
-                      const keysRes = await fetch(`http://localhost:8000/api/keys/query/${selectedFriend.username}/`, {
-                        headers: { 'Authorization': `Bearer ${token}` }
-                      });
-                      if (keysRes.ok) {
-                        const keysData = await keysRes.json();
-                        createInboundSession(friendId, keysData.identityKey, encrypted.body);
-                      }
-                    } catch (e) {
-                      console.warn('Could not create inbound session:', e);
-                    }
+            const encrypted = JSON.parse(msg.content);
+            if (encrypted.type !== undefined && encrypted.body) {
+              // Determine the friendId based on who sent it
+              const friendId = msg.sender_id === selectedFriend.id 
+                ? selectedFriend.id 
+                : selectedFriend.id;
+              
+              // For incoming messages without session, create inbound session
+              if (encrypted.type === 0 && !hasSession(friendId)) {
+                // We need the sender's identity key for inbound session.
+                // The identity endpoint does not use up one of their one-time keys,
+                // and the browser revalidates it with its ETag
+                try {
+                  const keysRes = await fetch(`http://localhost:8000/api/keys/identity/${selectedFriend.username}/`, {
+                    headers: { 'Authorization': `Bearer ${token}` }
+                  });
+                  if (keysRes.ok) {
+                    const keysData = await keysRes.json();
+                    createInboundSession(friendId, keysData.identityKey, encrypted.body);
                   }
-
-                  const plaintext = decryptMessage(friendId, encrypted.type, encrypted.body);
-                  return { ...msg, content: plaintext };
+                } catch (e) {
+                  console.warn('Could not create inbound session:', e);
                 }
-              } catch (parseErr) {
-                // Not encrypted JSON, return as-is (legacy unencrypted message)
-                return msg;
               }
-            }
-            
-            // If message is from vault (encrypted with AES)
-            if (msg.source === 'vault') {
-              try {
-                const plaintext = await decryptFromVault(msg.content);
-                return { ...msg, content: plaintext };
-              } catch (vaultErr) {
-                console.warn('Vault decryption failed, showing raw content:', vaultErr.message);
-                // Return the message as-is - it might be unencrypted legacy or from a different session
-                return { ...msg, decryptionFailed: true };
-              }
-            }
 
+              const plaintext = decryptMessage(friendId, encrypted.type, encrypted.body);
+              return { ...msg, content: plaintext };
+            }
+          } catch (parseErr) {
+            // Not encrypted JSON, return as-is (legacy unencrypted message)
             return msg;
-          } catch (decryptErr) {
-            console.error('Decryption error for message:', decryptErr);
-            return { ...msg, content: '[Decryption failed]', decryptionFailed: true };
           }
-        }));
+        }
+        
+        // If message is from vault (encrypted with AES)
+        if (msg.source === 'vault') {
+          try {
+            const plaintext = await decryptFromVault(msg.content);
+            return { ...msg, content: plaintext };
+          } catch (vaultErr) {
+            console.warn('Vault decryption failed, showing raw content:', vaultErr.message);
+            // Return the message as-is - it might be unencrypted legacy or from a different session
+            return { ...msg, decryptionFailed: true };
+          }
+        }
 
-        setMessages(decryptedMessages);
+        return msg;
+      } catch (decryptErr) {
+        console.error('Decryption error for message:', decryptErr);
+        return { ...msg, content: '[Decryption failed]', decryptionFailed: true };
+      }
+    }));
+  }, [selectedFriend, token]);
+
+  const requestMessages = React.useCallback(async (params) => {
+    const query = new URLSearchParams({ user_id: selectedFriend.id, ...params });
+    const res = await fetch(`http://localhost:8000/api/get-messages/?${query}`, {
+      headers: { 'Authorization': `Bearer ${token}` }
+    });
+    const data = await res.json();
+    return { ...data, messages: await decryptMessages(data.messages || []) };
+  }, [selectedFriend, token, decryptMessages]);
+
+  // Fetch only what arrived since the last fetch (the newest page the first time).
+  // Olm messages can only be decrypted once, so known messages are never fetched again.
+  const fetchMessages = React.useCallback(async () => {
+    if (selectedFriend && token) {
+      try {
+        if (cursorsRef.current === null) {
+          const data = await requestMessages({});
+          cursorsRef.current = data.cursors;
+          setHasOlder(data.has_more);
+          setMessages(prev => mergeMessages(prev, data.messages));
+          return;
+        }
+        // Ids start at 1, so 0 means "everything" when a source had no messages yet
+        let hasMore = true;
+        while (hasMore) {
+          const { since, vault_since } = cursorsRef.current;
+          const data = await requestMessages({ since: since ?? 0, vault_since: vault_since ?? 0 });
+          cursorsRef.current = { ...cursorsRef.current, since: data.cursors.since, vault_since: data.cursors.vault_since };
+          setMessages(prev => mergeMessages(prev, data.messages));
+          hasMore = data.has_more && data.messages.length > 0;
+        }
       } catch (err) {
         console.error('Fetch messages error:', err);
       }
     }
-  }, [selectedFriend, token]);
+  }, [selectedFriend, token, requestMessages]);
+
+  // Page back through the conversation, one page per source at a time
+  const fetchOlderMessages = async () => {
+    if (!cursorsRef.current) return;
+    try {
+      const { before, vault_before } = cursorsRef.current;
+      // An exclusive bound of 1 asks a source with no messages on screen for nothing
+      const data = await requestMessages({ before: before ?? 1, vault_before: vault_before ?? 1 });
+      cursorsRef.current = { ...cursorsRef.current, before: data.cursors.before, vault_before: data.cursors.vault_before };
+      setHasOlder(data.has_more);
+      setMessages(prev => mergeMessages(prev, data.messages, true));
+    } catch (err) {
+      console.error('Fetch older messages error:', err);
+    }
+  };
 
   // Load messages when friend is selected
   React.useEffect(() => {
     if (selectedFriend && token) {
+      cursorsRef.current = null;
+      setHasOlder(false);
+      setMessages([]);
       fetchMessages();
     }
   }, [selectedFriend, token, fetchMessages]);
 
+  // Fetch the new messages when the server pushes one from the open chat's friend
+  React.useEffect(() => {
+    if (!selectedFriend || !token) return undefined;
+    const socket = new WebSocket(`ws://localhost:8000/ws/messages/?token=${token}`);
+    socket.onmessage = (event) => {
+      const data = JSON.parse(event.data);
+      if (data.type === 'message' && data.message.sender_id === selectedFriend.id) {
+        fetchMessages();
+      }
+    };
+    return () => socket.close();
+  }, [selectedFriend, token, fetchMessages]);
+
   const handleSendMessage = async () => {
     if (message.trim()) {
       try {
@@ -372,6 +439,7 @@ function ChatUI({ selectedFriend, token, username }) {
           // Add message to state with decrypted content for display
           setMessages(prev => [...prev, {
             ...data.message_data,
+            source: 'redis', // Known from now on, so the next fetch skips it
             content: message // Show original plaintext in UI
           }]);
           setMessage("");
@@ -408,14 +476,17 @@ function ChatUI({ selectedFriend, token, username }) {
         body: JSON.stringify({
           other_user_id: selectedFriend.id,
           content: vaultContent,
-          is_sender: isSender
+          is_sender: isSender,
+          // The server matches the message (and its Redis copy) by id: the vault
+          // copy is encrypted afresh, so its content never equals the original
+          message_id: msg.source === 'redis' ? msg.id : undefined
         })
       });
       
       if (res.ok) {
         // Update message to show it's saved without refresh
         setMessages(prev => prev.map(m => 
-          m.content === msg.content && m.sender_id === msg.sender_id
+          m.id === msg.id && m.source === msg.source
             ? { ...m, is_saved: true, source: 'vault' }
             : m
         ));
@@ -427,7 +498,7 @@ function ChatUI({ selectedFriend, token, username }) {
 
   const handleDeleteMessage = (messageId) => {
     // Remove from state (will be cleaned up by server on logout)
-    setMessages(prev => prev.filter(m => m.id !== messageId));
+    setMessages(prev => prev.filter(m => !(m.source === 'redis' && m.id === messageId)));
   };
 
   return (
@@ -463,9 +534,14 @@ function ChatUI({ selectedFriend, token, username }) {
         padding: '15px',
         background: '#f9f9f9'
       }}>
+        {hasOlder && (
+          <button onClick={fetchOlderMessages} style={{ display: 'block', margin: '0 auto 15px', padding: '6px 12px', cursor: 'pointer' }}>
+            Load older messages
+          </button>
+        )}
         {messages.length > 0 ? (
           messages.map((msg) => (
-            <div key={msg.id || `${msg.sender_id}-${msg.content}`} style={{
+            <div key={messageKey(msg)} style={{
               marginBottom: '15px',
               padding: '10px',
               background: msg.sender_username === selectedFriend.username ? '#e3f2fd' : '#f1f8e9',